@@ -20,11 +20,16 @@ This module implements a LRU (Least Recently Used) Cache.
 http://en.wikipedia.org/wiki/Cache_algorithms
 """
 
-# Import from itools
-from odict import OrderedDict
+
+class Node(object):
+    """The nodes of the doubly-linked list.
+    """
+
+    __slots__ = ['prev', 'next', 'key']
+
 
 
-class LRUCache(OrderedDict):
+class LRUCache(dict):
     """LRU stands for Least-Recently-Used.
 
     The LRUCache is a mapping from key to value, it is implemented as a dict
@@ -57,8 +62,16 @@ class LRUCache(OrderedDict):
 
     - touch(key): defines the value identified by the given key as to be
       accessed, hence it will be at the end of the list.
+
+    The access order is kept in a circular doubly-linked list, with a
+    sentinel node (the root), so every operation is O(1) without special
+    cases for the first and last nodes.  Setting the value of a key already
+    in the cache touches it.
     """
 
+    __slots__ = ['size_min', 'size_max', 'automatic', 'root', 'key2node']
+
+
     def __init__(self, size_min, size_max=None, automatic=True):
         # Check arguments type
         if type(size_min) is not int:
@@ -78,6 +91,12 @@ class LRUCache(OrderedDict):
 
         # Initialize the dict
         super(LRUCache, self).__init__()
+        # The doubly-linked list
+        root = self.root = Node()
+        root.prev = root.next = root
+        root.key = None
+        # Map from key-to-node
+        self.key2node = {}
         # The cache size
         self.size_min = size_min
         self.size_max = size_max
@@ -85,13 +104,30 @@ class LRUCache(OrderedDict):
         self.automatic = automatic
 
 
-    def _append(self, key):
-        super(LRUCache, self)._append(key)
-
-        # Free memory if needed
-        if self.automatic is True and len(self) > self.size_max:
-            while len(self) > self.size_min:
-                self.popitem()
+    def _check_integrity(self):
+        """This method is for testing purposes, it checks the internal
+        data structures are consistent.
+        """
+        keys = self.keys()
+        keys.sort()
+        # Check the key-to-node mapping
+        keys2 = self.key2node.keys()
+        keys2.sort()
+        assert keys == keys2
+        # Check the key-to-node against the doubly-linked list
+        for key, node in self.key2node.iteritems():
+            assert type(key) is type(node.key)
+            assert key == node.key
+        # Check the doubly-linked list against the cache
+        keys = set(keys)
+        root = self.root
+        node = root.next
+        while node is not root:
+            assert node.next.prev is node
+            assert node.key in keys
+            keys.discard(node.key)
+            node = node.next
+        assert len(keys) == 0
 
 
     def touch(self, key):
@@ -99,20 +135,146 @@ class LRUCache(OrderedDict):
         node = self.key2node[key]
 
         # (2) Touch in the doubly-linked list
+        root = self.root
+        last = root.prev
         # Already the last one
-        if node.next is None:
+        if node is last:
             return
 
         # Unlink
-        if node.prev is None:
-            self.first = node.next
-        else:
-            node.prev.next = node.next
+        node.prev.next = node.next
         node.next.prev = node.prev
-
         # Link
-        node.prev = self.last
-        node.next = None
-        self.last.next = node
-        self.last = node
+        node.prev = last
+        node.next = root
+        last.next = root.prev = node
+
+
+    ######################################################################
+    # Override dict API
+    def __iter__(self):
+        root = self.root
+        node = root.next
+        while node is not root:
+            yield node.key
+            node = node.next
+
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+
+        # Already in the cache
+        key2node = self.key2node
+        if key in key2node:
+            self.touch(key)
+            return
+
+        # Append to the doubly-linked list
+        root = self.root
+        last = root.prev
+        node = Node()
+        node.key = key
+        node.prev = last
+        node.next = root
+        last.next = root.prev = key2node[key] = node
+
+        # Free memory if needed
+        if self.automatic is True and len(self) > self.size_max:
+            self._evict(self.size_min)
+
+
+    def _evict(self, size):
+        """Removes the least-recently used values until the cache has the
+        given size.
+        """
+        root = self.root
+        key2node = self.key2node
+        n = len(self) - size
+        while n > 0:
+            node = root.next
+            key = node.key
+            dict.__delitem__(self, key)
+            del key2node[key]
+            root.next = node.next
+            node.next.prev = root
+            n -= 1
+
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        node = self.key2node.pop(key)
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+
+    def clear(self):
+        dict.clear(self)
+        self.key2node.clear()
+        root = self.root
+        root.prev = root.next = root
+
+
+    def copy(self):
+        message = "use 'copy.deepcopy' to copy a cache"
+        raise NotImplementedError, message
+
+
+    def fromkeys(self, seq, value=None):
+        raise NotImplementedError, "the 'fromkeys' method is not supported"
+
+
+    def items(self):
+        return list(self.iteritems())
+
+
+    def iteritems(self):
+        root = self.root
+        node = root.next
+        while node is not root:
+            key = node.key
+            yield key, self[key]
+            node = node.next
+
+
+    def iterkeys(self):
+        return self.__iter__()
+
+
+    def itervalues(self):
+        root = self.root
+        node = root.next
+        while node is not root:
+            yield self[node.key]
+            node = node.next
+
+
+    def keys(self):
+        return list(self.__iter__())
+
+
+    def pop(self, key):
+        value = dict.pop(self, key)
+        node = self.key2node.pop(key)
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        return value
+
+
+    def popitem(self):
+        node = self.root.next
+        if node is self.root:
+            raise KeyError, 'popitem(): cache is empty'
+        key = node.key
+        return key, self.pop(key)
+
+
+    def setdefault(self, key, default=None):
+        raise NotImplementedError, "the 'setdefault' method is not supported"
+
+
+    def update(self, value=None, **kw):
+        raise NotImplementedError, "the 'update' method is not supported"
+
 
+    def values(self):
+        return list(self.itervalues())
@@ -22,11 +22,14 @@ from fields import Field
 from queries import AllQuery, NotQuery, StartQuery, TextQuery
 from queries import RangeQuery, PhraseQuery, AndQuery, OrQuery, pprint_query
 from magic_ import magic_from_buffer, magic_from_file
+from maintenance import Maintenance
 from metadata import Metadata
 from registry import get_register_fields, register_field
+from reindex import reindex_catalog
 from resources import Resource
 from ro import RODatabase, ReadonlyError
 from rw import RWDatabase, make_git_database, check_database
+from snapshot import SnapshotDatabase
 
 
 __all__ = [
@@ -36,8 +39,10 @@ __all__ = [
     'ReadonlyError',
     'RODatabase',
     'RWDatabase',
+    'SnapshotDatabase',
     'make_git_database',
     'check_database',
+    'Maintenance',
     'get_register_fields',
     'register_field',
     # Metadata
@@ -48,6 +53,7 @@ __all__ = [
     # Xapian
     'make_catalog',
     'Catalog',
+    'reindex_catalog',
     # Queries
     'RangeQuery',
     'PhraseQuery',
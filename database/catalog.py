@@ -25,10 +25,11 @@ from hashlib import sha1
 # Import from xapian
 from xapian import Database, WritableDatabase, DB_CREATE, DB_OPEN
 from xapian import Document, Query, QueryParser, Enquire, MultiValueSorter
+from xapian import ValueCountMatchSpy
 from xapian import sortable_serialise, sortable_unserialise, TermGenerator
 
 # Import from itools
-from itools.core import fixed_offset, lazy
+from itools.core import LRUCache, fixed_offset, lazy
 from itools.datatypes import Integer, Unicode, String
 from itools.fs import lfs
 from itools.i18n import is_punctuation
@@ -41,6 +42,7 @@ from queries import RangeQuery, StartQuery, TextQuery, _MultipleQuery
 # Constants
 OP_AND = Query.OP_AND
 OP_AND_NOT = Query.OP_AND_NOT
+OP_FILTER = Query.OP_FILTER
 OP_OR = Query.OP_OR
 OP_PHRASE = Query.OP_PHRASE
 OP_VALUE_RANGE = Query.OP_VALUE_RANGE
@@ -142,25 +144,131 @@ class Doc(object):
 
 
 
+_record_classes = {}
+
+def _get_record_class(names):
+    """Returns the class of the records with the given attributes, see
+    "SearchResults.get_documents".
+    """
+    cls = _record_classes.get(names)
+    if cls is None:
+        cls = type('Record', (object,), {'__slots__': names})
+        _record_classes[names] = cls
+    return cls
+
+
+
+def _get_make_doc(catalog, names):
+    """Returns the function to build the document (a "Doc" or a record with
+    only the given fields) from the Xapian document.
+    """
+    fields = catalog._fields
+    metadata = catalog._metadata
+    if names is None:
+        return lambda xdoc: Doc(xdoc, fields, metadata)
+
+    # The stored fields to load
+    names = tuple(names)
+    columns = []
+    for name in names:
+        info = metadata.get(name)
+        if info is None:
+            # No document has this field yet
+            if name not in fields:
+                raise ValueError, MSG_NOT_INDEXED_NOR_STORED.format(name=name)
+            if not getattr(fields[name], 'stored', False):
+                raise ValueError, MSG_NOT_STORED.format(name=name)
+            columns.append((name, None, fields[name], False))
+            continue
+        stored = info.get('value')
+        if stored is None:
+            raise ValueError, MSG_NOT_STORED.format(name=name)
+        field_cls = _get_field_cls(name, fields, info)
+        # Multilingual field: the language will be negotiated by "Doc"
+        negotiate = issubclass(field_cls, Unicode) and 'from' not in info
+        columns.append((name, stored, field_cls, negotiate))
+
+    record_class = _get_record_class(names)
+    def make_doc(xdoc):
+        record = record_class()
+        for name, stored, field_cls, negotiate in columns:
+            raw_value = xdoc.get_value(stored) if stored is not None else ''
+            if raw_value:
+                value = _decode(field_cls, raw_value)
+            elif negotiate:
+                value = getattr(Doc(xdoc, fields, metadata), name)
+            else:
+                value = field_cls.get_default()
+            setattr(record, name, value)
+        return record
+
+    return make_doc
+
+
+
 class SearchResults(object):
 
-    def __init__(self, database, xquery):
+    def __init__(self, database, xquery, key=None):
         self._database = database
         self._xquery = xquery
+        # The normalized query, used to cache the results (None if the
+        # results are not to be cached)
+        self._key = key
 
 
-    @lazy
-    def _enquire(self):
+    def _make_enquire(self, sort_by=None, reverse=False):
         enquire = Enquire(self._database.catalog._db)
         enquire.set_query(self._xquery)
+
+        # sort_by != None
+        metadata = self._database.catalog._metadata
+        if sort_by is not None:
+            if isinstance(sort_by, list):
+                sorter = MultiValueSorter()
+                for name in sort_by:
+                    # If there is a problem, ignore this field
+                    if name not in metadata:
+                        warn_not_stored(name)
+                        continue
+                    sorter.add(metadata[name]['value'])
+                enquire.set_sort_by_key_then_relevance(sorter, reverse)
+            else:
+                # If there is a problem, ignore the sort
+                if sort_by in metadata:
+                    value = metadata[sort_by]['value']
+                    enquire.set_sort_by_value_then_relevance(value, reverse)
+                else:
+                    warn_not_stored(sort_by)
+        else:
+            enquire.set_sort_by_relevance()
+
         return enquire
 
 
+    @lazy
+    def _enquire(self):
+        return self._make_enquire()
+
+
     @lazy
     def _max(self):
-        enquire = self._enquire
-        max = enquire.get_mset(0, 0).get_matches_upper_bound()
-        return enquire.get_mset(0, max).size()
+        catalog = self._database.catalog
+        key = self._key
+        if key is not None:
+            key = ('len', key)
+            value = catalog._get_cached_results(key)
+            if value is not None:
+                return value
+
+        # Ask Xapian to check every document, so the estimation is exact,
+        # but without building the match set (the memory use is bounded).
+        doccount = catalog._db.get_doccount()
+        mset = self._enquire.get_mset(0, 0, doccount)
+        value = mset.get_matches_estimated()
+
+        if key is not None:
+            catalog._set_cached_results(key, value)
+        return value
 
 
     def __len__(self):
@@ -168,15 +276,81 @@ class SearchResults(object):
         return self._max
 
 
+    def get_n_documents(self, exact=True, check_at_least=0):
+        """Returns the number of documents found.
+
+        By default the count is exact.  If "exact" is False an estimation
+        is returned instead, which is much cheaper on big catalogs.  The
+        estimation is exact when there are no more than "check_at_least"
+        matches.
+        """
+        if exact:
+            return self._max
+
+        mset = self._enquire.get_mset(0, 0, check_at_least)
+        return mset.get_matches_estimated()
+
+
+    def get_facets(self, *names):
+        """Returns the number of documents found for every value of the
+        given stored fields, in a single pass. For example:
+
+          >>> results.get_facets('format', 'workflow_state')
+          {'format': {'file': 12, 'folder': 3},
+           'workflow_state': {'public': 10, 'private': 5}}
+
+        For the multiple fields every value is counted separately.
+        """
+        catalog = self._database.catalog
+        fields = catalog._fields
+        metadata = catalog._metadata
+
+        # One spy per field
+        enquire = self._make_enquire()
+        spies = []
+        for name in names:
+            info = metadata.get(name)
+            if info is None or 'value' not in info:
+                warn_not_stored(name)
+                continue
+            spy = ValueCountMatchSpy(info['value'])
+            enquire.add_matchspy(spy)
+            field_cls = _get_field_cls(name, fields, info)
+            spies.append((name, field_cls, spy))
+
+        # Go
+        doccount = catalog._db.get_doccount()
+        enquire.get_mset(0, 0, doccount)
+
+        # Decode
+        facets = dict([ (name, {}) for name in names ])
+        for name, field_cls, spy in spies:
+            facet = facets[name]
+            for item in spy.values():
+                value = _decode(field_cls, item.term)
+                count = item.termfreq
+                if type(value) is not list:
+                    value = [value]
+                for x in value:
+                    facet[x] = facet.get(x, 0) + count
+
+        return facets
+
+
     def search(self, query=None, **kw):
         database = self._database
 
-        xquery = _get_xquery(database.catalog, query, **kw)
+        xquery, key = database.catalog._get_cached_xquery(query, kw)
         query = Query(Query.OP_AND, [self._xquery, xquery])
-        return self.__class__(database, query)
+        if key is not None and self._key is not None:
+            key = (_AndQuery, frozenset([self._key, key]))
+        else:
+            key = None
+        return self.__class__(database, query, key)
 
 
-    def get_documents(self, sort_by=None, reverse=False, start=0, size=0):
+    def get_documents(self, sort_by=None, reverse=False, start=0, size=0,
+                      fields=None):
         """Returns the documents for the search, sorted by weight.
 
         Four optional arguments are accepted, which will modify the documents
@@ -202,58 +376,189 @@ class SearchResults(object):
           - "size": returns at most documents as specified by this parameter.
 
         By default all the documents are returned.
+
+        Finally, the "fields" parameter allows to load only the given stored
+        fields. Then the documents returned are light records with just
+        these fields as attributes, all of them loaded at once.
         """
-        enquire = self._enquire
         catalog = self._database.catalog
-
-        # sort_by != None
-        metadata = catalog._metadata
-        if sort_by is not None:
-            if isinstance(sort_by, list):
-                sorter = MultiValueSorter()
-                for name in sort_by:
-                    # If there is a problem, ignore this field
-                    if name not in metadata:
-                        warn_not_stored(name)
-                        continue
-                    sorter.add(metadata[name]['value'])
-                enquire.set_sort_by_key_then_relevance(sorter, reverse)
+        if fields is not None:
+            fields = tuple(fields)
+
+        # Cache (only the small pages, the memory used must be bounded)
+        key = self._key
+        if size < 1 or size > catalog.results_page_max:
+            key = None
+        if key is not None:
+            if type(sort_by) is list:
+                sort_key = tuple(sort_by)
             else:
-                # If there is a problem, ignore the sort
-                if sort_by in metadata:
-                    value = metadata[sort_by]['value']
-                    enquire.set_sort_by_value_then_relevance(value, reverse)
-                else:
-                    warn_not_stored(sort_by)
-        else:
-            enquire.set_sort_by_relevance()
+                sort_key = sort_by
+            key = ('documents', key, sort_key, reverse, start, size, fields)
+            results = catalog._get_cached_results(key)
+            if results is not None:
+                return list(results)
+
+        enquire = self._make_enquire(sort_by, reverse)
 
         # start/size
         if size == 0:
             size = self._max
 
         # Construction of the results
-        fields = catalog._fields
-        results = [ Doc(x.document, fields, metadata)
-                    for x in enquire.get_mset(start, size) ]
+        make_doc = _get_make_doc(catalog, fields)
+        mset = enquire.get_mset(start, size)
+        results = [ make_doc(x.document) for x in mset ]
 
         # sort_by=None/reverse=True
         if sort_by is None and reverse:
             results.reverse()
 
+        if key is not None:
+            catalog._set_cached_results(key, results)
+            return list(results)
         return results
 
 
+    def iter_documents(self, sort_by=None, reverse=False, start=0, size=0,
+                       fields=None, page_size=100):
+        """Like "get_documents", but returns a generator. The documents are
+        loaded from the catalog in pages of "page_size" documents, so the
+        memory used does not depend on the number of documents found.
+
+        Reversing the order by weight is not supported, the parameter
+        "reverse" requires the parameter "sort_by".
+        """
+        if sort_by is None and reverse:
+            raise ValueError, 'reverse requires the sort_by parameter'
+        if page_size < 1:
+            raise ValueError, 'page_size must be a positive integer'
+
+        # An enquire of our own, the sort order must not change between
+        # two pages
+        enquire = self._make_enquire(sort_by, reverse)
+
+        make_doc = _get_make_doc(self._database.catalog, fields)
+        while True:
+            n = page_size if size == 0 else min(page_size, size)
+            mset = enquire.get_mset(start, n)
+            for x in mset:
+                yield make_doc(x.document)
+
+            # Last page
+            if mset.size() < n:
+                return
+            start += n
+            if size:
+                size -= n
+                if size == 0:
+                    return
+
+
+    def get_page(self, sort_by, reverse=False, size=20, after=None,
+                 fields=None):
+        """Returns a page of documents sorted by the given stored field,
+        and the cursor to get the next page (None if this is the last page):
+
+          >>> documents, cursor = results.get_page('mtime', size=50)
+          >>> documents, cursor = results.get_page('mtime', size=50,
+          ...                                      after=cursor)
+
+        Unlike "get_documents(start=N)", the cost of a page does not depend
+        on its position, since the search starts after the last sort value
+        of the previous page.  The documents with the same sort value are
+        ordered by their internal id; those without a value come first (or
+        last if reverse).
+
+        The parameters "reverse" and "fields" work like in "get_documents".
+        """
+        catalog = self._database.catalog
+
+        # The field must be stored
+        if type(sort_by) is not str:
+            raise TypeError, 'expected the name of one field, not "%s"' % (
+                sort_by,)
+        info = catalog._metadata.get(sort_by)
+        if info is None or 'value' not in info:
+            raise ValueError, MSG_NOT_STORED.format(name=sort_by)
+        slot = info['value']
+
+        # Start after the cursor.  The value ranges do not match the
+        # documents without a value, which come first (or last if reverse)
+        xquery = self._xquery
+        skip = 0
+        if after is not None:
+            after_value, skip = after
+            empty = Query(OP_AND_NOT, Query(''), Query(OP_VALUE_GE, slot, ''))
+            if after_value == '':
+                # Still among the documents without a value
+                if reverse:
+                    xquery = Query(OP_FILTER, xquery, empty)
+            elif reverse:
+                xfilter = Query(OP_OR, Query(OP_VALUE_LE, slot, after_value),
+                                empty)
+                xquery = Query(OP_FILTER, xquery, xfilter)
+            else:
+                xfilter = Query(OP_VALUE_GE, slot, after_value)
+                xquery = Query(OP_FILTER, xquery, xfilter)
+
+        enquire = Enquire(catalog._db)
+        enquire.set_query(xquery)
+        enquire.set_sort_by_value(slot, reverse)
+        enquire.set_docid_order(Enquire.ASCENDING)
+        mset = enquire.get_mset(skip, size)
+
+        # The documents
+        make_doc = _get_make_doc(catalog, fields)
+        documents = []
+        values = []
+        for x in mset:
+            xdoc = x.document
+            documents.append(make_doc(xdoc))
+            values.append(xdoc.get_value(slot))
+
+        # Last page
+        if len(values) < size:
+            return documents, None
+
+        # The cursor: the last sort value, and how many documents with this
+        # value have been returned so far
+        last_value = values[-1]
+        n = 0
+        for value in reversed(values):
+            if value != last_value:
+                break
+            n += 1
+        if n == len(values) and after is not None:
+            if after_value == last_value:
+                n += skip
+
+        return documents, (last_value, n)
+
+
     def get_resources(self, sort_by=None, reverse=False, start=0, size=0):
+        # Only the abspath is needed to load the resources
+        fields = ['abspath']
+        if sort_by is None and reverse:
+            brains = self.get_documents(sort_by, reverse, start, size, fields)
+        else:
+            brains = self.iter_documents(sort_by, reverse, start, size,
+                                         fields)
+
         database = self._database
-        for brain in self.get_documents(sort_by, reverse, start, size):
+        for brain in brains:
             yield database.get_resource(brain.abspath)
 
 
 
 class Catalog(object):
 
-    def __init__(self, ref, fields, read_only=False, asynchronous_mode=True):
+    # The pages of documents are cached only up to this size
+    results_page_max = 50
+
+
+    def __init__(self, ref, fields, read_only=False, asynchronous_mode=True,
+                 xquery_cache_size=1000, results_cache_size=200):
         # Load the database
         if isinstance(ref, (Database, WritableDatabase)):
             self._db = ref
@@ -278,6 +583,23 @@ class Catalog(object):
         self._prefix_nb = 0
         self._load_all_internal()
 
+        # The caches, from normalized query to Xapian query, and to search
+        # results (the number of documents found and the small pages of
+        # documents already returned).  The caches are cleared by every
+        # change, and the results are specific to a revision of the Xapian
+        # database.
+        self._xquery_cache = None
+        if xquery_cache_size:
+            self._xquery_cache = LRUCache(xquery_cache_size)
+        self._results_cache = None
+        if results_cache_size:
+            self._results_cache = LRUCache(results_cache_size)
+        self._cache_stats = {
+            'xquery_hits': 0,
+            'xquery_misses': 0,
+            'results_hits': 0,
+            'results_misses': 0}
+
 
     #######################################################################
     # API / Public / Transactions
@@ -291,6 +613,7 @@ class Catalog(object):
         db.commit_transaction()
         db.flush()
         db.begin_transaction(False)
+        self._clear_cache()
 
 
     def abort_changes(self):
@@ -302,6 +625,35 @@ class Catalog(object):
         db.cancel_transaction()
         self._load_all_internal()
         db.begin_transaction(False)
+        self._clear_cache()
+
+
+    def get_last_commit(self):
+        """Returns the SHA of the last commit of the database indexed by
+        this catalog, or None if it is not known.
+        """
+        return self._db.get_metadata('last_commit') or None
+
+
+    def set_last_commit(self, sha):
+        """Records the SHA of the last commit indexed (to be called before
+        'save_changes').
+        """
+        self._db.set_metadata('last_commit', sha)
+
+
+    def reopen(self):
+        """For read-only catalogs, see the last changes committed by the
+        writer.
+        """
+        db = self._db
+        revision = _get_revision(db)
+        db.reopen()
+        # The last commit does not change with group commits, compare the
+        # revisions (without them, always reload)
+        if revision is None or _get_revision(db) != revision:
+            self._load_all_internal()
+            self._clear_cache()
 
 
     #######################################################################
@@ -310,7 +662,64 @@ class Catalog(object):
     def index_document(self, document):
         """Add a new document.
         """
+        xdoc, metadata_modified = self._make_xdoc(document, TermGenerator())
+
+        # TODO: Don't store two documents with the same key field!
+
+        # Save the doc
         db = self._db
+        db.add_document(xdoc)
+        self._clear_cache()
+
+        # Store metadata ?
+        if metadata_modified:
+            db.set_metadata('metadata', dumps(self._metadata))
+
+
+    def index_documents(self, documents, batch_size=0):
+        """Add the given documents, this is the bulk version of
+        "index_document", meant for (re)indexing many documents at once.
+
+        The term generator is shared by all the documents, and the metadata
+        is written once at the end.
+
+        If "batch_size" is given, the changes are saved to disk every
+        "batch_size" documents, this bounds the memory used by Xapian but
+        it means the changes cannot be aborted afterwards.
+
+        Returns the number of documents indexed.
+        """
+        db = self._db
+        add_document = db.add_document
+        make_xdoc = self._make_xdoc
+        tg = TermGenerator()
+        self._clear_cache()
+
+        metadata_modified = False
+        n = 0
+        for document in documents:
+            xdoc, modified = make_xdoc(document, tg)
+            add_document(xdoc)
+            metadata_modified = metadata_modified or modified
+            n += 1
+            # Flush
+            if batch_size and n % batch_size == 0:
+                if metadata_modified:
+                    db.set_metadata('metadata', dumps(self._metadata))
+                    metadata_modified = False
+                self._flush()
+
+        # Store metadata ?
+        if metadata_modified:
+            db.set_metadata('metadata', dumps(self._metadata))
+
+        return n
+
+
+    def _make_xdoc(self, document, tg):
+        """Build and return the Xapian document for the given document (or
+        dict of values), and whether the metadata has been modified.
+        """
         metadata = self._metadata
         fields = self._fields
 
@@ -370,9 +779,9 @@ class Catalog(object):
                         if 'prefix' in lang_info:
                             # Comment: Index twice
                             _index(xdoc, field_cls, lang_value,
-                                   info['prefix'], language)
+                                   info['prefix'], language, tg)
                             _index(xdoc, field_cls, lang_value,
-                                   lang_info['prefix'], language)
+                                   lang_info['prefix'], language, tg)
             # The value can be None
             elif value is not None:
                 # Is stored ?
@@ -381,16 +790,10 @@ class Catalog(object):
                 # Is indexed ?
                 if 'prefix' in info:
                     # By default language='en'
-                    _index(xdoc, field_cls, value, info['prefix'], 'en')
-
-        # TODO: Don't store two documents with the same key field!
-
-        # Save the doc
-        db.add_document(xdoc)
+                    _index(xdoc, field_cls, value, info['prefix'], 'en',
+                           tg)
 
-        # Store metadata ?
-        if metadata_modified:
-            db.set_metadata('metadata', dumps(metadata))
+        return xdoc, metadata_modified
 
 
     def unindex_document(self, abspath):
@@ -399,6 +802,7 @@ class Catalog(object):
         """
         data = _reduce_size(_encode(self._fields['abspath'], abspath))
         self._db.delete_document('Q' + data)
+        self._clear_cache()
 
 
     #######################################################################
@@ -419,9 +823,78 @@ class Catalog(object):
         return set([ t.term[prefix_len:] for t in self._db.allterms(prefix) ])
 
 
+    def get_cache_stats(self):
+        """Returns the statistics of the query and results caches, a dict
+        with the number of hits and misses, and the size of every cache.
+        """
+        stats = self._cache_stats.copy()
+        for name in 'xquery', 'results':
+            cache = getattr(self, '_%s_cache' % name)
+            stats['%s_size' % name] = len(cache) if cache is not None else 0
+        return stats
+
+
     #######################################################################
     # API / Private
     #######################################################################
+    def _clear_cache(self):
+        if self._xquery_cache is not None:
+            self._xquery_cache.clear()
+        if self._results_cache is not None:
+            self._results_cache.clear()
+
+
+    def _get_cached_xquery(self, query, kw):
+        """Returns the Xapian query for the given itools query (or keyword
+        parameters), and the key used to cache it (None if the query cannot
+        be cached).
+        """
+        cache = self._xquery_cache
+        if cache is None:
+            return _get_xquery(self, query, **kw), None
+
+        key = _get_query_key(query, kw)
+        if key is None:
+            return _get_xquery(self, query, **kw), None
+
+        # Cache hit
+        stats = self._cache_stats
+        xquery = cache.get(key)
+        if xquery is not None:
+            cache.touch(key)
+            stats['xquery_hits'] += 1
+            return xquery, key
+
+        # Cache miss
+        stats['xquery_misses'] += 1
+        xquery = _get_xquery(self, query, **kw)
+        cache[key] = xquery
+        return xquery, key
+
+
+    def _get_cached_results(self, key):
+        cache = self._results_cache
+        if cache is None:
+            return None
+
+        key = (_get_revision(self._db), key)
+        stats = self._cache_stats
+        value = cache.get(key)
+        if value is None:
+            stats['results_misses'] += 1
+            return None
+
+        cache.touch(key)
+        stats['results_hits'] += 1
+        return value
+
+
+    def _set_cached_results(self, key, value):
+        cache = self._results_cache
+        if cache is not None:
+            cache[(_get_revision(self._db), key)] = value
+
+
     def _get_info(self, field_cls, name):
         # The key field ?
         if name == 'abspath':
@@ -443,6 +916,15 @@ class Catalog(object):
         return info
 
 
+    def _flush(self):
+        """Write the changes to disk, whatever the transaction mode.
+        """
+        if self._asynchronous:
+            self.save_changes()
+        else:
+            self._db.flush()
+
+
     def _load_all_internal(self):
         """Load the metadata from the database
         """
@@ -647,6 +1129,16 @@ def make_catalog(uri, fields):
 # Private API
 
 
+def _get_revision(db):
+    # Database.get_revision is new in Xapian 1.4, with older versions the
+    # results cache relies on '_clear_cache' only
+    get_revision = getattr(db, 'get_revision', None)
+    if get_revision is None:
+        return None
+    return get_revision()
+
+
+
 def _get_prefix(number):
     """By convention:
     Q is used for the unique Id of a document
@@ -775,7 +1267,7 @@ def _index_cjk(xdoc, value, prefix, termpos):
 
 
 
-def _index_unicode(xdoc, value, prefix, language, termpos,
+def _index_unicode(xdoc, value, prefix, language, termpos, tg=None,
                    TRANSLATE_MAP=TRANSLATE_MAP):
     # Check type
     if type(value) is not unicode:
@@ -787,7 +1279,8 @@ def _index_unicode(xdoc, value, prefix, language, termpos,
         return _index_cjk(xdoc, value, prefix, termpos)
 
     # Case 2: Any other language
-    tg = TermGenerator()
+    if tg is None:
+        tg = TermGenerator()
     tg.set_document(xdoc)
     tg.set_termpos(termpos - 1)
     # Suppress the accents (FIXME This should be done by the stemmer)
@@ -801,13 +1294,16 @@ def _index_unicode(xdoc, value, prefix, language, termpos,
 
 
 
-def _index(xdoc, field_cls, value, prefix, language):
+def _index(xdoc, field_cls, value, prefix, language, tg=None):
     """To index a field it must be split in a sequence of words and
     positions:
 
       [(word, 1), (word, 2), (word, 3), ...]
 
     Where <word> will be a <str> value.
+
+    The term generator "tg" is optional, it allows to reuse the same term
+    generator for many values.
     """
     is_multiple = (field_cls.multiple
                    and isinstance(value, (tuple, list, set, frozenset)))
@@ -817,9 +1313,10 @@ def _index(xdoc, field_cls, value, prefix, language):
         if is_multiple:
             termpos = 1
             for x in value:
-                termpos = _index_unicode(xdoc, x, prefix, language, termpos)
+                termpos = _index_unicode(xdoc, x, prefix, language, termpos,
+                                         tg)
         else:
-            _index_unicode(xdoc, value, prefix, language, 1)
+            _index_unicode(xdoc, value, prefix, language, 1, tg)
     # Case 2: multiple
     elif is_multiple:
         for position, data in enumerate(value):
@@ -854,6 +1351,63 @@ def _make_PhraseQuery(field_cls, value, prefix):
 
 
 
+def _get_value_key(value):
+    value_type = type(value)
+    if value_type is list or value_type is tuple:
+        return (tuple, tuple([ _get_value_key(x) for x in value ]))
+    if value_type is set or value_type is frozenset:
+        return (frozenset, frozenset([ _get_value_key(x) for x in value ]))
+    if value_type is dict:
+        return (dict, frozenset([ (k, _get_value_key(v))
+                                  for k, v in value.iteritems() ]))
+    return (value_type, value)
+
+
+
+def _get_query_tree_key(query):
+    query_class = type(query)
+    if query_class is AllQuery:
+        return (AllQuery,)
+
+    if isinstance(query, _MultipleQuery):
+        atoms = frozenset([ _get_query_tree_key(x) for x in query.atoms ])
+        if len(atoms) == 1:
+            return iter(atoms).next()
+        return (query_class, atoms)
+
+    if query_class is NotQuery:
+        return (NotQuery, _get_query_tree_key(query.query))
+
+    if query_class is RangeQuery:
+        return (RangeQuery, query.name, _get_value_key(query.left),
+                _get_value_key(query.right))
+
+    if query_class in (PhraseQuery, StartQuery, TextQuery):
+        return (query_class, query.name, _get_value_key(query.value))
+
+    raise TypeError, 'unexpected query "%s"' % query_class
+
+
+
+def _get_query_key(query, kw):
+    """Returns a normalized and hashable version of the given itools query
+    (or keyword parameters), or None if it cannot be done.  Two queries
+    with the same key are equivalent.
+    """
+    try:
+        if query is not None:
+            key = _get_query_tree_key(query)
+        else:
+            key = frozenset([ (name, _get_value_key(value))
+                              for name, value in kw.iteritems() ])
+        hash(key)
+    except TypeError:
+        return None
+
+    return key
+
+
+
 def _get_xquery(catalog, query=None, **kw):
     # Case 1: a query is given
     if query is not None:
@@ -15,18 +15,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from anydbm import open as dbm_open, error as dbm_error
 from datetime import datetime
-from os import listdir, makedirs, remove, rmdir, walk
-from os.path import abspath, dirname, exists, getmtime, isabs, isdir, isfile
-from os.path import normpath
+from difflib import unified_diff
+from os import close, fsync, listdir, makedirs, O_RDONLY, open as os_open
+from os import remove, rmdir, walk
+from os.path import abspath, dirname, exists, getmtime, getsize, isabs
+from os.path import isdir, isfile, normpath
 from re import search
 from shutil import copy2, copytree
+from struct import unpack
 from subprocess import Popen, PIPE
 import time
 
 # Import from pygit2
 from pygit2 import Repository, Signature, GitError, init_repository
-from pygit2 import GIT_SORT_REVERSE, GIT_SORT_TIME, GIT_OBJ_TREE
+from pygit2 import GIT_SORT_TIME, GIT_OBJ_TREE
 from pygit2 import GIT_STATUS_WT_MODIFIED, GIT_STATUS_WT_DELETED
 
 # Import from itools
@@ -48,6 +52,23 @@ def message_short(commit):
     return message.rstrip()
 
 
+def dbm_get(db, key, default=None):
+    """Not all the dbm implementations have the 'get' method.
+    """
+    try:
+        return db[key]
+    except KeyError:
+        return default
+
+
+def _fsync_path(path):
+    fd = os_open(path, O_RDONLY)
+    try:
+        fsync(fd)
+    finally:
+        close(fd)
+
+
 def make_parent_dirs(path):
     folder = dirname(path)
     if not exists(folder):
@@ -227,6 +248,57 @@ class Worktree(object):
         self._call(command)
 
 
+    def count_objects(self):
+        """Equivalent to 'git count-objects -v', returns a dict with:
+
+          count     -- the number of loose objects
+          size      -- the disk space used by the loose objects (bytes)
+          packs     -- the number of packs
+          in_pack   -- the number of objects in the packs
+          size_pack -- the disk space used by the packs (bytes)
+        """
+        objects = '%s.git/objects' % self.path
+        stats = {'count': 0, 'size': 0, 'packs': 0, 'in_pack': 0,
+                 'size_pack': 0}
+
+        # The files may be removed by 'git repack' or 'git prune' while we
+        # count them
+        for folder in listdir(objects):
+            if len(folder) != 2:
+                continue
+            folder = '%s/%s' % (objects, folder)
+            for name in listdir(folder):
+                try:
+                    size = getsize('%s/%s' % (folder, name))
+                except OSError:
+                    continue
+                stats['count'] += 1
+                stats['size'] += size
+
+        folder = '%s/pack' % objects
+        if not exists(folder):
+            return stats
+        for name in listdir(folder):
+            path = '%s/%s' % (folder, name)
+            try:
+                if name.endswith('.pack'):
+                    stats['size_pack'] += getsize(path)
+                    stats['packs'] += 1
+                elif name.endswith('.idx'):
+                    stats['size_pack'] += getsize(path)
+                    # The last entry of the fan-out table is the number of
+                    # objects (version 2 has an 8 bytes header)
+                    with open(path, 'rb') as file:
+                        header = file.read(8)
+                        offset = 8 if header[:4] == '\377tOc' else 0
+                        file.seek(offset + 255 * 4)
+                        stats['in_pack'] += unpack('>I', file.read(4))[0]
+            except (IOError, OSError):
+                continue
+
+        return stats
+
+
     def git_add(self, *args):
         """Equivalent 'git add', adds the given paths to the index file.
         If a path is a folder, adds all its content recursively.
@@ -238,6 +310,23 @@ class Worktree(object):
                     index.add(path)
 
 
+    def sync_objects(self, shas):
+        """Writes to disk the given loose objects, and the folders they are
+        in.  The objects already packed are skipped.
+        """
+        objects = '%s.git/objects' % self.path
+        folders = set()
+        for sha in shas:
+            path = '%s/%s/%s' % (objects, sha[:2], sha[2:])
+            if exists(path):
+                _fsync_path(path)
+                folders.add(dirname(path))
+        if folders:
+            folders.add(objects)
+            for folder in folders:
+                _fsync_path(folder)
+
+
     def git_rm(self, *args):
         """Equivalent to 'git rm', removes the given paths from the index
         file and from the filesystem. If a path is a folder removes all
@@ -305,14 +394,18 @@ class Worktree(object):
 
     @lazy
     def username(self):
-        cmd = ['git', 'config', '--get', 'user.name']
-        return self._call(cmd).rstrip()
+        try:
+            return self.repo.config['user.name']
+        except KeyError:
+            return None
 
 
     @lazy
     def useremail(self):
-        cmd = ['git', 'config', '--get', 'user.email']
-        return self._call(cmd).rstrip()
+        try:
+            return self.repo.config['user.email']
+        except KeyError:
+            return None
 
 
     def git_commit(self, message, author=None, date=None):
@@ -361,8 +454,19 @@ class Worktree(object):
         author = Signature(author[0], author[1], when_time, when_offset)
 
         # Create the commit
-        return self.repo.create_commit('HEAD', author, committer, message,
-                                       tree, parents)
+        repo = self.repo
+        commit = repo.create_commit('HEAD', author, committer, message, tree,
+                                    parents)
+
+        # Keep the index of the history up-to-date, if it is
+        history = self.history
+        if history is not None:
+            last = dbm_get(history, '/')
+            if last == (repo[parent].hex if parent else None):
+                self._index_commit(history, repo[commit])
+                self._sync_history()
+
+        return commit
 
 
     def git_log(self, paths=None, n=None, author=None, grep=None,
@@ -377,18 +481,26 @@ class Worktree(object):
           grep    -- filter out commits whose message does not match the
                      given pattern
           reverse -- return results in reverse order
+
+        If paths are given, the history of the files is taken from the index
+        of the history (see 'update_history') when possible.
         """
         # Get the sha
         sha = self._resolve_reference(reference)
 
-        # Sort
-        sort = GIT_SORT_TIME
-        if reverse is True:
-            sort |= GIT_SORT_REVERSE
+        # The commits to consider, from the index of the history or else
+        # from walking all the history
+        commits = None
+        if paths and reference == 'HEAD':
+            commits = self._get_history(paths)
+        check_paths = False
+        if commits is None:
+            commits = self.repo.walk(sha, GIT_SORT_TIME)
+            check_paths = bool(paths)
 
         # Go
-        commits = []
-        for commit in self.repo.walk(sha, GIT_SORT_TIME):
+        results = []
+        for commit in commits:
             # --author=<pattern>
             if author:
                 commit_author = commit.author
@@ -402,7 +514,7 @@ class Worktree(object):
                     continue
 
             # -- path ...
-            if paths:
+            if check_paths:
                 parents = commit.parents
                 parent = parents[0] if parents else None
                 for path in paths:
@@ -418,7 +530,7 @@ class Worktree(object):
                     continue
 
             ts = commit.commit_time
-            commits.append(
+            results.append(
                 {'sha': commit.hex,
                  'author_name': commit.author.name,
                  'author_date': datetime.fromtimestamp(ts),
@@ -429,7 +541,9 @@ class Worktree(object):
                     break
 
         # Ok
-        return commits
+        if reverse is True:
+            results.reverse()
+        return results
 
 
     def git_reset(self):
@@ -458,52 +572,370 @@ class Worktree(object):
                     f.write(data)
 
 
-    def git_diff(self, since, until=None, paths=None):
-        """Return the diff between two commits, eventually reduced to the
-        given paths.
+    def _get_data(self, tree, path):
+        """Returns the content of the file at the given path from the given
+        tree, or None if there is not such file.  Unlike the method
+        'lookup_from_commit_by_path' the objects are not kept in the cache.
+        """
+        repo = self.repo
+        obj = tree
+        for name in path.split('/'):
+            if obj is None or obj.type != GIT_OBJ_TREE or name not in obj:
+                return None
+            obj = repo[obj[name].oid]
 
-        TODO Implement using Python's difflib standard library, to avoid
-        calling Git.
+        if obj.type == GIT_OBJ_TREE:
+            return None
+        return obj.data
+
+
+    def _get_changes(self, since, until, paths):
+        """Returns the sorted list of changes between the two given commits,
+        eventually reduced to the given paths.  Every change is a tuple with
+        three values: the path, the old data and the new data (None if the
+        file did not exist).
+
+        If 'until' is None, returns the changes done by the 'since' commit.
         """
+        repo = self.repo
         if until is None:
-            data = self._call(['git', 'show', since, '--pretty=format:'])
-            return data[1:]
+            b = repo[self._resolve_reference(since)]
+            parents = b.parents
+            a = parents[0].tree if parents else None
+            b = b.tree
+        else:
+            a = repo[self._resolve_reference(since)].tree
+            b = repo[self._resolve_reference(until)].tree
 
-        cmd = ['git', 'diff', '%s..%s' % (since, until)]
+        # The files that differ
+        changes = []
+        self._diff_trees(a, b, '', changes)
+        changes.sort()
         if paths:
-            cmd.append('--')
-            cmd.extend(paths)
-        return self._call(cmd)
+            changes = [
+                x for x in changes
+                if [ y for y in paths if x == y or x.startswith(y + '/') ] ]
+
+        # Load the data
+        get_data = self._get_data
+        for i, path in enumerate(changes):
+            changes[i] = (path, get_data(a, path), get_data(b, path))
+
+        return changes
+
+
+    def _diff_blobs(self, path, old, new):
+        """Returns the unified diff of the given file (as a list of lines),
+        or None if it is a binary file.
+        """
+        if (old and '\0' in old) or (new and '\0' in new):
+            return None
+
+        a = 'a/%s' % path if old is not None else '/dev/null'
+        b = 'b/%s' % path if new is not None else '/dev/null'
+        old = old.splitlines(True) if old else []
+        new = new.splitlines(True) if new else []
+        return list(unified_diff(old, new, a, b))
+
+
+    def git_diff(self, since, until=None, paths=None):
+        """Return the diff between two commits, eventually reduced to the
+        given paths.  If 'until' is not given returns the diff of the
+        'since' commit.
+
+        The diff is computed with Python's difflib, the output is like the
+        one of 'git diff' without the index lines.
+        """
+        lines = []
+        for path, old, new in self._get_changes(since, until, paths):
+            lines.append('diff --git a/%s b/%s\n' % (path, path))
+            diff = self._diff_blobs(path, old, new)
+            if diff is None:
+                lines.append('Binary files differ\n')
+            else:
+                lines.extend(diff)
+
+        # Lines without end of line (at the end of the file)
+        return ''.join([ x if x[-1] == '\n' else x + '\n' for x in lines ])
+
+
+    def get_numstat(self, since, until=None, paths=None):
+        """Equivalent to 'git diff --numstat': returns a list with a tuple
+        for every file changed between two commits (or by the 'since' commit
+        if 'until' is not given).  The tuples have three values: the path,
+        the number of lines added and the number of lines removed.  For
+        binary files both numbers are None.
+        """
+        stats = []
+        for path, old, new in self._get_changes(since, until, paths):
+            diff = self._diff_blobs(path, old, new)
+            if diff is None:
+                stats.append((path, None, None))
+                continue
+
+            added = removed = 0
+            for line in diff[2:]:
+                if line[0] == '+':
+                    added += 1
+                elif line[0] == '-':
+                    removed += 1
+            stats.append((path, added, removed))
+
+        return stats
 
 
     def git_stats(self, since, until=None, paths=None):
         """Return statistics of the changes done between two commits,
-        eventually reduced to the given paths.
-
-        TODO Implement using libgit2
+        eventually reduced to the given paths.  The output is git-like: it
+        has the layout of 'git diff --stat', but the scaling of the bars and
+        the summary line are not identical to those of git.
         """
-        if until is None:
-            cmd = ['git', 'show', '--pretty=format:', '--stat', since]
-            data = self._call(cmd)
-            return data[1:]
+        stats = self.get_numstat(since, until, paths)
+        if not stats:
+            return ''
+
+        width = max([ len(x[0]) for x in stats ])
+        lines = []
+        total_added = total_removed = 0
+        for path, added, removed in stats:
+            if added is None:
+                lines.append(' %s | Bin\n' % path.ljust(width))
+                continue
+            total_added += added
+            total_removed += removed
+            # The bar is at most 50 characters long
+            n = added + removed
+            if n > 50:
+                added = added * 50 / n
+                removed = removed * 50 / n
+            lines.append(' %s | %d %s%s\n' % (path.ljust(width), n,
+                         '+' * added, '-' * removed))
 
-        cmd = ['git', 'diff', '--stat', '%s..%s' % (since, until)]
-        if paths:
-            cmd.append('--')
-            cmd.extend(paths)
-        return self._call(cmd)
+        lines.append(' %d files changed, %d insertions(+), %d deletions(-)\n'
+                     % (len(stats), total_added, total_removed))
+        return ''.join(lines)
 
 
     def get_files_changed(self, since, until):
         """Return the files that have been changed between two commits.
+        """
+        return frozenset(self.get_tree_changes(since, until))
+
+
+    def _diff_trees(self, a, b, base, changes):
+        """Compares the trees 'a' and 'b' (any of them may be None), and
+        appends to 'changes' the path of every file that differs. Only the
+        sub-trees that differ are traversed.
+        """
+        repo = self.repo
+        a = dict([ (x.name, x.oid) for x in a ]) if a is not None else {}
+        b = dict([ (x.name, x.oid) for x in b ]) if b is not None else {}
+        for name in set(a) | set(b):
+            a_oid = a.get(name)
+            b_oid = b.get(name)
+            if a_oid == b_oid:
+                continue
+
+            # Sub-trees
+            a_obj = repo[a_oid] if a_oid is not None else None
+            b_obj = repo[b_oid] if b_oid is not None else None
+            a_tree = b_tree = None
+            if a_obj is not None and a_obj.type == GIT_OBJ_TREE:
+                a_tree, a_obj = a_obj, None
+            if b_obj is not None and b_obj.type == GIT_OBJ_TREE:
+                b_tree, b_obj = b_obj, None
+            path = '%s%s' % (base, name)
+            if a_tree is not None or b_tree is not None:
+                self._diff_trees(a_tree, b_tree, '%s/' % path, changes)
+
+            # Files
+            if a_obj is not None or b_obj is not None:
+                changes.append(path)
+
+
+    def get_tree_changes(self, since, until='HEAD'):
+        """Returns the sorted list of the files that differ between the
+        trees of the two given commits.  This is done in-process with
+        libgit2.
+        """
+        since = self.repo[self._resolve_reference(since)]
+        until = self.repo[self._resolve_reference(until)]
+        changes = []
+        self._diff_trees(since.tree, until.tree, '', changes)
+        changes.sort()
+        return changes
+
+
+    #######################################################################
+    # Index of the history
+    #######################################################################
+    # The index is written by one process only, the writer (see RWDatabase),
+    # the other processes open it read-only
+    history_writer = False
+    # The commits not yet indexed, from the oldest to the newest (see
+    # 'update_history')
+    history_pending = None
+
+
+    @lazy
+    def history(self):
+        """The index of the history of the files, it maps every file path to
+        the SHAs of the commits that changed it (concatenated, from the
+        oldest to the newest).  The key '/' holds the last commit indexed.
+
+        This is the writer's handle, it is None for the other processes, or
+        if the index cannot be opened.
+        """
+        if not self.history_writer:
+            return None
+
+        try:
+            return dbm_open('%s.git/history' % self.path, 'c')
+        except dbm_error:
+            return None
 
-        TODO Implement with libgit2
+
+    def _open_history(self):
+        """Returns the index of the history to read from: the writer's
+        handle, or else a read-only handle to be closed by the caller.
+        Returns None if the index is not available.
+        """
+        if self.history_writer:
+            return self.history
+
+        try:
+            return dbm_open('%s.git/history' % self.path, 'r')
+        except dbm_error:
+            return None
+
+
+    def _sync_history(self):
+        history = self.history
+        if hasattr(history, 'sync'):
+            history.sync()
+
+
+    def _index_commit(self, history, commit):
+        sha = commit.hex
+        parents = commit.parents
+        changes = []
+        self._diff_trees(parents[0].tree if parents else None, commit.tree,
+                         '', changes)
+        for path in changes:
+            value = dbm_get(history, path, '')
+            # The commit may be already there, if the last update was
+            # interrupted
+            if value[-40:] != sha:
+                history[path] = value + sha
+        history['/'] = sha
+
+
+    def update_history(self, n=None):
+        """Updates the index of the history of the files with the commits
+        done since the last update (or since the beginning the first time),
+        at most 'n' of them (the oldest) if given.  Returns the number of
+        commits indexed.  Only the writer updates the index.
+
+        The history is walked once, the commits not yet indexed are kept
+        for the next calls, so building the index 'n' commits at a time
+        costs about the same as building it at once.
+
+        The commits done with 'git_commit' are indexed on the fly, so this
+        is only needed when the index is created, and when the repository
+        has been changed by other means.  It is meant to be called by the
+        maintenance (see Maintenance.index_history), not within a request.
+        """
+        history = self.history
+        head = self._resolve_reference('HEAD')
+        if history is None or head is None:
+            return 0
+
+        pending = self.history_pending
+        if not pending:
+            pending = self.history_pending = self._get_history_pending()
+        if n is None:
+            n = len(pending)
+
+        # Index
+        repo = self.repo
+        history = self.history
+        shas = pending[:n]
+        del pending[:n]
+        for sha in shas:
+            self._index_commit(history, repo[sha])
+        self._sync_history()
+        return len(shas)
+
+
+    def _get_history_pending(self):
+        """Returns the commits not yet indexed, from the oldest to the
+        newest.  If the last commit indexed is not found, the history has
+        been rewritten: the index is emptied, to start again.
         """
-        expr = '%s..%s' % (since, until)
-        cmd = ['git', 'show', '--numstat', '--pretty=format:', expr]
-        data = self._call(cmd)
-        lines = data.splitlines()
-        return frozenset([ line.split('\t')[-1] for line in lines if line ])
+        history = self.history
+        head = self._resolve_reference('HEAD')
+        last = dbm_get(history, '/')
+        if last == self.repo[head].hex:
+            return []
+
+        shas = []
+        for commit in self.repo.walk(head, GIT_SORT_TIME):
+            sha = commit.hex
+            if sha == last:
+                break
+            shas.append(sha)
+        else:
+            if last is not None:
+                history.close()
+                path = '%s.git/history' % self.path
+                self.history = dbm_open(path, 'n')
+
+        shas.reverse()
+        return shas
+
+
+    def _get_history(self, paths):
+        """Returns the commits that changed the given files, from the newest
+        to the oldest, using the index of the history.  Returns None if the
+        index cannot be used (not available, not up-to-date, or some path is
+        a folder).
+        """
+        # Folders are not indexed
+        head = self._resolve_reference('HEAD')
+        if head is None:
+            return []
+        head = self.repo[head]
+        for path in paths:
+            obj = self.lookup_from_commit_by_path(head, path)
+            if obj is not None and obj.type == GIT_OBJ_TREE:
+                return None
+
+        history = self._open_history()
+        if history is None:
+            return None
+        try:
+            # The index is not up-to-date, it is not updated here (this
+            # may take long, and only the writer is allowed to)
+            if dbm_get(history, '/') != head.hex:
+                return None
+            shas = []
+            for path in paths:
+                value = dbm_get(history, path, '')
+                shas.extend([ value[i:i+40]
+                              for i in range(0, len(value), 40) ])
+        finally:
+            if history is not self.history:
+                history.close()
+
+        # One file: the commits are already sorted, load them lazily
+        repo = self.repo
+        if len(paths) == 1:
+            return ( repo[x] for x in reversed(shas) )
+
+        # Several files
+        commits = [ repo[x] for x in set(shas) ]
+        commits.sort(key=lambda x: x.commit_time, reverse=True)
+        return commits
 
 
     def get_metadata(self, reference='HEAD'):
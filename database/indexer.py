@@ -0,0 +1,230 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the asynchronous indexing of the catalog.
+
+Instead of updating the catalog within the transaction, the documents to
+(un)index are written to a persistent queue, a folder with one file per
+commit.  A background process, the only one allowed to write to the
+catalog, consumes the queue in order.  The items that cannot be indexed are
+moved aside, to the "failed" folder of the queue; from then on the last
+commit indexed is not updated, so the next 'catch_up' (or a reindex) indexes
+their documents again.
+"""
+
+# Import from the Standard Library
+from cPickle import dump, load, HIGHEST_PROTOCOL
+from multiprocessing import Event, Process
+from os import fsync, getppid, listdir, makedirs, remove, rename
+from os.path import exists
+from time import sleep, time
+
+# Import from itools
+from itools.log import log_error
+from catalog import Catalog
+from registry import get_register_fields
+
+
+
+class IndexQueue(object):
+    """The persistent queue of documents to (un)index, every item is a
+    file named after its sequence number.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not exists(path):
+            makedirs(path)
+        seqs = self.get_seqs()
+        self.last_seq = seqs[-1] if seqs else 0
+
+
+    def get_seqs(self):
+        """Returns the sequence numbers of the items in the queue, in
+        order.
+        """
+        seqs = [ int(x) for x in listdir(self.path) if x.isdigit() ]
+        seqs.sort()
+        return seqs
+
+
+    def push(self, commit, docs_to_unindex, docs_to_index):
+        """Adds a new item to the queue, and returns its sequence number.
+        The item is written to disk before this method returns.
+        """
+        self.last_seq += 1
+        seq = self.last_seq
+        path = '%s/%020d' % (self.path, seq)
+        tmp_path = '%s/.%020d' % (self.path, seq)
+        with open(tmp_path, 'wb') as file:
+            dump((commit, docs_to_unindex, docs_to_index), file,
+                 HIGHEST_PROTOCOL)
+            file.flush()
+            fsync(file.fileno())
+        rename(tmp_path, path)
+        return seq
+
+
+    def load(self, seq):
+        with open('%s/%020d' % (self.path, seq), 'rb') as file:
+            return load(file)
+
+
+    def remove(self, seq):
+        remove('%s/%020d' % (self.path, seq))
+
+
+    def discard(self, seq):
+        """Moves the item with the given sequence number out of the queue,
+        to the "failed" folder, where it can be examined.
+        """
+        failed = '%s/failed' % self.path
+        if not exists(failed):
+            makedirs(failed)
+        rename('%s/%020d' % (self.path, seq), '%s/%020d' % (failed, seq))
+
+
+    def get_failed(self):
+        """Returns the sequence numbers of the items moved aside, in order.
+        """
+        failed = '%s/failed' % self.path
+        if not exists(failed):
+            return []
+        seqs = [ int(x) for x in listdir(failed) if x.isdigit() ]
+        seqs.sort()
+        return seqs
+
+
+    def clear_failed(self):
+        """Removes the items moved aside, once their documents have been
+        indexed again.
+        """
+        failed = '%s/failed' % self.path
+        for seq in self.get_failed():
+            remove('%s/%020d' % (failed, seq))
+
+
+    def is_done(self, seq):
+        """Returns whether the item with the given sequence number, and all
+        the items before it, have been consumed.
+        """
+        seqs = self.get_seqs()
+        return not seqs or seqs[0] > seq
+
+
+
+def index_items(catalog, queue, failures, failures_max=3):
+    """Consumes the items in the queue, in order.  When an item fails, the
+    next call will try it again; after 'failures_max' failures it is moved
+    aside (see 'IndexQueue.discard') and the next items are consumed.  The
+    number of failures by item is kept in the given dict.
+
+    While there are items moved aside the last commit indexed is not
+    updated, so the catalog is not taken for up-to-date.
+    """
+    failed = bool(queue.get_failed())
+    for seq in queue.get_seqs():
+        try:
+            commit, docs_to_unindex, docs_to_index = queue.load(seq)
+            for abspath in docs_to_unindex:
+                catalog.unindex_document(abspath)
+            # Unindex first, the item may have been half applied
+            for values in docs_to_index:
+                catalog.unindex_document(values['abspath'])
+            catalog.index_documents(docs_to_index)
+            # With group commits, the transaction may not be committed
+            if commit is not None and not failed:
+                catalog.set_last_commit(commit)
+            catalog.save_changes()
+        except Exception:
+            catalog.abort_changes()
+            n = failures.get(seq, 0) + 1
+            if n < failures_max:
+                log_error('Indexing failed (item %d)' % seq,
+                          domain='itools.database')
+                failures[seq] = n
+                return
+            log_error('Indexing failed (item %d), moved aside, the catalog '
+                      'will not be up-to-date until "catch_up" is run' % seq,
+                      domain='itools.database')
+            failures.pop(seq, None)
+            queue.discard(seq)
+            failed = True
+        else:
+            failures.pop(seq, None)
+            queue.remove(seq)
+
+
+
+def index_worker(path, queue_path, event, interval=1):
+    """The background process: consumes the queue of the database at the
+    given path, until the parent process dies.  It is woken up by the given
+    event, or every 'interval' seconds.
+    """
+    catalog = Catalog('%s/catalog' % path, get_register_fields())
+    queue = IndexQueue(queue_path)
+    failures = {}
+    parent = getppid()
+    while getppid() == parent:
+        index_items(catalog, queue, failures)
+        event.wait(interval)
+        event.clear()
+
+
+
+class Indexer(object):
+    """The interface to the queue and the background process, used by the
+    database.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = IndexQueue('%s/catalog.queue' % path)
+        self.event = Event()
+        self.process = None
+
+
+    def start(self):
+        process = Process(target=index_worker,
+                          args=(self.path, self.queue.path, self.event))
+        process.daemon = True
+        process.start()
+        self.process = process
+
+
+    def push(self, commit, docs_to_unindex, docs_to_index):
+        seq = self.queue.push(commit, docs_to_unindex, docs_to_index)
+        self.event.set()
+        return seq
+
+
+    def wait(self, seq=None, timeout=None):
+        """Waits until the item with the given sequence number (by default
+        the last one) has been indexed.  Returns False if the timeout (in
+        seconds) expires before, True otherwise.
+        """
+        queue = self.queue
+        if seq is None:
+            seq = queue.last_seq
+
+        if timeout is not None:
+            timeout = time() + timeout
+        while not queue.is_done(seq):
+            if timeout is not None and time() > timeout:
+                return False
+            sleep(0.01)
+        return True
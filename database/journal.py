@@ -0,0 +1,81 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the journal of the group commits.
+
+With group commits the transactions are not committed to git one by one.
+Instead every transaction is recorded in the journal, an append-only file,
+and from time to time all the transactions recorded are committed at once.
+"""
+
+# Import from the Standard Library
+from cPickle import dump, load, HIGHEST_PROTOCOL, UnpicklingError
+from os import fsync
+from os.path import exists
+
+
+
+class Journal(object):
+    """Every record of the journal is a dict with the keys:
+
+      author  -- the author of the transaction, a tuple (name, email) or None
+      date    -- the date of the transaction, a datetime or None
+      message -- the message of the transaction
+      add     -- the files added or changed, a list of tuples (path, sha)
+                 with the SHA of the blob
+      rm      -- the files and folders removed, a list of paths
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def append(self, record):
+        """Adds the given record to the journal, it is written to disk before
+        this method returns.
+        """
+        with open(self.path, 'ab') as file:
+            dump(record, file, HIGHEST_PROTOCOL)
+            file.flush()
+            fsync(file.fileno())
+
+
+    def load(self):
+        """Returns the list of records in the journal.
+        """
+        if not exists(self.path):
+            return []
+
+        records = []
+        with open(self.path, 'rb') as file:
+            while True:
+                try:
+                    records.append(load(file))
+                except EOFError:
+                    break
+                except (UnpicklingError, ValueError, IndexError):
+                    # The last record was not written completely, the
+                    # transaction was not finished
+                    break
+
+        return records
+
+
+    def clear(self):
+        with open(self.path, 'wb') as file:
+            file.flush()
+            fsync(file.fileno())
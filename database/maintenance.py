@@ -0,0 +1,214 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the periodic maintenance of the git repository of a
+database: refresh of the tree cache, incremental repack, and prune of the
+unreachable objects.  And the update of the index of the history, and the
+prune of the old entries of the parsed cache.
+
+The git commands are run in the background, one after the other, while the
+server goes on.  This is safe: git never removes a loose object it has not
+packed, and the prune keeps the unreachable objects newer than
+'prune_expire' (the blobs of the transactions in flight).  The tree cache is
+written to a copy of the index, which replaces the index only if it has not
+changed meanwhile.
+"""
+
+# Import from the Standard Library
+from os import devnull, environ, remove, rename
+from os.path import exists, getmtime
+from shutil import copyfile
+from subprocess import Popen, PIPE
+from time import sleep
+
+# Import from itools
+from itools.log import log_error, log_info
+
+
+
+class Maintenance(object):
+    """The maintenance of the repository of a RWDatabase.  Usage, with the
+    main loop:
+
+      maintenance = Maintenance(database)
+      cron(maintenance.run, timedelta(minutes=10))
+
+    Or from a script, 'maintenance.run()' followed by 'maintenance.wait()'.
+    """
+
+    def __init__(self, database, loose_max=5000, packs_max=50,
+                 prune_expire='2.weeks.ago', parsed_max_age=2592000):
+        self.database = database
+        # Repack when there are 'loose_max' loose objects or more; and
+        # repack everything in a single pack with 'packs_max' packs or more
+        self.loose_max = loose_max
+        self.packs_max = packs_max
+        self.prune_expire = prune_expire
+        # The commands to run, tuples (command, environment, callback); and
+        # the one running (the callback is called once it is done)
+        self.commands = []
+        self.process = None
+        self.callback = None
+        # The last object stats
+        self.stats = None
+        # Remove the entries of the parsed cache older than 'parsed_max_age'
+        # seconds (30 days by default), a few folders at a time
+        self.parsed_max_age = parsed_max_age
+        self.parsed_folders = []
+
+
+    def get_stats(self):
+        """Returns the number and size of the objects of the repository,
+        see 'Worktree.count_objects'.
+        """
+        self.stats = self.database.worktree.count_objects()
+        return self.stats
+
+
+    def update_tree_cache(self):
+        """Adds 'git write-tree' to the commands to run, to refresh the tree
+        cache, unless there are changes in the index not yet written, from
+        a transaction in flight or from group commits.  Returns True if the
+        command has been added, False otherwise.
+        """
+        if not self._index_is_clean():
+            return False
+
+        # Work on a copy of the index
+        index_path = self.database.worktree.index_path
+        tmp_path = '%s.maintenance' % index_path
+        copyfile(index_path, tmp_path)
+        self.index_mtime = getmtime(index_path)
+        env = dict(environ, GIT_INDEX_FILE=tmp_path)
+        command = (['git', 'write-tree'], env, self._replace_index)
+        self.commands.append(command)
+        return True
+
+
+    def _index_is_clean(self):
+        database = self.database
+        return not database.has_changed and not database.group_count
+
+
+    def _replace_index(self):
+        index_path = self.database.worktree.index_path
+        tmp_path = '%s.maintenance' % index_path
+        if not exists(tmp_path):
+            return
+        # The index has changed meanwhile: too late
+        if not self._index_is_clean() or \
+           getmtime(index_path) != self.index_mtime:
+            remove(tmp_path)
+            return
+        # The worktree will load it again (the mtime changes)
+        rename(tmp_path, index_path)
+
+
+    def index_history(self, n=100):
+        """Adds to the index of the history the next 'n' commits not yet
+        indexed, to build the index the first time (later the commits are
+        indexed as they are done).  Returns the number of commits indexed.
+        """
+        return self.database.worktree.update_history(n)
+
+
+    def prune_parsed(self, n=16):
+        """Prunes the next 'n' folders of the parsed cache, if the database
+        has one (see 'ParsedCache.prune').  Returns the number of entries
+        removed.
+        """
+        parsed = self.database.parsed
+        if parsed is None:
+            return 0
+
+        folders = self.parsed_folders
+        if not folders:
+            folders.extend(parsed.get_folders())
+        todo = folders[:n]
+        del folders[:n]
+        return parsed.prune(self.parsed_max_age, todo)
+
+
+    def is_running(self):
+        """Returns True if a command is running in the background, or waits
+        to be run.
+        """
+        process = self.process
+        if process is not None:
+            if process.poll() is None:
+                return True
+            # Done
+            if process.returncode != 0:
+                error = process.stderr.read()
+                log_error('git maintenance failed: %s' % error,
+                          domain='itools.database')
+                # Do not go on
+                del self.commands[:]
+            elif self.callback is not None:
+                self.callback()
+            self.process = None
+            self.callback = None
+
+        return len(self.commands) > 0
+
+
+    def _start_next(self):
+        command, env, callback = self.commands.pop(0)
+        log_info(' '.join(command), domain='itools.database')
+        self.process = Popen(command, cwd=self.database.worktree.path,
+                             env=env, stdout=open(devnull, 'w'), stderr=PIPE)
+        self.callback = callback
+
+
+    def run(self):
+        """Runs a step of the maintenance, never blocks for long.  This is
+        the callback for 'itools.loop.cron', it always returns True.
+        """
+        self.index_history()
+        self.prune_parsed()
+
+        # A round is going on
+        if self.is_running():
+            if self.process is None:
+                self._start_next()
+            return True
+
+        # A new round
+        self.update_tree_cache()
+        stats = self.get_stats()
+        if stats['count'] >= self.loose_max:
+            if stats['packs'] >= self.packs_max:
+                repack = ['git', 'repack', '-a', '-d', '-q']
+            else:
+                repack = ['git', 'repack', '-d', '-q']
+            prune = ['git', 'prune', '--expire=%s' % self.prune_expire]
+            self.commands.append((repack, None, None))
+            self.commands.append((prune, None, None))
+        if self.commands:
+            self._start_next()
+
+        return True
+
+
+    def wait(self, interval=0.1):
+        """Runs the commands of the current round until they are all done,
+        to be used by scripts.
+        """
+        while self.is_running():
+            if self.process is None:
+                self._start_next()
+            sleep(interval)
@@ -15,6 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from datetime import datetime
+from hashlib import sha1
+from os import stat
+
 # Import from itools
 from itools.core import add_type, freeze
 from itools.csv import parse_table, Property, property_to_str
@@ -53,6 +58,35 @@ class Metadata(File):
         self.version = version or cls.class_version
 
 
+    def load_state(self):
+        # Load from the parsed cache of the database, if any and if it is
+        # still valid.  The text file remains the reference.
+        database = self.database
+        parsed = database.parsed
+        if parsed is None:
+            super(Metadata, self).load_state()
+            return
+
+        # The cache key changes whenever the file changes
+        key = self.key
+        info = stat(database.fs._resolve_path(key))
+        mtime = datetime.fromtimestamp(info.st_mtime)
+        parsed_key = '%s:%s:%s' % (key, info.st_mtime, info.st_size)
+        parsed_key = sha1(parsed_key).hexdigest()
+
+        self.reset()
+        if parsed.load(parsed_key, self):
+            self.timestamp = mtime
+            self.dirty = None
+            self.set_footprint(info.st_size)
+            return
+
+        # Cache miss
+        super(Metadata, self).load_state()
+        if self.timestamp == mtime:
+            parsed.save(parsed_key, self)
+
+
     def _load_state_from_file(self, file):
         properties = self.properties
         data = file.read()
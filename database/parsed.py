@@ -0,0 +1,152 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from cPickle import dump, load, HIGHEST_PROTOCOL, PicklingError
+from os import getpid, listdir, makedirs, remove, rename
+from os.path import exists, getmtime
+from time import time
+
+# Import from itools
+from itools.log import log_warning
+
+
+
+class ParsedCache(object):
+    """An on-disk cache of the state of parsed handlers, to load them
+    without parsing their file again.  Every entry is a file, named after a
+    key that must change whenever the source file changes (typically the
+    SHA of the git blob).
+
+    The cache can be shared by several processes.  It is not aware of the
+    schemas, so it must be removed when they change (software upgrade).
+
+    The entries are never updated, a new one is written instead: the old
+    entries must be removed from time to time (see 'prune').
+
+    The cache is optional: if it cannot be written (read-only filesystem,
+    disk full, etc.) the errors are logged, and the handlers are parsed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not exists(path):
+            try:
+                makedirs(path)
+            except OSError, e:
+                log_warning('cannot make the parsed cache: %s' % e,
+                            domain='itools.database')
+
+
+    def _get_path(self, key):
+        return '%s/%s/%s' % (self.path, key[:2], key[2:])
+
+
+    def load(self, key, handler):
+        """Loads into the given handler the state stored with the given
+        key.  Returns False if there is no such state, True otherwise.
+        """
+        try:
+            file = open(self._get_path(key), 'rb')
+        except IOError:
+            return False
+
+        try:
+            state = load(file)
+        except Exception:
+            log_warning('broken entry "%s" in the parsed cache' % key,
+                        domain='itools.database')
+            return False
+        finally:
+            file.close()
+
+        handler.__dict__.update(state)
+        return True
+
+
+    def save(self, key, handler):
+        """Stores the state of the given handler (which must be loaded) with
+        the given key.
+        """
+        exclude = handler.clone_exclude
+        state = dict([ (k, v) for k, v in handler.__dict__.iteritems()
+                       if k not in exclude ])
+
+        # Write to a temporary file first, another process may be reading
+        folder = '%s/%s' % (self.path, key[:2])
+        if not exists(folder):
+            try:
+                makedirs(folder)
+            except OSError:
+                # Created by another process (else open fails below)
+                pass
+        path = self._get_path(key)
+        tmp_path = '%s.%d' % (path, getpid())
+        try:
+            with open(tmp_path, 'wb') as file:
+                dump(state, file, HIGHEST_PROTOCOL)
+            rename(tmp_path, path)
+        except (PicklingError, TypeError):
+            # This state cannot be cached
+            self._remove(tmp_path)
+        except (IOError, OSError), e:
+            log_warning('cannot write to the parsed cache: %s' % e,
+                        domain='itools.database')
+            self._remove(tmp_path)
+
+
+    def _remove(self, path):
+        try:
+            remove(path)
+        except OSError:
+            pass
+
+
+    def get_folders(self):
+        """Returns the names of the folders of the cache, the entries are
+        spread among them by the first two characters of their keys.
+        """
+        return sorted(listdir(self.path))
+
+
+    def prune(self, max_age, folders=None):
+        """Removes the entries written more than 'max_age' seconds ago, from
+        the given folders (by default all of them).  The entries still used
+        will be written again the next time they are needed.  Returns the
+        number of entries removed.
+        """
+        if folders is None:
+            folders = self.get_folders()
+
+        limit = time() - max_age
+        n = 0
+        for folder in folders:
+            folder = '%s/%s' % (self.path, folder)
+            try:
+                names = listdir(folder)
+            except OSError:
+                continue
+            for name in names:
+                path = '%s/%s' % (folder, name)
+                try:
+                    if getmtime(path) < limit:
+                        remove(path)
+                        n += 1
+                except OSError:
+                    # Removed by another process
+                    pass
+
+        return n
@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+class PathSet(object):
+    """A set of file paths (like 'a/b/c'), indexed by folder.  Besides the
+    set API, it answers these questions with a cost that does not depend on
+    the number of paths in the set:
+
+    - has_folder(path): whether the given folder contains a path of the set
+    - get_names(path): the names in the given folder that are, or contain,
+      paths of the set
+    - get_subtree(path): the paths of the set within the given folder
+
+    The root folder is the empty string.
+    """
+
+    def __init__(self, paths=None):
+        self.paths = set()
+        # {folder: {name: number of paths within folder/name}}
+        self.folders = {}
+
+        if paths is not None:
+            for path in paths:
+                self.add(path)
+
+
+    def __contains__(self, path):
+        return path in self.paths
+
+
+    def __iter__(self):
+        return iter(self.paths)
+
+
+    def __len__(self):
+        return len(self.paths)
+
+
+    def add(self, path):
+        paths = self.paths
+        if path in paths:
+            return
+        paths.add(path)
+
+        folders = self.folders
+        folder = ''
+        for name in path.split('/'):
+            names = folders.setdefault(folder, {})
+            names[name] = names.get(name, 0) + 1
+            folder = '%s/%s' % (folder, name) if folder else name
+
+
+    def discard(self, path):
+        paths = self.paths
+        if path not in paths:
+            return
+        paths.remove(path)
+
+        folders = self.folders
+        folder = ''
+        for name in path.split('/'):
+            names = folders[folder]
+            n = names[name] - 1
+            if n:
+                names[name] = n
+            else:
+                del names[name]
+                if not names:
+                    del folders[folder]
+            folder = '%s/%s' % (folder, name) if folder else name
+
+
+    def remove(self, path):
+        if path not in self.paths:
+            raise KeyError, path
+        self.discard(path)
+
+
+    def clear(self):
+        self.paths.clear()
+        self.folders.clear()
+
+
+    def has_folder(self, path):
+        return path in self.folders
+
+
+    def get_names(self, path):
+        names = self.folders.get(path)
+        return names.keys() if names else []
+
+
+    def get_subtree(self, path):
+        folders = self.folders
+        paths = self.paths
+
+        subtree = []
+        stack = [path]
+        while stack:
+            folder = stack.pop()
+            for name in folders.get(folder, ()):
+                path = '%s/%s' % (folder, name) if folder else name
+                if path in paths:
+                    subtree.append(path)
+                if path in folders:
+                    stack.append(path)
+
+        return subtree
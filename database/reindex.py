@@ -0,0 +1,252 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements a parallel full reindex of the catalog.
+
+The resources are split in as many partitions as worker processes. Every
+worker builds its own Xapian database (a shard), then the shards are merged
+into the new catalog with the Xapian compactor.
+
+The merge is only possible if the shards share the same field-to-prefix and
+field-to-value assignment (the catalog "_metadata"), so it is computed once
+by the master and given to the workers.  The documents that need a field not
+yet in the metadata (typically a multilingual field in a language not known
+in advance) are not indexed by the workers, they are indexed by the master
+once the shards have been merged.
+
+The new catalog replaces the old one at the end.  No other process may have
+the database open meanwhile: a writer would commit changes the new catalog
+does not have, and the readers would go on reading the old catalog (removed
+from the filesystem, but still open).
+"""
+
+# Import from the Standard Library
+from marshal import dumps
+from multiprocessing import Pool, Value, cpu_count
+
+# Import from xapian
+from xapian import Compactor, TermGenerator
+
+# Import from itools
+from itools.datatypes import Unicode
+from itools.fs import lfs
+from catalog import Catalog, make_catalog
+from indexer import IndexQueue
+from registry import get_register_fields
+from ro import RODatabase
+
+
+
+def get_resources_abspaths(database):
+    """Returns the sorted list of the absolute paths of all the resources
+    in the given database (one per metadata file).
+    """
+    abspaths = []
+    for path in database.worktree.walk():
+        if path[-9:] == '.metadata':
+            abspaths.append('/%s' % path[:-9])
+
+    abspaths.sort()
+    return abspaths
+
+
+
+def make_metadata(fields, languages=()):
+    """Computes the catalog metadata for the given fields, and for the
+    language specific version of the unicode fields in the given languages.
+    """
+    catalog = Catalog.__new__(Catalog)
+    catalog._metadata = metadata = {}
+    catalog._value_nb = 0
+    catalog._prefix_nb = 0
+
+    for name in sorted(fields):
+        field_cls = fields[name]
+        metadata[name] = catalog._get_info(field_cls, name)
+        if issubclass(field_cls, Unicode):
+            for language in languages:
+                lang_name = '%s_%s' % (name, language)
+                lang_info = catalog._get_info(field_cls, lang_name)
+                lang_info['from'] = name
+                metadata[lang_name] = lang_info
+
+    return metadata
+
+
+
+def _get_head(database):
+    worktree = database.worktree
+    return worktree.repo[worktree._resolve_reference('HEAD')].hex
+
+
+
+def _set_metadata(catalog, metadata):
+    catalog._metadata = metadata.copy()
+    catalog._value_nb = len([ x for x in metadata.itervalues()
+                              if 'value' in x ])
+    catalog._prefix_nb = len([ x for x in metadata.itervalues()
+                               if 'prefix' in x ])
+
+
+
+###########################################################################
+# Workers
+###########################################################################
+_counter = None
+
+def _init_worker(counter):
+    global _counter
+    _counter = counter
+
+
+
+def _index_shard(args):
+    """Indexes the given resources into a new catalog (the shard).  Returns
+    the resources that could not be indexed because they need a field not in
+    the metadata.
+    """
+    path, shard_path, abspaths, metadata, batch_size = args
+
+    database = RODatabase(path)
+    catalog = make_catalog(shard_path, get_register_fields())
+    _set_metadata(catalog, metadata)
+    catalog._db.set_metadata('metadata', dumps(metadata))
+
+    add_document = catalog._db.add_document
+    make_xdoc = catalog._make_xdoc
+    tg = TermGenerator()
+    deferred = []
+    n = 0
+    for abspath in abspaths:
+        resource = database.get_resource(abspath, soft=True)
+        if resource is not None:
+            xdoc, modified = make_xdoc(resource, tg)
+            if modified:
+                # New field: leave it to the master
+                _set_metadata(catalog, metadata)
+                deferred.append(abspath)
+            else:
+                add_document(xdoc)
+
+        # Progress
+        with _counter.get_lock():
+            _counter.value += 1
+
+        # Flush
+        n += 1
+        if n % batch_size == 0:
+            catalog.save_changes()
+            database.make_room()
+
+    catalog.save_changes()
+    return deferred
+
+
+
+###########################################################################
+# Master
+###########################################################################
+def reindex_catalog(path, n_workers=None, languages=(), batch_size=1000,
+                    progress=None, interval=1):
+    """Rebuilds from scratch the catalog of the database at the given path,
+    using a pool of "n_workers" processes (by default one per processor).
+
+    The unicode fields are expected to be multilingual for the given
+    languages, the documents with other languages are indexed at the end
+    by the calling process.
+
+    If given, the "progress" callback is called every "interval" seconds
+    with two arguments, the number of resources processed so far and the
+    total number of resources.
+
+    The new catalog replaces the old one only once it is complete, it is
+    up to the caller to stop every process using the database before, and
+    to start them again after.  Raises RuntimeError if a commit is done
+    meanwhile, then the old catalog is kept.  Returns the number of
+    resources processed.
+    """
+    if n_workers is None:
+        n_workers = cpu_count()
+
+    path = lfs.get_absolute_path(path)
+    target = '%s/catalog' % path
+    new_target = '%s/catalog.new' % path
+    shards_path = '%s/catalog.shards' % path
+    for x in (new_target, shards_path):
+        if lfs.exists(x):
+            lfs.remove(x)
+    lfs.make_folder(shards_path)
+
+    # The resources, and the metadata shared by the shards
+    database = RODatabase(path)
+    head = _get_head(database)
+    abspaths = get_resources_abspaths(database)
+    total = len(abspaths)
+    fields = get_register_fields()
+    metadata = make_metadata(fields, languages)
+
+    # Build the shards
+    tasks = []
+    for i in range(n_workers):
+        shard_path = '%s/%d' % (shards_path, i)
+        tasks.append((path, shard_path, abspaths[i::n_workers], metadata,
+                      batch_size))
+
+    counter = Value('i', 0)
+    pool = Pool(n_workers, _init_worker, (counter,))
+    try:
+        result = pool.map_async(_index_shard, tasks)
+        while not result.ready():
+            result.wait(interval)
+            if progress is not None:
+                progress(counter.value, total)
+        deferred = result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+    # Merge the shards
+    compactor = Compactor()
+    for task in tasks:
+        compactor.add_source(task[1])
+    compactor.set_destdir(new_target)
+    compactor.compact()
+    lfs.remove(shards_path)
+
+    # Index the documents left by the workers
+    catalog = Catalog(new_target, fields)
+    documents = ( database.get_resource(x) for y in deferred for x in y )
+    catalog.index_documents(documents, batch_size=batch_size)
+    catalog.set_last_commit(head)
+    catalog.save_changes()
+    del catalog
+
+    # Replace the old catalog, unless a writer has been there
+    if _get_head(database) != head:
+        lfs.remove(new_target)
+        raise RuntimeError, 'the database has changed during the reindex'
+    if lfs.exists(target):
+        lfs.remove(target)
+    lfs.move(new_target, target)
+    # The items that failed to index are done
+    queue_path = '%s/catalog.queue' % path
+    if lfs.exists(queue_path):
+        IndexQueue(queue_path).clear_failed()
+
+    if progress is not None:
+        progress(total, total)
+    return total
@@ -19,7 +19,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from marshal import dump, load
+from os import getpid, remove, rename
+from os.path import getmtime
 from sys import getrefcount
+from threading import RLock
 
 # Import from other libraries
 from xapian import DatabaseError, DatabaseOpeningError
@@ -30,13 +34,18 @@ from itools.fs import lfs
 from itools.handlers import Folder, get_handler_class_by_mimetype
 from itools.log import log_warning
 from itools.uri import Path
-from catalog import Catalog, _get_xquery, SearchResults
+from catalog import Catalog, SearchResults
 from git import open_worktree
 from magic_ import magic_from_file
 from metadata import Metadata
+from parsed import ParsedCache
 from registry import get_register_fields
 
 
+# The registry of the resource classes is shared by all the databases, the
+# threads of the web server have their own (see itools.web.threads)
+registry_lock = RLock()
+
 
 
 class ReadonlyError(StandardError):
@@ -46,7 +55,8 @@ class ReadonlyError(StandardError):
 
 class RODatabase(object):
 
-    def __init__(self, path, size_min=4800, size_max=5200):
+    def __init__(self, path, size_min=4800, size_max=5200, exclusive=False,
+                 memory_max=None, parsed_cache=False):
         # 1. Keep the path
         if not lfs.is_folder(path):
             error = '"%s" should be a folder, but it is not' % path
@@ -67,12 +77,33 @@ class RODatabase(object):
         # 4. New interface to Git
         self.worktree = open_worktree(self.path_data)
 
-        # 5. A mapping from key to handler
+        # 5. A mapping from key to handler, bounded by the number of handlers
+        # and, optionally, by the memory they use (in bytes)
         self.cache = LRUCache(size_min, size_max, automatic=False)
+        self.memory_max = memory_max
+        # The total footprint of the handlers in the cache (see
+        # 'get_cache_footprint')
+        self.cache_footprint = 0
 
         # 6. The git cache
         self.git_cache = LRUCache(900, 1100)
 
+        # 7. If this database is the only one to write to the worktree, the
+        # handlers in the cache are kept in sync by the database itself,
+        # there is no need to check them against the filesystem.
+        self.exclusive = exclusive
+
+        # 8. The mimetypes found by libmagic, {key: (mtime, mimetype)}, kept
+        # on disk to survive restarts (see 'save_mimetypes')
+        self.mimetypes = LRUCache(9000, 11000)
+        self.mimetypes_changed = False
+        self.load_mimetypes()
+
+        # 9. Optionally, keep the parsed metadata on disk (see Metadata)
+        self.parsed = None
+        if parsed_cache:
+            self.parsed = ParsedCache('%s/parsed' % self.path)
+
 
     #######################################################################
     # Private API
@@ -90,6 +121,10 @@ class RODatabase(object):
         if handler is None:
             return None
 
+        # The database is the only writer, the cache is always right
+        if self.exclusive:
+            return handler
+
         # (1) Not yet loaded
         if handler.timestamp is None and handler.dirty is None:
             # Removed from the filesystem
@@ -143,11 +178,37 @@ class RODatabase(object):
         """Unconditionally remove the handler identified by the given key from
         the cache, and invalidate it (and free memory at the same time).
         """
-        handler = self.cache.pop(key)
+        handler = self._pop_handler(key)
         # Invalidate the handler
         handler.__dict__.clear()
 
 
+    def _pop_handler(self, key):
+        """Removes the handler identified by the given key from the cache,
+        and returns it.
+        """
+        handler = self.cache.pop(key)
+        self.cache_footprint -= handler.footprint
+        return handler
+
+
+    def discard_handlers(self, keys=None):
+        """Removes from the cache the handlers with the given keys, or all
+        of them if no key is given.  To be called when the worktree has been
+        changed by somebody else, in exclusive mode (see '__init__').
+
+        The modified handlers are kept.
+        """
+        cache = self.cache
+        if keys is None:
+            keys = cache.keys()
+        for key in keys:
+            key = self.normalize_key(key)
+            handler = cache.get(key)
+            if handler is not None and handler.dirty is None:
+                self._discard_handler(key)
+
+
     def _abort_changes(self):
         """To be called to abandon the transaction.
         """
@@ -190,39 +251,78 @@ class RODatabase(object):
         if type(handler) is Folder:
             return
         # Store in the cache
-        self.cache[key] = handler
+        cache = self.cache
+        old = cache.get(key)
+        if old is not None:
+            self.cache_footprint -= old.footprint
+        cache[key] = handler
+        self.cache_footprint += handler.footprint
+
+
+    def update_footprint(self, handler, footprint):
+        """Called by the handler when its footprint changes (see
+        'File.set_footprint'), before it is changed.
+        """
+        if self.cache.get(handler.key) is handler:
+            self.cache_footprint += footprint - handler.footprint
+
+
+    def get_cache_footprint(self):
+        """Returns the approximate memory used by the handlers in the cache,
+        in bytes.
+        """
+        return self.cache_footprint
 
 
     def make_room(self):
-        """Remove handlers from the cache until it fits the defined size.
+        """Remove handlers from the cache until it fits the defined size, and
+        the defined memory budget if any.
 
         Use with caution. If the handlers we are about to discard are still
         used outside the database, and one of them (or more) are modified, then
         there will be an error.
+
+        The handlers that cannot be discarded are moved to the end of the
+        cache (the most recently used), so the next calls do not check them
+        again.
         """
+        cache = self.cache
+
         # Find out how many handlers should be removed
-        size = len(self.cache)
-        if size < self.cache.size_max:
+        size = len(cache)
+        n = size - cache.size_min if size >= cache.size_max else 0
+        # And how much memory should be freed
+        memory = 0
+        if self.memory_max is not None:
+            memory = self.get_cache_footprint() - self.memory_max
+        if n <= 0 and memory <= 0:
             return
 
         # Discard as many handlers as needed
-        n = size - self.cache.size_min
-        for key, handler in self.cache.iteritems():
+        pinned = []
+        for key, handler in cache.iteritems():
             # Skip externally referenced handlers (refcount should be 3:
             # one for the cache, one for the local variable and one for
             # the argument passed to getrefcount).
             refcount = getrefcount(handler)
             if refcount > 3:
+                pinned.append(key)
                 continue
             # Skip modified (not new) handlers
             if handler.dirty is not None:
+                pinned.append(key)
                 continue
             # Discard this handler
+            memory -= handler.footprint
             self._discard_handler(key)
             # Check whether we are done
             n -= 1
-            if n == 0:
-                return
+            if n <= 0 and memory <= 0:
+                break
+
+        # Move the pinned handlers out of the way
+        for key in pinned:
+            cache.touch(key)
 
 
     def has_handler(self, key):
@@ -243,9 +343,64 @@ class RODatabase(object):
 
 
     def get_mimetype(self, key):
-        fs = self.fs
-        abspath = fs._resolve_path(key)
-        return magic_from_file(abspath)
+        abspath = self.fs._resolve_path(key)
+        mtime = getmtime(abspath)
+
+        # Cache hit
+        mimetypes = self.mimetypes
+        value = mimetypes.get(key)
+        if value is not None and value[0] == mtime:
+            mimetypes.touch(key)
+            return value[1]
+
+        # Cache miss
+        mimetype = magic_from_file(abspath)
+        mimetypes[key] = (mtime, mimetype)
+        self.mimetypes_changed = True
+        return mimetype
+
+
+    def load_mimetypes(self):
+        """Loads the mimetypes cache, if it was saved before.
+        """
+        path = '%s/mimetypes' % self.path
+        if not lfs.exists(path):
+            return
+
+        with open(path, 'rb') as file:
+            try:
+                mimetypes = load(file)
+            except (EOFError, ValueError, TypeError):
+                log_warning('the mimetypes cache is broken, ignored',
+                            domain='itools.database')
+                return
+
+        cache = self.mimetypes
+        for key, value in mimetypes.iteritems():
+            cache[key] = value
+
+
+    def save_mimetypes(self):
+        """Saves the mimetypes cache, if it has changed since the last time
+        it was loaded or saved.  This is done by the writer only (see
+        RWDatabase._cleanup), a failure is not fatal: it is just logged.
+        """
+        if self.mimetypes_changed is False:
+            return
+
+        path = '%s/mimetypes' % self.path
+        tmp_path = '%s/.mimetypes.%d' % (self.path, getpid())
+        try:
+            with open(tmp_path, 'wb') as file:
+                dump(dict(self.mimetypes), file)
+            rename(tmp_path, path)
+        except (IOError, OSError), error:
+            log_warning('cannot save the mimetypes cache: %s' % error,
+                        domain='itools.database')
+            if lfs.exists(tmp_path):
+                remove(tmp_path)
+            return
+        self.mimetypes_changed = False
 
 
     def get_handler_class(self, key):
@@ -255,6 +410,7 @@ class RODatabase(object):
             return get_handler_class_by_mimetype(mimetype)
         except ValueError:
             log_warning('unknown handler class "{0}"'.format(mimetype))
+            fs = self.fs
             if fs.is_file(key):
                 from itools.handlers import File
                 return File
@@ -356,26 +512,29 @@ class RODatabase(object):
         if type(class_id) is not str:
             raise TypeError, 'expected byte string, got %s' % class_id
 
-        # Check dynamic models are not broken
+        # Dynamic models
         registry = self._resources_registry
         if class_id[0] == '/':
             model = self.get_resource(class_id, soft=True)
-            if model is None:
-                registry.pop(class_id, None)
-                err = 'the resource "%s" does not exist' % class_id
-                raise LookupError, err
+            # The registry is shared by the databases of all the threads
+            with registry_lock:
+                # Check dynamic models are not broken
+                if model is None:
+                    registry.pop(class_id, None)
+                    err = 'the resource "%s" does not exist' % class_id
+                    raise LookupError, err
+                # Cache miss
+                cls = registry.get(class_id)
+                if cls is None:
+                    cls = model.build_resource_class()
+                    registry[class_id] = cls
+                return cls
 
         # Cache hit
         cls = registry.get(class_id)
         if cls:
             return cls
 
-        # Cache miss: dynamic model
-        if class_id[0] == '/':
-            cls = model.build_resource_class()
-            registry[class_id] = cls
-            return cls
-
         # Cache miss: fallback on mimetype
         if '/' in class_id:
             class_id = class_id.split('/')[0]
@@ -504,5 +663,5 @@ class RODatabase(object):
     def search(self, query=None, **kw):
         """Launch a search in the catalog.
         """
-        xquery = _get_xquery(self.catalog, query, **kw)
-        return SearchResults(self, xquery)
+        xquery, key = self.catalog._get_cached_xquery(query, kw)
+        return SearchResults(self, xquery, key)
@@ -21,6 +21,10 @@
 # Import from the Standard Library
 from datetime import datetime
 from os.path import dirname
+from time import time
+
+# Import from pygit2
+from pygit2 import GitError
 
 # Import from itools
 from itools.core import get_pipe, lazy
@@ -28,7 +32,10 @@ from itools.fs import lfs
 from itools.handlers import Folder
 from itools.log import log_error
 from catalog import Catalog, make_catalog
-from git import open_worktree
+from git import make_parent_dirs, open_worktree
+from indexer import Indexer, IndexQueue
+from journal import Journal
+from pathset import PathSet
 from registry import get_register_fields
 from ro import RODatabase
 
@@ -40,12 +47,28 @@ MSG_URI_IS_BUSY = 'The "%s" URI is busy.'
 
 class RWDatabase(RODatabase):
 
-    def __init__(self, path, size_min, size_max):
-        super(RWDatabase, self).__init__(path, size_min, size_max)
-
-        # The "git add" arguments
-        self.added = set()
-        self.changed = set()
+    def __init__(self, path, size_min, size_max, async_indexing=False,
+                 exclusive=False, memory_max=None, parsed_cache=False,
+                 group_size=1, group_delay=None):
+        super(RWDatabase, self).__init__(path, size_min, size_max, exclusive,
+                                         memory_max, parsed_cache)
+
+        # This process writes the index of the history (see git_log)
+        self.worktree.history_writer = True
+
+        # Asynchronous indexing: the documents to (un)index are pushed to a
+        # queue consumed by a background process, the catalog is read-only
+        # for this process.
+        self.indexer = None
+        if async_indexing:
+            self.indexer = Indexer(self.path)
+            self.indexer.start()
+
+        # The "git add" arguments (indexed by folder, to find quickly the
+        # new folders and their content)
+        self.added = PathSet()
+        self.changed = PathSet()
+        self.removed = []
         self.has_changed = False
 
         # The resources that been added, removed, changed and moved can be
@@ -87,11 +110,31 @@ class RWDatabase(RODatabase):
         self.resources_old2new = {}
         self.resources_new2old = {}
 
+        # Group commits: the transactions are recorded in the journal, and
+        # committed to git all at once every 'group_size' transactions or
+        # 'group_delay' seconds (see 'flush_commits')
+        self.journal = Journal('%s/database.journal' % self.path)
+        self.group_size = group_size
+        self.group_delay = group_delay
+        self.group_commits = group_size > 1 or group_delay is not None
+        self.group_count = 0
+        self.group_time = None
+
+        # Commit the transactions left in the journal by the previous run,
+        # drop whatever else it left in the working tree
+        if self.journal.load():
+            worktree = self.worktree
+            worktree.git_reset()
+            worktree.git_clean()
+            self._replay_journal()
+            self.flush_commits()
+
 
     @lazy
     def catalog(self):
         path = '%s/catalog' % self.path
-        return Catalog(path, get_register_fields())
+        read_only = self.indexer is not None
+        return Catalog(path, get_register_fields(), read_only=read_only)
 
 
     #######################################################################
@@ -109,10 +152,9 @@ class RWDatabase(RODatabase):
         key = self.normalize_key(key)
 
         # A new file/directory is only in added
-        n = len(key)
-        for f_key in self.added:
-            if f_key[:n] == key and (len(f_key) == n or f_key[n] == '/'):
-                return True
+        added = self.added
+        if key in added or added.has_folder(key):
+            return True
 
         # Normal case
         return super(RWDatabase, self).has_handler(key)
@@ -120,11 +162,8 @@ class RWDatabase(RODatabase):
 
     def _get_handler(self, key, cls=None, soft=False):
         # A hook to handle the new directories
-        base = key + '/'
-        n = len(base)
-        for f_key in self.added:
-            if f_key[:n] == base:
-                return Folder(key, database=self)
+        if self.added.has_folder(key):
+            return Folder(key, database=self)
 
         # The other files
         return super(RWDatabase, self)._get_handler(key, cls, soft)
@@ -159,24 +198,23 @@ class RWDatabase(RODatabase):
             else:
                 self.changed.discard(key)
                 self.worktree.git_rm(key)
+                self.removed.append(key)
             # Changed
             self.has_changed = True
             return
 
         # Case 2: folder
-        base = key + '/'
-        for k in self.added.copy():
-            if k.startswith(base):
-                self._discard_handler(k)
-                self.added.discard(k)
+        for k in self.added.get_subtree(key):
+            self._discard_handler(k)
+            self.added.discard(k)
 
-        for k in self.changed.copy():
-            if k.startswith(base):
-                self._discard_handler(k)
-                self.changed.discard(k)
+        for k in self.changed.get_subtree(key):
+            self._discard_handler(k)
+            self.changed.discard(k)
 
         if self.fs.exists(key):
             self.worktree.git_rm(key)
+            self.removed.append(key)
 
         # Changed
         self.has_changed = True
@@ -191,7 +229,7 @@ class RWDatabase(RODatabase):
 
         # The phantoms become real files
         if self.is_phantom(handler):
-            self.cache[key] = handler
+            self.push_handler(key, handler)
             self.added.add(key)
             self.has_changed = True
             return
@@ -216,12 +254,7 @@ class RWDatabase(RODatabase):
         names = set(names)
 
         # In added
-        base = key + '/'
-        n = len(base)
-        for f_key in self.added:
-            if f_key[:n] == base:
-                name = f_key[n:].split('/', 1)[0]
-                names.add(name)
+        names.update(self.added.get_names(key))
 
         # Remove .git
         if key == "":
@@ -274,18 +307,18 @@ class RWDatabase(RODatabase):
 
         # Go
         fs = self.fs
-        cache = self.cache
 
         # Case 1: file
         handler = self._get_handler(source)
         if type(handler) is not Folder:
             if fs.exists(source):
                 self.worktree.git_mv(source, target, add=False)
+                self.removed.append(source)
 
             # Remove source
             self.added.discard(source)
             self.changed.discard(source)
-            del cache[source]
+            self._pop_handler(source)
             # Add target
             self.push_handler(target, handler)
             self.added.add(target)
@@ -296,24 +329,22 @@ class RWDatabase(RODatabase):
 
         # Case 2: Folder
         n = len(source)
-        base = source + '/'
-        for key in self.added.copy():
-            if key.startswith(base):
-                new_key = '%s%s' % (target, key[n:])
-                handler = cache.pop(key)
-                self.push_handler(new_key, handler)
-                self.added.remove(key)
-                self.added.add(new_key)
-
-        for key in self.changed.copy():
-            if key.startswith(base):
-                new_key = '%s%s' % (target, key[n:])
-                handler = cache.pop(key)
-                self.push_handler(new_key, handler)
-                self.changed.remove(key)
+        for key in self.added.get_subtree(source):
+            new_key = '%s%s' % (target, key[n:])
+            handler = self._pop_handler(key)
+            self.push_handler(new_key, handler)
+            self.added.remove(key)
+            self.added.add(new_key)
+
+        for key in self.changed.get_subtree(source):
+            new_key = '%s%s' % (target, key[n:])
+            handler = self._pop_handler(key)
+            self.push_handler(new_key, handler)
+            self.changed.remove(key)
 
         if fs.exists(source):
             self.worktree.git_mv(source, target, add=False)
+            self.removed.append(source)
         for path in fs.traverse(target):
             if not fs.is_folder(path):
                 path = fs.get_relative_path(path)
@@ -402,6 +433,7 @@ class RWDatabase(RODatabase):
     def _cleanup(self):
         super(RWDatabase, self)._cleanup()
         self.has_changed = False
+        self.save_mimetypes()
 
 
     def _abort_changes(self):
@@ -416,13 +448,17 @@ class RWDatabase(RODatabase):
         self.worktree.git_reset()
         if self.added:
             self.worktree.git_clean()
+        # Restore the transactions not yet committed to git
+        self._replay_journal()
 
         # Reset state
         self.added.clear()
         self.changed.clear()
+        del self.removed[:]
 
         # 2. Catalog
-        self.catalog.abort_changes()
+        if self.indexer is None:
+            self.catalog.abort_changes()
 
         # 3. Resources
         self.resources_old2new.clear()
@@ -469,20 +505,48 @@ class RWDatabase(RODatabase):
         git_msg = git_msg or 'no comment'
 
         # 3. Call git
+        worktree = self.worktree
         git_add = list(added) + list(changed)
-        self.worktree.git_add(*git_add)
-        self.worktree.git_commit(git_msg, git_author, git_date)
+        worktree.git_add(*git_add)
+        if self.group_commits:
+            # Group commits: record the transaction in the journal
+            index = worktree.index
+            paths = [ y for x in git_add for y in worktree.walk(x)
+                      if y[-1] != '/' ]
+            add = [ (x, index[x].hex) for x in paths ]
+            # The journal refers to the blobs, write them to disk first
+            worktree.sync_objects([ sha for x, sha in add ])
+            self.journal.append({
+                'author': git_author,
+                'date': git_date,
+                'message': git_msg,
+                'add': add,
+                'rm': list(self.removed)})
+            self.group_count += 1
+            if self.group_time is None:
+                self.group_time = time()
+            commit = None
+        else:
+            commit = worktree.git_commit(git_msg, git_author, git_date)
+            commit = worktree.repo[commit].hex
 
         # 4. Clear state
         changed.clear()
         added.clear()
+        del self.removed[:]
 
         # 5. Catalog
+        if self.indexer is not None:
+            docs_to_index = [ values for x, values in docs_to_index ]
+            self.indexer.push(commit, list(docs_to_unindex), docs_to_index)
+            return
+
         catalog = self.catalog
         for path in docs_to_unindex:
             catalog.unindex_document(path)
-        for resource, values in docs_to_index:
-            catalog.index_document(values)
+        catalog.index_documents([ values for x, values in docs_to_index ])
+        if commit is not None:
+            catalog.set_last_commit(commit)
         catalog.save_changes()
 
 
@@ -516,9 +580,198 @@ class RWDatabase(RODatabase):
         finally:
             self._cleanup()
 
+        # Group commits
+        if self.group_commits:
+            if self.group_count >= self.group_size:
+                self.flush_commits()
+            elif self.group_delay is not None:
+                if time() - self.group_time >= self.group_delay:
+                    self.flush_commits()
+
+
+    #######################################################################
+    # Group commits
+    #######################################################################
+    def _replay_journal(self):
+        """Brings the working tree and the index up to the last transaction
+        recorded in the journal, from the last commit.
+        """
+        worktree = self.worktree
+        repo = worktree.repo
+        index = worktree.index
+        fs = self.fs
+        for record in self.journal.load():
+            for path in record['rm']:
+                if fs.exists(path):
+                    fs.remove(path)
+                prefix = path + '/'
+                entries = [ x.path for x in index
+                            if x.path == path or x.path.startswith(prefix) ]
+                for entry in entries:
+                    del index[entry]
+            for path, sha in record['add']:
+                # The blob may be lost if the system crashed before it was
+                # written to disk (journals from older versions)
+                try:
+                    data = repo[sha].data
+                except (KeyError, GitError):
+                    log_error('journal: the blob %s of "%s" is missing, '
+                              'dropped' % (sha, path),
+                              domain='itools.database')
+                    continue
+                abspath = worktree._get_abspath(path)
+                make_parent_dirs(abspath)
+                with open(abspath, 'w') as file:
+                    file.write(data)
+                index.add(path)
+
+
+    def flush_commits(self):
+        """With group commits, commits to git all the transactions recorded
+        in the journal.  The author and message of every transaction are
+        kept in the message of the commit.
+
+        Besides being called by 'save_changes', this method may be called
+        periodically with 'itools.loop.cron'.  It always returns True.
+        """
+        records = self.journal.load()
+        if not records:
+            return True
+
+        # The message
+        if len(records) == 1:
+            record = records[0]
+            git_msg = record['message']
+            git_author = record['author']
+            git_date = record['date']
+        else:
+            lines = ['%d transactions' % len(records), '']
+            for record in records:
+                author = record['author']
+                author = '%s <%s>' % author if author else '-'
+                date = record['date']
+                date = date.isoformat() if date else '-'
+                lines.append('%s %s %s' % (date, author, record['message']))
+            git_msg = '\n'.join(lines)
+            # The author, if it is always the same
+            authors = set([ x['author'] for x in records ])
+            git_author = authors.pop() if len(authors) == 1 else None
+            git_date = records[-1]['date']
+
+        # Commit
+        worktree = self.worktree
+        commit = worktree.git_commit(git_msg, git_author, git_date)
+        commit = worktree.repo[commit].hex
+        self.journal.clear()
+        self.group_count = 0
+        self.group_time = None
+
+        # Catalog
+        if self.indexer is not None:
+            self.indexer.push(commit, [], [])
+        else:
+            catalog = self.catalog
+            catalog.set_last_commit(commit)
+            catalog.save_changes()
+
+        return True
+
+
+    #######################################################################
+    # Catalog
+    #######################################################################
+    def sync_catalog(self, timeout=None):
+        """With asynchronous indexing, waits until the changes committed so
+        far are indexed, and reopens the catalog to see them.  Returns False
+        if the timeout (in seconds) expires before.
+        """
+        if self.indexer is None:
+            return True
+
+        if not self.indexer.wait(timeout=timeout):
+            return False
+        self.catalog.reopen()
+        return True
+
+
+    def search(self, query=None, **kw):
+        # Asynchronous indexing, see the last changes indexed
+        if self.indexer is not None:
+            self.catalog.reopen()
+        return super(RWDatabase, self).search(query, **kw)
+
+
+    def get_resource_path_by_key(self, key):
+        """Returns the absolute path of the resource the given file (the key)
+        belongs to.  By default a resource is made of its metadata file,
+        "a/b.metadata", and its data files, like "a/b.txt" or "a/b.txt.fr".
+        """
+        if key[-9:] == '.metadata':
+            return '/%s' % key[:-9]
+
+        folder, name = key.rsplit('/', 1) if '/' in key else ('', key)
+        name = name.split('.', 1)[0]
+        return '/%s/%s' % (folder, name) if folder else '/%s' % name
+
+
+    def catch_up(self):
+        """Brings the catalog up to date with the last commit, by indexing
+        only the resources changed since the last commit indexed (the tree
+        of both commits are compared with libgit2).
 
+        Returns the number of resources (un)indexed.  Raises ValueError if
+        the last commit indexed is not known, then a full reindex is needed.
 
-def make_git_database(path, size_min, size_max, fields=None):
+        This also indexes again the documents of the items that failed with
+        asynchronous indexing (see itools.database.indexer).
+        """
+        if self.has_changed:
+            raise RuntimeError, 'cannot catch up within a transaction'
+        if self.indexer is not None:
+            raise RuntimeError, 'cannot catch up with asynchronous indexing'
+
+        catalog = self.catalog
+        since = catalog.get_last_commit()
+        if since is None:
+            raise ValueError, 'the last commit indexed is not known'
+
+        worktree = self.worktree
+        head = worktree.repo[worktree._resolve_reference('HEAD')].hex
+        if since == head:
+            return 0
+
+        # The resources changed
+        keys = worktree.get_tree_changes(since, head)
+        abspaths = set([ self.get_resource_path_by_key(x) for x in keys ])
+        abspaths = sorted(abspaths)
+
+        # Unindex, then index again the resources still there
+        documents = []
+        for abspath in abspaths:
+            catalog.unindex_document(abspath)
+            resource = self.get_resource(abspath, soft=True)
+            if resource is not None:
+                documents.append(resource)
+        catalog.index_documents(documents)
+        catalog.set_last_commit(head)
+        catalog.save_changes()
+        self._cleanup()
+
+        # The items that failed to index are done
+        self._clear_failed()
+        return len(abspaths)
+
+
+    def _clear_failed(self):
+        queue_path = '%s/catalog.queue' % self.path
+        if lfs.exists(queue_path):
+            IndexQueue(queue_path).clear_failed()
+
+
+
+def make_git_database(path, size_min, size_max, fields=None,
+                      exclusive=False, memory_max=None, parsed_cache=False,
+                      group_size=1, group_delay=None):
     """Create a new empty Git database if the given path does not exists or
     is a folder.
 
@@ -534,7 +787,9 @@ def make_git_database(path, size_min, size_max, fields=None):
         fields = get_register_fields()
     catalog = make_catalog('%s/catalog' % path, fields)
     # Ok
-    database = RWDatabase(path, size_min, size_max)
+    database = RWDatabase(path, size_min, size_max, exclusive=exclusive,
+                          memory_max=memory_max, parsed_cache=parsed_cache,
+                          group_size=group_size, group_delay=group_delay)
     database.catalog = catalog
     return database
 
@@ -547,6 +802,11 @@ def check_database(target):
 
     This is meant to be used by scripts, like 'icms-start.py'
     """
+    # With group commits, the transactions not yet committed are recorded in
+    # the journal, they will be committed when the database is opened
+    if Journal('%s/database.journal' % target).load():
+        return True
+
     cwd = '%s/database' % target
 
     # Check modifications to the working tree not yet in the index.
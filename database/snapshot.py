@@ -0,0 +1,170 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from cStringIO import StringIO
+from datetime import datetime
+
+# Import from pygit2
+from pygit2 import GIT_OBJ_TREE
+
+# Import from itools
+from itools.handlers import Folder
+from magic_ import magic_from_buffer
+from metadata import Metadata
+from ro import RODatabase
+
+
+
+class SnapshotDatabase(RODatabase):
+    """A read-only database that serves the handlers from the git objects of
+    a given commit, instead of from the working tree.  Since the objects
+    never change, the handlers never need to be checked against the
+    filesystem.
+
+    The parsed metadata handlers are kept on disk, keyed by the SHA of the
+    blob, so they are shared by all the processes that open the database.
+    """
+
+    def __init__(self, path, size_min=4800, size_max=5200, memory_max=None,
+                 reference='HEAD'):
+        super(SnapshotDatabase, self).__init__(path, size_min, size_max,
+                                               memory_max=memory_max,
+                                               parsed_cache=True)
+        self.commit = None
+        self.set_commit(reference)
+
+
+    def set_commit(self, reference='HEAD'):
+        """Moves the snapshot to the given commit (by default the current
+        HEAD).  Returns True if it has changed, False otherwise.
+
+        The handlers in the cache are discarded, so this must be called
+        between two requests, when none of them is in use.
+        """
+        worktree = self.worktree
+        sha = worktree._resolve_reference(reference)
+        commit = worktree.repo[sha]
+        if self.commit is not None and commit.hex == self.commit.hex:
+            return False
+
+        # The handlers of the previous commit may be outdated
+        self.discard_handlers()
+        self.commit = commit
+        self.commit_date = datetime.fromtimestamp(commit.commit_time)
+        return True
+
+
+    def _get_object(self, key):
+        """Returns the git object (tree or blob) for the given key in the
+        commit of the snapshot, or None if there is not such object.
+        """
+        repo = self.worktree.repo
+        obj = self.commit.tree
+        if not key:
+            return obj
+
+        for name in key.split('/'):
+            if obj.type != GIT_OBJ_TREE or name not in obj:
+                return None
+            obj = repo[obj[name].oid]
+        return obj
+
+
+    #######################################################################
+    # Layer 0: handlers
+    #######################################################################
+    def _sync_filesystem(self, key):
+        return self.cache.get(key)
+
+
+    def has_handler(self, key):
+        key = self.normalize_key(key)
+        if key in self.cache:
+            return True
+        return self._get_object(key) is not None
+
+
+    def get_handler_names(self, key):
+        key = self.normalize_key(key)
+        tree = self._get_object(key)
+        if tree is None or tree.type != GIT_OBJ_TREE:
+            return []
+        return [ x.name for x in tree ]
+
+
+    def get_mimetype(self, key):
+        blob = self._get_object(key)
+        sha = blob.hex
+
+        # Cache hit
+        mimetypes = self.mimetypes
+        value = mimetypes.get(key)
+        if value is not None and value[0] == sha:
+            mimetypes.touch(key)
+            return value[1]
+
+        # Cache miss
+        mimetype = magic_from_buffer(blob.data)
+        mimetypes[key] = (sha, mimetype)
+        return mimetype
+
+
+    def _get_handler(self, key, cls=None, soft=False):
+        # Cache hit
+        handler = self.cache.get(key)
+        if handler is not None:
+            # Check the class matches
+            if cls is not None and not isinstance(handler, cls):
+                error = "expected '%s' class, '%s' found"
+                raise LookupError, error % (cls, handler.__class__)
+            self.cache.touch(key)
+            return handler
+
+        # Check the resource exists
+        obj = self._get_object(key)
+        if obj is None:
+            if soft:
+                return None
+            raise LookupError, 'the resource "%s" does not exist' % key
+
+        # Folders are not cached
+        if obj.type == GIT_OBJ_TREE:
+            return Folder(key, database=self)
+
+        # Cache miss
+        if cls is None:
+            cls = self.get_handler_class(key)
+        handler = object.__new__(cls)
+        handler.database = self
+        handler.key = key
+
+        # Load, from the parsed cache if possible
+        sha = obj.hex
+        data = obj.data
+        is_metadata = issubclass(cls, Metadata)
+        if not is_metadata or not self.parsed.load(sha, handler):
+            handler.reset()
+            handler._load_state_from_file(StringIO(data))
+            if is_metadata:
+                self.parsed.save(sha, handler)
+        handler.timestamp = self.commit_date
+        handler.dirty = None
+        handler.footprint = len(data)
+
+        # Update the cache
+        self.push_handler(key, handler)
+        return handler
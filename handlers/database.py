@@ -38,6 +38,9 @@ class RODatabase(object):
     # actions by the 'save' and 'abort' methods.
     has_changed = False
 
+    # There is no cache of parsed files (see itools.database.parsed)
+    parsed = None
+
 
     def __init__(self, size_min=4800, size_max=5200, fs=None):
         # A mapping from key to handler
@@ -159,6 +162,13 @@ class RODatabase(object):
         self.cache[key] = handler
 
 
+    def update_footprint(self, handler, footprint):
+        """Called by the handler when its footprint changes, before it is
+        changed.  This database does not keep track of the footprints.
+        """
+        pass
+
+
     def make_room(self):
         """Remove handlers from the cache until it fits the defined size.
 
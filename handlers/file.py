@@ -51,6 +51,9 @@ class File(Handler):
     # By default handlers are not loaded
     timestamp = None
     dirty = None
+    # The approximate memory used by the handler, in bytes (the size of the
+    # file it was loaded from or saved to)
+    footprint = 0
 
 
     def __init__(self, key=None, string=None, database=None, **kw):
@@ -111,6 +114,7 @@ class File(Handler):
 
         self.timestamp = fs.get_mtime(self.key)
         self.dirty = None
+        self.set_footprint(fs.get_size(self.key))
 
 
     def load_state_from_uri(self, uri):
@@ -148,8 +152,18 @@ class File(Handler):
             file.close()
 
         # Update timestamp/dirty
-        self.timestamp = self.database.fs.get_mtime(self.key)
+        fs = self.database.fs
+        self.timestamp = fs.get_mtime(self.key)
         self.dirty = None
+        self.set_footprint(fs.get_size(self.key))
+
+
+    def set_footprint(self, footprint):
+        # The database may keep the total footprint of its cache
+        database = self.database
+        if database is not None:
+            database.update_footprint(self, footprint)
+        self.footprint = footprint
 
 
     def save_state_to(self, key):
@@ -181,7 +195,8 @@ class File(Handler):
         file.truncate(file.tell())
 
 
-    clone_exclude = frozenset(['database', 'key', 'timestamp', 'dirty'])
+    clone_exclude = frozenset(['database', 'key', 'timestamp', 'dirty',
+                               'footprint'])
     def clone(self, cls=None):
         # Define the class to build
         if cls is None:
@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of the LRU cache, compared to the previous implementation
+based on the ordered dict. Usage:
+
+  $ python bench_cache.py [-n NUMBER]
+"""
+
+# Import from the Standard Library
+from optparse import OptionParser
+from sys import getsizeof
+from time import time
+
+# Import from itools
+from itools.core import LRUCache, OrderedDict
+
+
+class OldLRUCache(OrderedDict):
+    """The LRU cache as implemented before (itools 0.75).
+    """
+
+    def __init__(self, size_min, size_max=None, automatic=True):
+        super(OldLRUCache, self).__init__()
+        self.size_min = size_min
+        self.size_max = size_max if size_max is not None else size_min
+        self.automatic = automatic
+
+
+    def _append(self, key):
+        super(OldLRUCache, self)._append(key)
+        if self.automatic is True and len(self) > self.size_max:
+            while len(self) > self.size_min:
+                self.popitem()
+
+
+    def touch(self, key):
+        node = self.key2node[key]
+        if node.next is None:
+            return
+        if node.prev is None:
+            self.first = node.next
+        else:
+            node.prev.next = node.next
+        node.next.prev = node.prev
+        node.prev = self.last
+        node.next = None
+        self.last.next = node
+        self.last = node
+
+
+
+def bench(cls, n):
+    keys = [ 'key-%d' % i for i in xrange(n) ]
+    results = []
+
+    # Set
+    cache = cls(n, n, automatic=False)
+    t0 = time()
+    for key in keys:
+        cache[key] = key
+    results.append(time() - t0)
+
+    # Memory per entry (the values are shared)
+    size = getsizeof(cache) + getsizeof(cache.key2node)
+    size += sum([ getsizeof(x) for x in cache.key2node.itervalues() ])
+    memory = size / float(n)
+
+    # Get
+    t0 = time()
+    for key in keys:
+        cache[key]
+    results.append(time() - t0)
+
+    # Touch
+    t0 = time()
+    for key in keys:
+        cache.touch(key)
+    results.append(time() - t0)
+
+    # Evict (automatic, one half each time)
+    cache = cls(n / 2, n)
+    t0 = time()
+    for key in keys:
+        cache[key] = key
+    for key in keys:
+        cache[key + '-new'] = key
+    results.append(time() - t0)
+
+    # Ok
+    line = ' '.join([ '%10.0f' % (n / x) for x in results ])
+    print '%-12s %s %10.1f' % (cls.__name__, line, memory)
+
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [-n NUMBER]')
+    parser.add_option('-n', type='int', dest='number', default=100000,
+                      help='number of keys (default 100000)')
+    options, args = parser.parse_args()
+
+    print '%-12s %10s %10s %10s %10s %10s' % (
+        'ops/s', 'set', 'get', 'touch', 'evict', 'bytes/key')
+    for cls in OldLRUCache, LRUCache:
+        bench(cls, options.number)
@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the catalog. Usage:
+
+  $ python bench_catalog.py [-n NUMBER] [--page-size SIZE]
+"""
+
+# Import from the Standard Library
+from optparse import OptionParser
+from random import Random
+from time import time
+
+# Import from itools
+from itools.database import make_catalog
+from itools.database.catalog import SearchResults, _get_xquery
+from itools.datatypes import Integer, String, Unicode
+from itools.fs import lfs
+
+
+fields = {
+    'abspath': String(indexed=True, stored=True),
+    'format': String(indexed=True, stored=True),
+    'title': Unicode(indexed=True, stored=True),
+    'text': Unicode(indexed=True),
+    'size': Integer(indexed=True, stored=True)}
+
+
+words = [
+    u'lion', u'mouse', u'wolf', u'lamb', u'fox', u'crow', u'cheese', u'dog',
+    u'shadow', u'ant', u'grasshopper', u'hare', u'tortoise', u'frog', u'ox',
+    u'the', u'and', u'of', u'a', u'to', u'in', u'was', u'he', u'it', u'said']
+
+
+def make_documents(n, seed=0):
+    random = Random(seed)
+    for i in xrange(n):
+        text = u' '.join([ random.choice(words) for x in range(200) ])
+        yield {
+            'abspath': '/doc-%06d' % i,
+            'format': random.choice(['file', 'folder', 'webpage']),
+            'title': u' '.join([ random.choice(words) for x in range(5) ]),
+            'text': text,
+            'size': len(text)}
+
+
+def bench(name, callback, path, n):
+    if lfs.exists(path):
+        lfs.remove(path)
+    catalog = make_catalog(path, fields)
+    t0 = time()
+    callback(catalog, make_documents(n))
+    catalog.save_changes()
+    t1 = time() - t0
+    lfs.remove(path)
+    print '%-16s %8d docs %8.2f s %10.1f docs/s' % (name, n, t1, n / t1)
+
+
+def index_one_by_one(catalog, documents):
+    for document in documents:
+        catalog.index_document(document)
+
+
+def index_bulk(catalog, documents):
+    catalog.index_documents(documents, batch_size=1000)
+
+
+
+class Database(object):
+    """SearchResults only needs the catalog of the database.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+
+
+def bench_pagination(path, n, page_size):
+    if lfs.exists(path):
+        lfs.remove(path)
+    catalog = make_catalog(path, fields)
+    index_bulk(catalog, make_documents(n))
+    catalog.save_changes()
+
+    database = Database(catalog)
+    xquery = _get_xquery(catalog)
+    last_page = n / page_size - 1
+
+    # Offset
+    results = SearchResults(database, xquery)
+    for page in 0, last_page:
+        t0 = time()
+        results.get_documents(sort_by='title', start=page * page_size,
+                              size=page_size)
+        t1 = time() - t0
+        print 'offset   page %6d %10.2f ms' % (page + 1, t1 * 1000)
+
+    # Cursor
+    cursor = None
+    for page in range(last_page + 1):
+        t0 = time()
+        documents, next_cursor = results.get_page('title', size=page_size,
+                                                  after=cursor)
+        t1 = time() - t0
+        if page in (0, last_page):
+            print 'cursor   page %6d %10.2f ms' % (page + 1, t1 * 1000)
+        cursor = next_cursor
+
+    lfs.remove(path)
+
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [-n NUMBER] [--page-size SIZE]')
+    parser.add_option('-n', type='int', dest='number', default=10000,
+                      help='number of documents to index (default 10000)')
+    parser.add_option('--page-size', type='int', dest='page_size',
+                      default=20, help='number of documents per page '
+                      '(default 20)')
+    options, args = parser.parse_args()
+
+    n = options.number
+    bench('index_document', index_one_by_one, 'bench_catalog', n)
+    bench('index_documents', index_bulk, 'bench_catalog', n)
+    bench_pagination('bench_catalog', n, options.page_size)
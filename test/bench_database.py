@@ -0,0 +1,74 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of a bulk import: many new files added to the database within a
+single transaction.  Usage:
+
+  $ python bench_database.py [-n NUMBER] [--batch SIZE]
+
+The time per batch should stay flat, it used to grow with the number of
+files already added.
+"""
+
+# Import from the Standard Library
+from optparse import OptionParser
+from time import time
+
+# Import from itools
+from itools.database import make_git_database
+from itools.fs import lfs
+from itools.handlers import TextFile
+
+
+def bench(path, n, batch):
+    if lfs.exists(path):
+        lfs.remove(path)
+    database = make_git_database(path, n, n)
+
+    t0 = time()
+    for i in xrange(n):
+        # Like an import does: check the folder and the file before
+        # adding it
+        folder = 'import/%03d' % (i % 1000)
+        database.has_handler(folder)
+        key = '%s/%06d.txt' % (folder, i)
+        if not database.has_handler(key):
+            database.set_handler(key, TextFile(data=u'%d\n' % i))
+        database.get_handler_names(folder)
+
+        if (i + 1) % batch == 0:
+            t1 = time()
+            print '%8d files %10.2f s %10.1f files/s' % (
+                i + 1, t1 - t0, batch / (t1 - t0))
+            t0 = t1
+
+    t0 = time()
+    database.save_changes()
+    print 'commit   %10.2f s' % (time() - t0)
+    lfs.remove(path)
+
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [-n NUMBER] [--batch SIZE]')
+    parser.add_option('-n', type='int', dest='number', default=50000,
+                      help='number of files to import (default 50000)')
+    parser.add_option('--batch', type='int', dest='batch', default=5000,
+                      help='number of files per timing (default 5000)')
+    options, args = parser.parse_args()
+
+    bench('bench_database', options.number, options.batch)
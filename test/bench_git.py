@@ -0,0 +1,123 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the git diffs, calling the git command (as done before) versus
+in-process with libgit2. Usage:
+
+  $ python bench_git.py [-n NUMBER] [--sample SIZE]
+
+The repository is built once (it takes a while with many commits), and kept
+in the 'bench_git' folder for the next runs.  The git user name and email
+must be configured.
+"""
+
+# Import from the Standard Library
+from optparse import OptionParser
+from os import makedirs
+from os.path import dirname, exists
+from random import Random
+from time import time
+
+# Import from itools
+from itools.database.git import open_worktree
+
+
+def make_repository(path, n):
+    worktree = open_worktree(path, init=True)
+    random = Random(0)
+    for i in xrange(n):
+        # Change a file in one of 100 folders, of 100 files each
+        name = '%02d/%02d.txt' % (random.randint(0, 99), random.randint(0, 99))
+        abspath = '%s/%s' % (path, name)
+        if not exists(dirname(abspath)):
+            makedirs(dirname(abspath))
+        with open(abspath, 'a') as file:
+            file.write('line %d\n' % i)
+        worktree.git_add(name)
+        worktree.git_commit('commit %d' % i, ('Bench', 'bench@example.com'))
+        if i % 1000 == 0:
+            print 'commit %d' % i
+
+
+###########################################################################
+# The previous implementation, calling git
+###########################################################################
+def old_git_diff(worktree, since, until):
+    return worktree._call(['git', 'diff', '%s..%s' % (since, until)])
+
+
+def old_git_stats(worktree, since, until):
+    cmd = ['git', 'diff', '--stat', '%s..%s' % (since, until)]
+    return worktree._call(cmd)
+
+
+def old_get_files_changed(worktree, since, until):
+    expr = '%s..%s' % (since, until)
+    cmd = ['git', 'show', '--numstat', '--pretty=format:', expr]
+    lines = worktree._call(cmd).splitlines()
+    return frozenset([ line.split('\t')[-1] for line in lines if line ])
+
+
+def old_username(worktree):
+    return worktree._call(['git', 'config', '--get', 'user.name']).rstrip()
+
+
+
+###########################################################################
+# The benchmark
+###########################################################################
+def bench(name, callback, pairs):
+    t0 = time()
+    for since, until in pairs:
+        callback(since, until)
+    t1 = time() - t0
+    print '%-24s %10.2f ms/call' % (name, t1 * 1000 / len(pairs))
+
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [-n NUMBER] [--sample SIZE]')
+    parser.add_option('-n', type='int', dest='number', default=100000,
+                      help='number of commits (default 100000)')
+    parser.add_option('--sample', type='int', dest='sample', default=100,
+                      help='number of diffs to compute (default 100)')
+    options, args = parser.parse_args()
+
+    path = 'bench_git'
+    if not exists(path):
+        make_repository(path, options.number)
+    worktree = open_worktree(path)
+
+    # Pairs of commits, 10 commits apart
+    commits = [ x.hex for x in worktree.repo.walk(
+                worktree._resolve_reference('HEAD'), 0) ]
+    random = Random(0)
+    pairs = []
+    for i in range(options.sample):
+        i = random.randint(10, len(commits) - 1)
+        pairs.append((commits[i], commits[i - 10]))
+
+    bench('git diff', lambda a, b: old_git_diff(worktree, a, b), pairs)
+    bench('git_diff', worktree.git_diff, pairs)
+    bench('git diff --stat', lambda a, b: old_git_stats(worktree, a, b),
+          pairs)
+    bench('git_stats', worktree.git_stats, pairs)
+    bench('git show --numstat',
+          lambda a, b: old_get_files_changed(worktree, a, b), pairs)
+    bench('get_files_changed', worktree.get_files_changed, pairs)
+    bench('git config', lambda a, b: old_username(worktree), pairs)
+    bench('config', lambda a, b: worktree.repo.config['user.name'], pairs)
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the metadata loading, parsing the text files versus loading
+them from the parsed cache. Usage:
+
+  $ python bench_metadata.py [-n NUMBER]
+"""
+
+# Import from the Standard Library
+from optparse import OptionParser
+from time import time
+
+# Import from itools
+from itools.core import freeze
+from itools.database import Field, Metadata, Resource, RODatabase
+from itools.database import make_git_database
+from itools.datatypes import ISODateTime, String, Unicode
+from itools.fs import lfs
+
+
+class TextField(Field):
+
+    datatype = Unicode
+    multiple = False
+    multilingual = True
+    parameters_schema = freeze({'lang': String})
+    parameters_schema_default = None
+
+
+
+class DateField(Field):
+
+    datatype = ISODateTime
+    multiple = False
+    multilingual = False
+    parameters_schema = freeze({})
+    parameters_schema_default = None
+
+
+
+class TagsField(DateField):
+
+    datatype = String
+    multiple = True
+
+
+
+class BenchResource(Resource):
+
+    class_id = 'bench'
+    class_version = '20120101'
+
+    title = TextField
+    description = TextField
+    mtime = DateField
+    tags = TagsField
+
+
+
+metadata = u"""format;version=20120101:bench
+description;lang=en:The %(n)d fable, of the wolf and the lamb
+description;lang=fr:La fable %(n)d, du loup et de l'agneau
+mtime:2012-01-01T10:00:00
+tags:animals
+tags:fables
+tags:wolf
+title;lang=en:Fable %(n)d
+title;lang=fr:Fable numéro %(n)d
+"""
+
+
+def make_database(path, n):
+    if lfs.exists(path):
+        lfs.remove(path)
+    make_git_database(path, 10, 20)
+    for i in xrange(n):
+        data = metadata % {'n': i}
+        with open('%s/database/%06d.metadata' % (path, i), 'w') as file:
+            file.write(data.encode('utf-8'))
+
+
+def bench(name, path, n, parsed_cache):
+    database = RODatabase(path, n, n, parsed_cache=parsed_cache)
+    t0 = time()
+    for i in xrange(n):
+        handler = database.get_handler('%06d.metadata' % i, Metadata)
+        handler.properties
+    t1 = time() - t0
+    print '%-20s %8d files %8.2f s %10.1f files/s' % (name, n, t1, n / t1)
+
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [-n NUMBER]')
+    parser.add_option('-n', type='int', dest='number', default=10000,
+                      help='number of metadata files (default 10000)')
+    options, args = parser.parse_args()
+
+    path = 'bench_metadata'
+    n = options.number
+    make_database(path, n)
+    bench('parse', path, n, False)
+    bench('parse (fill cache)', path, n, True)
+    bench('parsed cache', path, n, True)
+    lfs.remove(path)
@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load benchmark of the web server, with read-only GET requests, in single
+process mode versus pre-fork mode with 2, 4... workers (up to the number of
+cores).  Usage:
+
+  $ python bench_web.py [-c CLIENTS] [-d SECONDS] [-w WORK]
+
+Every request runs a loop of WORK iterations, to simulate the rendering of
+a page.
+"""
+
+# Import from the Standard Library
+from httplib import HTTPConnection
+from multiprocessing import cpu_count, Pool
+from optparse import OptionParser
+from os import _exit, fork, kill, waitpid
+from signal import SIGTERM
+from time import sleep, time
+
+# Import from itools
+from itools.log import Logger, register_logger, FATAL
+from itools.loop import Loop
+from itools.web import WebServer
+
+
+def serve(port, workers, work):
+    server = WebServer(None)
+    register_logger(Logger(min_level=FATAL), 'itools.web_access')
+    server.listen('127.0.0.1', port)
+
+    def callback(soup_message, path):
+        x = 0
+        for i in xrange(work):
+            x += i
+        soup_message.set_status(200)
+        soup_message.set_response('text/plain', 'Hello %d' % x)
+
+    server.add_handler('/', callback)
+    if workers == 0:
+        Loop().run()
+    else:
+        server.run_workers(workers)
+
+
+def client(args):
+    port, duration = args
+    connection = HTTPConnection('127.0.0.1', port)
+    n = 0
+    end = time() + duration
+    while time() < end:
+        connection.request('GET', '/')
+        connection.getresponse().read()
+        n += 1
+    return n
+
+
+def bench(name, port, workers, options):
+    pid = fork()
+    if pid == 0:
+        serve(port, workers, options.work)
+        _exit(0)
+
+    # Wait for the server to start
+    sleep(1)
+    try:
+        pool = Pool(options.clients)
+        args = [(port, options.duration)] * options.clients
+        n = sum(pool.map(client, args))
+        pool.close()
+    finally:
+        kill(pid, SIGTERM)
+        waitpid(pid, 0)
+
+    print '%-20s %10.1f requests/s' % (name, n / float(options.duration))
+
+
+
+if __name__ == '__main__':
+    usage = '%prog [-c CLIENTS] [-d SECONDS] [-w WORK]'
+    parser = OptionParser(usage=usage)
+    parser.add_option('-c', type='int', dest='clients', default=16,
+                      help='number of concurrent clients (default 16)')
+    parser.add_option('-d', type='int', dest='duration', default=10,
+                      help='duration of every run in seconds (default 10)')
+    parser.add_option('-w', type='int', dest='work', default=20000,
+                      help='iterations per request (default 20000)')
+    options, args = parser.parse_args()
+
+    port = 18080
+    bench('single process', port, 0, options)
+    workers = 1
+    while workers <= cpu_count():
+        port += 1
+        bench('%d workers' % workers, port, workers, options)
+        workers *= 2
@@ -418,6 +418,29 @@ class CacheTestCase(TestCase):
         self.assertEqual(keys, list('yzx'))
 
 
+    def test_setitem_touch(self):
+        cache = self.cache
+        cache['x'] = 'x'
+        self.assertEqual(cache.keys(), list('yzx'))
+        self.assertEqual(len(cache.key2node), 3)
+
+
+    def test_evict(self):
+        cache = LRUCache(2, 4)
+        for c in 'abcd':
+            cache[c] = c
+        cache.touch('a')
+        cache['e'] = 'e'
+        self.assertEqual(cache.keys(), list('ae'))
+        cache._check_integrity()
+
+
+    def test_popitem_empty(self):
+        cache = self.cache
+        cache.clear()
+        self.assertRaises(KeyError, cache.popitem)
+
+
 
 if __name__ == '__main__':
     main()
@@ -19,23 +19,33 @@
 
 # Import from the Standard Library
 from unittest import TestCase, main
+from os import utime
 from os.path import basename
 from random import sample
+from time import time
 import re
 
 # Import from itools
 from itools.database import AndQuery, RangeQuery, PhraseQuery, NotQuery
 from itools.database import AllQuery, OrQuery, TextQuery
 from itools.database import make_catalog, Catalog, Resource, StartQuery
-from itools.database import make_git_database
+from itools.database import make_git_database, RODatabase, RWDatabase
+from itools.database import get_register_fields
+from itools.database import Field, Maintenance, Metadata, SnapshotDatabase
+from itools.database import reindex_catalog
 from itools.database.catalog import _index, _decode
+from itools.database.indexer import IndexQueue, index_items
+from itools.database.parsed import ParsedCache
+from itools.database.pathset import PathSet
+from itools.database.reindex import make_metadata
 from itools.datatypes import String, Unicode, Boolean, Integer
 from itools.fs import lfs, FileName
 from itools.handlers import TextFile
+from itools.handlers import RODatabase as HandlersDatabase
 from itools.log.log import register_logger, Logger, FATAL
 
 # Import from xapian
-from xapian import Document as XapianDocument
+from xapian import Document as XapianDocument, Enquire
 
 
 
@@ -67,7 +77,10 @@ class RWDatabaseTestCase(TestCase):
                  'fables/database/.git',
                  'fables/database/31.txt',
                  'fables/database/agenda',
-                 'fables/database/broken.txt']
+                 'fables/database/broken.txt',
+                 'fables/database.journal',
+                 'fables/mimetypes',
+                 'fables/parsed']
         for path in paths:
             if lfs.exists(path):
                 lfs.remove(path)
@@ -130,6 +143,264 @@ class RWDatabaseTestCase(TestCase):
                          True)
 
 
+    def test_catch_up(self):
+        database = self.database
+        catalog = database.catalog
+        # Unknown
+        self.assertRaises(ValueError, database.catch_up)
+        # Up to date
+        fables = self.root
+        fables.set_handler('31.txt', TextFile())
+        database.save_changes()
+        head = database.worktree.repo[
+            database.worktree._resolve_reference('HEAD')].hex
+        self.assertEqual(catalog.get_last_commit(), head)
+        self.assertEqual(database.catch_up(), 0)
+
+
+    def test_get_tree_changes(self):
+        worktree = self.database.worktree
+        since = worktree.repo[worktree._resolve_reference('HEAD')].hex
+        fables = self.root
+        fables.set_handler('31.txt', TextFile())
+        fables.set_handler('agenda/a.txt', TextFile())
+        self.database.save_changes()
+        changes = worktree.get_tree_changes(since)
+        self.assertEqual(changes, ['31.txt', 'agenda/a.txt'])
+
+
+    def test_git_diff(self):
+        worktree = self.database.worktree
+        since = worktree.repo[worktree._resolve_reference('HEAD')].hex
+        self.root.set_handler('31.txt', TextFile(data=u'one\ntwo\n'))
+        self.database.save_changes()
+        until = worktree.repo[worktree._resolve_reference('HEAD')].hex
+        # Between two commits, and of one commit
+        self.assertEqual(worktree.get_numstat(since, until),
+                         [('31.txt', 2, 0)])
+        self.assertEqual(worktree.get_numstat(until), [('31.txt', 2, 0)])
+        self.assertEqual(worktree.get_numstat(until, paths=['agenda']), [])
+        self.assertEqual(worktree.get_files_changed(since, until),
+                         frozenset(['31.txt']))
+        # Diff
+        diff = worktree.git_diff(since, until)
+        self.assert_('--- /dev/null\n+++ b/31.txt\n' in diff)
+        self.assert_('+one\n+two\n' in diff)
+        self.assert_('1 files changed, 2 insertions(+)'
+                     in worktree.git_stats(until))
+
+
+    def test_git_log(self):
+        database = self.database
+        worktree = database.worktree
+        initial = worktree.repo[worktree._resolve_reference('HEAD')].hex
+        self.root.set_handler('31.txt', TextFile(data=u'one\n'))
+        database.save_changes()
+        self.root.set_handler('agenda/a.txt', TextFile(data=u'two\n'))
+        database.save_changes()
+        # Up-to-date
+        self.assertEqual(worktree.update_history(), 0)
+        # One file
+        self.assertEqual(len(worktree.git_log(['31.txt'])), 1)
+        log = worktree.git_log(['30.txt'], n=1)
+        self.assertEqual([ x['sha'] for x in log ], [initial])
+        # Several files, the same as walking the history (with a folder)
+        log = worktree.git_log(['31.txt', 'agenda/a.txt'])
+        self.assertEqual(len(log), 2)
+        shas = sorted([ x['sha'] for x in log ])
+        log2 = worktree.git_log(['31.txt', 'agenda'])
+        self.assertEqual(sorted([ x['sha'] for x in log2 ]), shas)
+        log.reverse()
+        self.assertEqual(
+            worktree.git_log(['31.txt', 'agenda/a.txt'], reverse=True), log)
+
+
+    def test_update_history(self):
+        database = self.database
+        worktree = database.worktree
+        for data in [u'one\n', u'two\n', u'three\n']:
+            if self.root.has_handler('31.txt'):
+                self.root.del_handler('31.txt')
+            self.root.set_handler('31.txt', TextFile(data=data))
+            database.save_changes()
+        log = worktree.git_log(['31.txt'])
+        self.assertEqual(len(log), 3)
+        # Build the index again, a few commits at a time
+        history = worktree.history
+        for key in history.keys():
+            del history[key]
+        self.assertEqual(worktree.update_history(1), 1)
+        self.assertEqual(worktree.update_history(2), 2)
+        self.assertEqual(worktree.update_history(), 1)
+        self.assertEqual(worktree.update_history(), 0)
+        self.assertEqual(worktree.git_log(['31.txt']), log)
+
+
+    def test_git_log_reader(self):
+        database = self.database
+        self.root.set_handler('31.txt', TextFile(data=u'one\n'))
+        database.save_changes()
+        log = database.worktree.git_log(['31.txt'])
+        # The other processes read the index, but do not write it
+        worktree = RODatabase('fables').worktree
+        self.assertEqual(worktree.history, None)
+        self.assertEqual(worktree.update_history(), 0)
+        self.assertEqual(worktree._get_history(['31.txt']) is None, False)
+        self.assertEqual(worktree.git_log(['31.txt']), log)
+
+
+    def test_exclusive(self):
+        database = self.database
+        database.exclusive = True
+        fables = self.root
+        fables.set_handler('31.txt', TextFile())
+        database.save_changes()
+        # Removed behind the back of the database: not seen
+        lfs.remove('fables/database/31.txt')
+        self.assertEqual(database.has_handler('31.txt'), True)
+        # Until it is notified
+        database.discard_handlers(['31.txt'])
+        self.assertEqual(database.has_handler('31.txt'), False)
+
+
+    def test_mimetypes(self):
+        database = self.database
+        mimetype = database.get_mimetype('30.txt')
+        self.assertEqual(database.mimetypes['30.txt'][1], mimetype)
+        # Saved with the transaction
+        self.root.set_handler('31.txt', TextFile())
+        database.save_changes()
+        self.assertEqual(lfs.exists('fables/mimetypes'), True)
+        # And loaded by the next database
+        database = RODatabase('fables')
+        self.assertEqual(database.mimetypes['30.txt'][1], mimetype)
+
+
+    def test_make_room(self):
+        database = self.database
+        keys = [ '%02d.txt' % x for x in range(10) ]
+        handlers = [ database.get_handler(x) for x in keys ]
+        for handler in handlers:
+            handler.to_str()
+        footprint = database.get_cache_footprint()
+        self.assert_(footprint > 0)
+        self.assertEqual(footprint, sum([ x.footprint
+                                          for x in database.cache.values() ]))
+        # Only the first handler is referenced
+        handler = handlers[0]
+        del handlers
+        # Memory budget
+        database.memory_max = footprint - handler.footprint
+        database.make_room()
+        self.assert_(database.get_cache_footprint() <= database.memory_max)
+        self.assert_(keys[0] in database.cache)
+        # The referenced handler has been moved to the end
+        database.memory_max = 0
+        database.make_room()
+        self.assertEqual(database.cache.keys(), [keys[0]])
+
+
+    def test_snapshot(self):
+        database = self.database
+        snapshot = SnapshotDatabase('fables')
+        self.assertEqual(snapshot.get_handler('30.txt').to_str(),
+                         database.get_handler('30.txt').to_str())
+        self.assert_('30.txt' in snapshot.get_handler_names(''))
+        # A new commit is not seen until the snapshot moves
+        self.root.set_handler('31.txt', TextFile())
+        database.save_changes()
+        self.assertEqual(snapshot.has_handler('31.txt'), False)
+        self.assertEqual(snapshot.set_commit(), True)
+        self.assertEqual(snapshot.has_handler('31.txt'), True)
+        self.assertEqual(snapshot.set_commit(), False)
+
+
+    def test_group_commit(self):
+        database = self.database
+        database.group_size = 3
+        database.group_commits = True
+        worktree = database.worktree
+        n = len(worktree.git_log())
+        # The transactions are recorded in the journal, not committed
+        self.root.set_handler('31.txt', TextFile())
+        database.save_changes()
+        self.root.set_handler('agenda/a.txt', TextFile())
+        database.save_changes()
+        self.assertEqual(len(worktree.git_log()), n)
+        self.assertEqual(len(database.journal.load()), 2)
+        # Aborting a transaction keeps the previous ones
+        self.root.set_handler('agenda/b.txt', TextFile())
+        database.abort_changes()
+        self.assertEqual(database.has_handler('31.txt'), True)
+        self.assertEqual(database.has_handler('agenda/a.txt'), True)
+        self.assertEqual(database.has_handler('agenda/b.txt'), False)
+        # The next database commits them
+        database = RWDatabase('fables', 20, 20)
+        log = worktree.git_log()
+        self.assertEqual(len(log), n + 1)
+        self.assertEqual(log[0]['message_short'], '2 transactions')
+        self.assertEqual(database.journal.load(), [])
+        self.assertEqual(database.has_handler('agenda/a.txt'), True)
+
+
+    def test_group_commit_lost_blob(self):
+        database = self.database
+        database.group_size = 3
+        database.group_commits = True
+        self.root.set_handler('31.txt', TextFile(data=u'one\n'))
+        database.save_changes()
+        # A crash lost the blob of a transaction
+        database.journal.append({
+            'author': None, 'date': None, 'message': 'lost',
+            'add': [('agenda/b.txt', '0' * 40)], 'rm': []})
+        # The database opens anyway, without the lost file
+        database = RWDatabase('fables', 20, 20)
+        self.assertEqual(database.journal.load(), [])
+        self.assertEqual(database.has_handler('31.txt'), True)
+        self.assertEqual(database.has_handler('agenda/b.txt'), False)
+
+
+    def test_group_commit_async(self):
+        # The catalog is written by the indexer process
+        self.database.catalog._db.close()
+        database = IndexingDatabase('fables', 20, 20, async_indexing=True,
+                                    group_size=3)
+        self.assertEqual(len(database.search(abspath='/31')), 0)
+        # Indexed, but not committed to git
+        database.docs = [{'abspath': '/31', 'about_wolf': True}]
+        database.get_handler('.').set_handler('31.txt', TextFile())
+        database.save_changes()
+        self.assertEqual(database.group_count, 1)
+        self.assertEqual(database.sync_catalog(10), True)
+        self.assertEqual(len(database.search(abspath='/31')), 1)
+        self.assertEqual(len(database.search(about_wolf=True)), 1)
+
+
+    def test_maintenance(self):
+        database = self.database
+        maintenance = Maintenance(database, loose_max=1)
+        self.assert_(maintenance.get_stats()['count'] > 0)
+        # Not with a transaction in flight
+        self.root.set_handler('31.txt', TextFile())
+        self.assertEqual(maintenance.update_tree_cache(), False)
+        database.save_changes()
+        self.assertEqual(maintenance.update_tree_cache(), True)
+        self.assertEqual(maintenance.is_running(), True)
+        maintenance.wait()
+        self.assertEqual(lfs.exists('fables/database/.git/index.maintenance'),
+                         False)
+        # The index of the history is kept up-to-date by the commits
+        self.assertEqual(maintenance.index_history(), 0)
+        # Repack and prune
+        maintenance.run()
+        self.assertEqual(maintenance.is_running(), True)
+        maintenance.wait()
+        stats = maintenance.get_stats()
+        self.assertEqual(stats['count'], 0)
+        self.assertEqual(stats['packs'], 1)
+        self.assert_(stats['in_pack'] > 0)
+
+
     def test_dot_git(self):
         fables = self.root
         self.assertRaises(ValueError, fables.del_handler, '.git')
@@ -442,6 +713,143 @@ class CatalogTestCase(TestCase):
         self.assertEqual(len(results), 2)
 
 
+    def test_iter_documents(self):
+        results = self.database.search(data=u'lion')
+        self.assertEqual(results.get_n_documents(), 5)
+        self.assertEqual(results.get_n_documents(exact=False,
+                                                 check_at_least=10), 5)
+        # Same documents, whatever the page size
+        expected = [ x.abspath
+                     for x in results.get_documents(sort_by='abspath') ]
+        for page_size in (1, 2, 5, 100):
+            documents = results.iter_documents(sort_by='abspath',
+                                               page_size=page_size)
+            documents = [ x.abspath for x in documents ]
+            self.assertEqual(documents, expected)
+        # Start & Size
+        documents = results.iter_documents(sort_by='abspath', start=1, size=3,
+                                           page_size=2)
+        documents = [ x.abspath for x in documents ]
+        self.assertEqual(documents, expected[1:4])
+
+
+    def test_facets(self):
+        results = self.database.search(name='hello')
+        facets = results.get_facets('lang', 'is_long', 'data')
+        self.assertEqual(facets['lang'], {'de': 1, 'en': 1, 'es': 1, 'fr': 1})
+        self.assertEqual(facets['is_long'], {False: 4})
+        # Not stored
+        self.assertEqual(facets['data'], {})
+
+
+    def test_cache(self):
+        database = self.database
+        catalog = database.catalog
+        catalog._clear_cache()
+        stats = catalog.get_cache_stats()
+        # Miss, then hit (the order of the atoms does not matter)
+        query1 = AndQuery(PhraseQuery('data', u'lion'),
+                          PhraseQuery('about_wolf', True))
+        query2 = AndQuery(PhraseQuery('about_wolf', True),
+                          PhraseQuery('data', u'lion'))
+        n = len(database.search(query1))
+        self.assertEqual(len(database.search(query2)), n)
+        new_stats = catalog.get_cache_stats()
+        self.assertEqual(new_stats['xquery_misses'],
+                         stats['xquery_misses'] + 1)
+        self.assertEqual(new_stats['xquery_hits'], stats['xquery_hits'] + 1)
+        self.assertEqual(new_stats['results_hits'],
+                         stats['results_hits'] + 1)
+        # Invalidation
+        catalog.unindex_document('03.txt')
+        self.assertEqual(catalog.get_cache_stats()['xquery_size'], 0)
+        self.assertEqual(len(database.search(data=u'lion')), 4)
+        catalog.abort_changes()
+        self.assertEqual(len(database.search(data=u'lion')), 5)
+
+
+    def test_cache_pages(self):
+        database = self.database
+        catalog = database.catalog
+        catalog._clear_cache()
+        results = database.search(data=u'lion')
+        # Every document: not cached
+        results.get_documents(sort_by='abspath')
+        size = catalog.get_cache_stats()['results_size']
+        results.get_documents(sort_by='abspath')
+        self.assertEqual(catalog.get_cache_stats()['results_size'], size)
+        # A small page: cached
+        page = results.get_documents(sort_by='abspath', size=2)
+        self.assertEqual(catalog.get_cache_stats()['results_size'],
+                         size + 1)
+        self.assertEqual(results.get_documents(sort_by='abspath', size=2),
+                         page)
+
+
+    def test_index_documents(self):
+        fables = lfs.open('fables/database')
+        documents = []
+        for name in fables.get_names():
+            _, ext, _ = FileName.decode(name)
+            if ext == 'txt':
+                abspath = fables.get_absolute_path(name)
+                documents.append(Document(abspath))
+
+        catalog = make_catalog('tests/catalog_bulk', Document.fields)
+        try:
+            n = catalog.index_documents(documents, batch_size=10)
+            self.assertEqual(n, len(documents))
+            catalog.save_changes()
+            # Same results as the catalog built one document at a time
+            catalog = Catalog('tests/catalog_bulk', Document.fields,
+                              read_only=True)
+            for word in [u'lion', u'mouse', u'wolf']:
+                xquery = catalog._query2xquery(PhraseQuery('data', word))
+                enquire = Enquire(catalog._db)
+                enquire.set_query(xquery)
+                mset = enquire.get_mset(0, 0, catalog._db.get_doccount())
+                expected = len(self.database.search(data=word))
+                self.assertEqual(mset.get_matches_estimated(), expected)
+        finally:
+            lfs.remove('tests/catalog_bulk')
+
+
+    def test_get_documents_fields(self):
+        results = self.database.search(data=u'lion')
+        expected = results.get_documents(sort_by='abspath')
+        documents = results.get_documents(sort_by='abspath',
+                                          fields=['abspath', 'count'])
+        self.assertEqual([ x.abspath for x in documents ],
+                         [ x.abspath for x in expected ])
+        self.assertEqual([ x.count for x in documents ],
+                         [ x.count for x in expected ])
+        # Only the given fields are loaded
+        self.assertRaises(AttributeError, getattr, documents[0], 'is_long')
+        # The field must be stored
+        self.assertRaises(ValueError, results.get_documents, fields=['data'])
+
+
+    def test_get_page(self):
+        results = self.database.search(AllQuery())
+        expected = [ x.abspath for x in results.get_documents() ]
+        # Many documents have no language, the cursor must go through
+        langs = [ x.lang for x in results.get_documents(fields=['lang']) ]
+        empty = [ x for x in langs if not x ]
+        self.assertEqual(0 < len(empty) < len(langs), True)
+        for reverse in (False, True):
+            for size in (1, 2, 3, 7):
+                documents = []
+                cursor = None
+                while True:
+                    page, cursor = results.get_page('lang', reverse,
+                                                    size=size, after=cursor)
+                    documents.extend([ x.abspath for x in page ])
+                    if cursor is None:
+                        break
+                # Every document, once
+                self.assertEqual(sorted(documents), sorted(expected))
+
+
     def test_AndQuery_empty(self):
         query = AndQuery()
         query.append(PhraseQuery('data', u'mouse'))
@@ -555,6 +963,279 @@ class CatalogTestCase(TestCase):
 
 
 
+class IndexQueueTestCase(TestCase):
+
+    def setUp(self):
+        # Silence the log system
+        logger = Logger(min_level=FATAL)
+        register_logger(logger, 'itools.database')
+        self.queue = IndexQueue('tests/catalog.queue')
+
+
+    def tearDown(self):
+        register_logger(None, 'itools.database')
+        for path in ['tests/catalog.queue', 'tests/catalog']:
+            if lfs.exists(path):
+                lfs.remove(path)
+
+
+    def test_queue(self):
+        queue = self.queue
+        values = {'abspath': '/a', 'title': {'en': u'A'}}
+        seq1 = queue.push('a' * 40, ['/b'], [values])
+        seq2 = queue.push('b' * 40, [], [])
+        self.assertEqual(queue.get_seqs(), [seq1, seq2])
+        self.assertEqual(queue.load(seq1), ('a' * 40, ['/b'], [values]))
+        # The sequence goes on after a restart
+        self.assertEqual(IndexQueue('tests/catalog.queue').last_seq, seq2)
+        # Consume
+        self.assertEqual(queue.is_done(seq1), False)
+        queue.remove(seq1)
+        self.assertEqual(queue.is_done(seq1), True)
+        self.assertEqual(queue.is_done(seq2), False)
+
+
+    def test_failures(self):
+        catalog = make_catalog('tests/catalog', Document_4.fields)
+        queue = self.queue
+        seq1 = queue.push(None, [], [None])
+        seq2 = queue.push('a' * 40, [], [{'abspath': '/a'}])
+        # The first failure stops the indexing
+        failures = {}
+        index_items(catalog, queue, failures, 2)
+        self.assertEqual(queue.get_seqs(), [seq1, seq2])
+        self.assertEqual(failures, {seq1: 1})
+        # The second one moves the item aside
+        index_items(catalog, queue, failures, 2)
+        self.assertEqual(queue.get_seqs(), [])
+        self.assertEqual(failures, {})
+        path = 'tests/catalog.queue/failed/%020d' % seq1
+        self.assertEqual(lfs.exists(path), True)
+        # The next items are indexed, but the last commit is not updated
+        self.assertEqual(queue.is_done(seq2), True)
+        self.assertEqual(catalog._db.get_doccount(), 1)
+        self.assertEqual(catalog.get_last_commit(), None)
+        self.assertEqual(queue.get_failed(), [seq1])
+        queue.push('b' * 40, [], [])
+        index_items(catalog, queue, failures, 2)
+        self.assertEqual(catalog.get_last_commit(), None)
+        # Until the failed items are done
+        queue.clear_failed()
+        seq4 = queue.push('c' * 40, [], [])
+        index_items(catalog, queue, failures, 2)
+        self.assertEqual(queue.is_done(seq4), True)
+        self.assertEqual(catalog.get_last_commit(), 'c' * 40)
+
+
+
+class ParsedCacheTestCase(TestCase):
+
+    def setUp(self):
+        # Silence the log system
+        logger = Logger(min_level=FATAL)
+        register_logger(logger, 'itools.database')
+
+
+    def tearDown(self):
+        register_logger(None, 'itools.database')
+        if lfs.exists('tests/parsed'):
+            lfs.remove('tests/parsed')
+
+
+    def test_cache(self):
+        cache = ParsedCache('tests/parsed')
+        cache.save('a' * 40, TextFile(data=u'hello'))
+        handler = object.__new__(TextFile)
+        self.assertEqual(cache.load('a' * 40, handler), True)
+        self.assertEqual(handler.data, u'hello')
+        self.assertEqual(handler.dirty, None)
+        self.assertEqual(cache.load('b' * 40, handler), False)
+
+
+    def test_prune(self):
+        cache = ParsedCache('tests/parsed')
+        cache.save('a' * 40, TextFile(data=u'hello'))
+        cache.save('b' * 40, TextFile(data=u'world'))
+        # Make the first entry 2 hours old
+        old = time() - 7200
+        utime(cache._get_path('a' * 40), (old, old))
+        self.assertEqual(cache.prune(3600), 1)
+        handler = object.__new__(TextFile)
+        self.assertEqual(cache.load('a' * 40, handler), False)
+        self.assertEqual(cache.load('b' * 40, handler), True)
+        # By folder
+        self.assertEqual(cache.get_folders(), ['aa', 'bb'])
+        self.assertEqual(cache.prune(0, ['aa']), 0)
+        self.assertEqual(cache.prune(-1, ['bb']), 1)
+
+
+    def test_errors(self):
+        # The cache cannot be written (its parent is a file), it is not used
+        cache = ParsedCache('tests/hello.txt/parsed')
+        cache.save('a' * 40, TextFile(data=u'hello'))
+        handler = object.__new__(TextFile)
+        self.assertEqual(cache.load('a' * 40, handler), False)
+
+
+
+class MetadataDatabase(HandlersDatabase):
+    """A database of itools.handlers, which knows the resource classes.
+    """
+
+    def get_resource_class(self, class_id):
+        return Fable
+
+
+
+class MetadataTestCase(TestCase):
+
+    def setUp(self):
+        with open('tests/fable.metadata', 'w') as file:
+            file.write('format:fable\nabout_wolf:1\n')
+
+
+    def tearDown(self):
+        lfs.remove('tests/fable.metadata')
+
+
+    def test_handlers_database(self):
+        # The databases of itools.handlers have no parsed cache
+        database = MetadataDatabase(fs=lfs)
+        metadata = database.get_handler('tests/fable.metadata', Metadata)
+        self.assertEqual(metadata.format, 'fable')
+        self.assertEqual(metadata.get_property('about_wolf').value, True)
+
+
+
+class PathSetTestCase(TestCase):
+
+    def setUp(self):
+        self.paths = PathSet(['a/b/c', 'a/b/d', 'a/e', 'f'])
+
+
+    def test_folders(self):
+        paths = self.paths
+        self.assertEqual(paths.has_folder(''), True)
+        self.assertEqual(paths.has_folder('a'), True)
+        self.assertEqual(paths.has_folder('a/b'), True)
+        self.assertEqual(paths.has_folder('a/e'), False)
+        self.assertEqual(paths.has_folder('ab'), False)
+
+
+    def test_names(self):
+        paths = self.paths
+        self.assertEqual(sorted(paths.get_names('')), ['a', 'f'])
+        self.assertEqual(sorted(paths.get_names('a')), ['b', 'e'])
+        self.assertEqual(paths.get_names('f'), [])
+
+
+    def test_subtree(self):
+        paths = self.paths
+        self.assertEqual(sorted(paths.get_subtree('a')),
+                         ['a/b/c', 'a/b/d', 'a/e'])
+        self.assertEqual(paths.get_subtree('a/b/c'), [])
+        self.assertEqual(len(paths.get_subtree('')), 4)
+
+
+    def test_discard(self):
+        paths = self.paths
+        paths.discard('a/b/c')
+        paths.discard('a/b/d')
+        self.assertEqual(paths.has_folder('a/b'), False)
+        self.assertEqual(sorted(paths.get_names('a')), ['e'])
+        self.assertRaises(KeyError, paths.remove, 'a/b/c')
+        paths.clear()
+        self.assertEqual(len(paths), 0)
+        self.assertEqual(paths.has_folder(''), False)
+
+
+
+class ReindexTestCase(TestCase):
+
+    def setUp(self):
+        # Silence the log system
+        logger = Logger(min_level=FATAL)
+        register_logger(logger, 'itools.database')
+        # Make database, with a resource for every fable (but the
+        # translations)
+        self.database = make_git_database('fables', 20, 20)
+        fables = lfs.open('fables/database')
+        for name in fables.get_names():
+            name, ext, lang = FileName.decode(name)
+            if ext == 'txt' and lang is None:
+                with fables.open('%s.metadata' % name, 'w') as file:
+                    file.write('format:%s\n' % Fable.class_id)
+        self.database.worktree.git_add('.')
+        self.database.worktree.git_commit('Initial commit')
+
+
+    def tearDown(self):
+        # Restore logging
+        register_logger(None, 'itools.database')
+        # Clean file-system
+        paths = ['fables/catalog', 'fables/catalog.new',
+                 'fables/catalog.shards', 'fables/database/.git',
+                 'fables/mimetypes', 'fables/parsed']
+        for path in paths:
+            if lfs.exists(path):
+                lfs.remove(path)
+        fables = lfs.open('fables/database')
+        for name in fables.get_names():
+            if name.endswith('.metadata'):
+                fables.remove(name)
+
+
+    def get_counts(self):
+        database = RODatabase('fables')
+        return [len(database.search()),
+                len(database.search(about_wolf=True)),
+                len(database.search(abspath='/03'))]
+
+
+    def test_reindex(self):
+        # Incremental
+        database = RODatabase('fables')
+        catalog = Catalog('fables/catalog', get_register_fields())
+        n = 0
+        for name in sorted(lfs.get_names('fables/database')):
+            if name.endswith('.metadata'):
+                catalog.index_document(database.get_resource('/' + name[:-9]))
+                n += 1
+        catalog.save_changes()
+        del catalog
+        counts = self.get_counts()
+        self.assertEqual(counts[0], n)
+        self.assertEqual(counts[2], 1)
+
+        # Parallel
+        self.assertEqual(reindex_catalog('fables', 2), n)
+        self.assertEqual(lfs.exists('fables/catalog.shards'), False)
+        self.assertEqual(lfs.exists('fables/catalog.new'), False)
+        self.assertEqual(self.get_counts(), counts)
+        # Up to date
+        catalog = Catalog('fables/catalog', get_register_fields())
+        head = self.database.worktree._resolve_reference('HEAD')
+        self.assertEqual(catalog.get_last_commit(),
+                         self.database.worktree.repo[head].hex)
+
+
+    def test_make_metadata(self):
+        metadata = make_metadata(Document.fields, ['en', 'fr'])
+        # Every worker computes the same assignment
+        self.assertEqual(metadata,
+                         make_metadata(dict(Document.fields), ['en', 'fr']))
+        # Multilingual fields
+        self.assertEqual(metadata['title_fr']['from'], 'title')
+        self.assert_('value' in metadata['title_fr'])
+        self.assert_('name_fr' not in metadata)
+        # Every field has its own prefix and value
+        prefixes = [ x['prefix'] for x in metadata.values() if 'prefix' in x ]
+        self.assertEqual(len(prefixes), len(set(prefixes)))
+        values = [ x['value'] for x in metadata.values() if 'value' in x ]
+        self.assertEqual(sorted(values), range(len(values)))
+
+
+
 class BugXapianTestCase(TestCase):
 
     def setUp(self):
@@ -624,6 +1305,42 @@ class Document(Resource):
 
 
 
+class IndexingDatabase(RWDatabase):
+    """Indexes the values in 'docs' with the next transaction.
+    """
+
+    docs = []
+
+
+    def _before_commit(self):
+        docs = [ (None, x) for x in self.docs ]
+        self.docs = []
+        return None, None, None, docs, []
+
+
+
+class Fable(Resource):
+
+    class_id = 'fable'
+
+    abspath = Field(datatype=String, indexed=True, stored=True)
+    about_wolf = Field(datatype=Boolean, indexed=True)
+
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+
+    def get_catalog_values(self):
+        database = self.metadata.database
+        path = '%s.txt' % str(self.abspath)[1:]
+        data = database.get_handler(path, TextFile)
+        data = data.to_str()
+        return {'abspath': str(self.abspath),
+                'about_wolf': re.search('wolf', data, re.I) is not None}
+
+
+
 class Document_4(Resource):
 
     fields = {'abspath': String(stored=True, indexed=True)}
@@ -15,14 +15,26 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from cStringIO import StringIO
+from threading import current_thread
 from unittest import TestCase, main
 
+# Import from pygobject
+from gobject import MainLoop, threads_init, timeout_add
+
 # Import from itools
+from itools.database import make_git_database, RODatabase
+from itools.fs import lfs
+from itools.log import Logger, register_logger, FATAL
 from itools.web import BaseView, WebServer
 from itools.web import Cookie, SetCookieDataType
+from itools.web.admission import AdmissionControl
 from itools.web.headers import ContentType, ContentDisposition, CookieDataType
 from itools.web.headers import read_token, read_quoted_string, read_parameter
 from itools.web.headers import read_parameters
+from itools.web.multipart import MultipartParser
+from itools.web.threads import ThreadPool
+from itools.web.utils import get_body_length, iter_body
 
 
 class ParsingTestCase(TestCase):
@@ -166,6 +178,298 @@ class CookieTestCase(TestCase):
 
 
 
+class MultipartTestCase(TestCase):
+
+    body = ('--XyZ\r\n'
+            'Content-Disposition: form-data; name="a"\r\n'
+            '\r\n'
+            'hello\r\n'
+            '--XyZ\r\n'
+            'Content-Disposition: form-data; name="a"\r\n'
+            '\r\n'
+            'world\r\n'
+            '--XyZ\r\n'
+            'Content-Disposition: form-data; name="file";'
+            ' filename="C:\\fables\\wolf.txt"\r\n'
+            'Content-Type: text/plain\r\n'
+            '\r\n'
+            'The wolf\r\n--XY and the lamb\r\n'
+            '--XyZ--\r\n')
+
+
+    def parse(self, size):
+        parser = MultipartParser('XyZ', spool_max=10)
+        body = self.body
+        for i in range(0, len(body), size):
+            parser.feed(body[i:i+size])
+        return parser.get_form()
+
+
+    def test_chunks(self):
+        for size in [1, 2, 5, 64, len(self.body)]:
+            form = self.parse(size)
+            self.assertEqual(form['a'], ['hello', 'world'])
+            filename, mimetype, file = form['file']
+            self.assertEqual(filename, 'wolf.txt')
+            self.assertEqual(mimetype, 'text/plain')
+            self.assertEqual(file.read(), 'The wolf\r\n--XY and the lamb')
+
+
+    def test_truncated(self):
+        parser = MultipartParser('XyZ')
+        parser.feed(self.body[:100])
+        self.assertRaises(ValueError, parser.get_form)
+
+
+
+class ResponseBodyTestCase(TestCase):
+
+    def test_file(self):
+        file = open('test_web.py')
+        self.assertEqual(get_body_length(file), len(file.read()))
+        file.seek(0)
+        chunks = list(iter_body(file, 1024))
+        self.assertEqual(''.join(chunks), open('test_web.py').read())
+        self.assert_(max([ len(x) for x in chunks ]) <= 1024)
+        self.assertEqual(file.closed, True)
+
+
+    def test_iterator(self):
+        body = StringIO('hello')
+        self.assertEqual(get_body_length(body), -1)
+        self.assertEqual(list(iter_body(body)), ['hello'])
+        self.assertEqual(list(iter_body([u'caf\xe9', 'x'])),
+                         ['caf\xc3\xa9', 'x'])
+
+
+    def test_error(self):
+        def generator():
+            yield 'hello'
+            raise ValueError
+        # The error is raised again, to abort the connection
+        body = iter_body(generator())
+        self.assertEqual(body.next(), 'hello')
+        self.assertRaises(ValueError, body.next)
+
+
+
+class AdmissionTestCase(TestCase):
+
+    def test_latency(self):
+        admission = AdmissionControl(alpha=0.5)
+        self.assertEqual(admission.get_latency('/a'), None)
+        admission.update('/a', 2.0)
+        self.assertEqual(admission.get_latency('/a'), 2.0)
+        admission.update('/a', 1.0)
+        self.assertEqual(admission.get_latency('/a'), 1.5)
+
+
+    def test_admit(self):
+        admission = AdmissionControl(requests_max=10, requests_busy=5,
+                                     latency_max=1.0, probe_rate=0)
+        admission.update('/slow', 3.0)
+        admission.update('/fast', 0.1)
+        # Not busy
+        self.assertEqual(admission.admit('/slow', 4), True)
+        # Busy
+        self.assertEqual(admission.admit('/slow', 5), False)
+        self.assertEqual(admission.admit('/fast', 5), True)
+        self.assertEqual(admission.admit('/new', 5), True)
+        # Overload
+        self.assertEqual(admission.admit('/fast', 10), False)
+        stats = admission.get_stats()
+        self.assertEqual(stats['degraded'], 1)
+        self.assertEqual(stats['rejected'], 1)
+
+
+    def test_probe(self):
+        admission = AdmissionControl(requests_max=10, requests_busy=5,
+                                     latency_max=1.0, probe_rate=1.0)
+        admission.update('/slow', 3.0)
+        # Busy: the slow path is probed
+        self.assertEqual(admission.admit('/slow', 5), True)
+        # Overload: never
+        self.assertEqual(admission.admit('/slow', 10), False)
+        stats = admission.get_stats()
+        self.assertEqual(stats['probed'], 1)
+        self.assertEqual(stats['degraded'], 0)
+
+
+
+class FakeServer(object):
+
+    thread_database_class = WebServer.thread_database_class
+    thread_cache_size = (4, 6)
+    open_thread_database = WebServer.__dict__['open_thread_database']
+
+    def __init__(self, database):
+        self.database = database
+        self.unpaused = []
+        self.latencies = {}
+
+
+    def pause_message(self, soup_message):
+        pass
+
+
+    def unpause_message(self, soup_message):
+        self.unpaused.append(soup_message)
+
+
+    def end_render(self, message_id, end=None):
+        self.latencies[message_id] = end
+
+
+
+class FakeMessage(object):
+    """Records the writes, and the threads they are done from (the reads
+    too).
+    """
+
+    def __init__(self):
+        self.status = None
+        self.body = None
+        self.threads = set()
+
+
+    def get_id(self):
+        self.threads.add(current_thread())
+        return id(self)
+
+
+    def get_method(self):
+        self.threads.add(current_thread())
+        return 'GET'
+
+
+    def get_host(self):
+        self.threads.add(current_thread())
+        return 'localhost'
+
+
+    def get_query(self):
+        self.threads.add(current_thread())
+        return None
+
+
+    def get_request_line(self):
+        self.threads.add(current_thread())
+        return 'GET / HTTP/1.1'
+
+
+    def get_headers(self):
+        self.threads.add(current_thread())
+        return [('Host', 'localhost'), ('Accept', 'text/plain')]
+
+
+    def get_body(self):
+        self.threads.add(current_thread())
+        return None
+
+
+    def set_status(self, status):
+        self.status = status
+        self.threads.add(current_thread())
+
+
+    def set_response(self, content_type, body):
+        self.body = body
+        self.threads.add(current_thread())
+
+
+
+class ThreadPoolTestCase(TestCase):
+
+    def setUp(self):
+        # Silence the log system
+        logger = Logger(min_level=FATAL)
+        register_logger(logger, 'itools.web')
+        threads_init()
+        self.database = make_git_database('fables', 20, 20)
+        self.database.worktree.git_add('.')
+        self.database.worktree.git_commit('Initial commit')
+
+
+    def tearDown(self):
+        register_logger(None, 'itools.web')
+        for path in ['fables/catalog', 'fables/database/.git',
+                     'fables/mimetypes']:
+            if lfs.exists(path):
+                lfs.remove(path)
+
+
+    def test_concurrent(self):
+        database = self.database
+        server = FakeServer(database)
+        pool = ThreadPool(server, 4, 100)
+
+        # Render in the threads
+        databases = set()
+        def callback(thread_database, soup_message, name):
+            databases.add(thread_database)
+            if name is None:
+                raise ValueError
+            # The request has been copied
+            if soup_message.get_header('accept') != 'text/plain':
+                raise ValueError
+            handler = thread_database.get_handler(name)
+            soup_message.set_status(200)
+            soup_message.set_response('text/plain', handler.to_str())
+
+        messages = []
+        for i in range(40):
+            message = FakeMessage()
+            name = '%02d.txt' % (i % 10)
+            self.assertEqual(pool.push(message, callback, name), True)
+            messages.append((message, name))
+        # A failure
+        failure = FakeMessage()
+        pool.push(failure, callback, None)
+
+        # Meanwhile, the main loop works with its own database
+        loop = MainLoop()
+        def main_loop():
+            for i in range(10):
+                database.get_handler('%02d.txt' % i)
+            database.make_room()
+            if len(server.unpaused) < 41:
+                return True
+            loop.quit()
+            return False
+        timeout_add(10, main_loop)
+        loop.run()
+
+        # Every thread has its own database
+        self.assertEqual(database in databases, False)
+        self.assertEqual(len(databases) <= 4, True)
+        for thread_database in databases:
+            self.assertEqual(type(thread_database), RODatabase)
+            self.assertEqual(thread_database.cache.size_max, 6)
+        # The message is only used from the main loop
+        main_thread = current_thread()
+        for message, name in messages:
+            self.assertEqual(message.threads, set([main_thread]))
+            self.assertEqual(message.status, 200)
+            data = open('fables/database/%s' % name).read()
+            self.assertEqual(message.body, data)
+        self.assertEqual(failure.threads, set([main_thread]))
+        self.assertEqual(failure.status, 500)
+        # The render time is recorded for every message
+        self.assertEqual(len(server.latencies), 41)
+        self.assertEqual(None in server.latencies.values(), False)
+        self.assertEqual(pool.is_pending(failure.get_id()), False)
+
+
+
+class WorkersTestCase(TestCase):
+
+    def test_restart_delay(self):
+        server = WebServer.__new__(WebServer)
+        delays = [ server.get_restart_delay(x) for x in range(1, 9) ]
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 32, 60, 60])
+
+
+
 #class MyRootView(BaseView):
 #    access = True
 #    def GET(self, resource, context):
@@ -0,0 +1,119 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the admission control of the web server: when it is
+too busy, the server answers "503 Service Unavailable" to some requests,
+instead of serving all of them slowly.
+"""
+
+# Import from the Standard Library
+from random import random
+
+# Import from itools
+from itools.core import LRUCache
+
+
+
+class AdmissionControl(object):
+    """Decides whether a request is served, from the number of requests
+    being served and the latency of the requested path:
+
+    - with 'requests_max' requests being served (or more), every new
+      request is rejected;
+    - with 'requests_busy' requests being served (or more), the requests to
+      the paths slower than 'latency_max' seconds are rejected, the other
+      requests go on; but for a random sample of them ('probe_rate', from 0
+      to 1), served to measure the latency again.
+
+    The latency of a path is the exponentially weighted moving average of
+    the time taken to render it, every new measure has the weight 'alpha'.
+    The latency of the 'paths_max' most recently served paths is kept.
+    """
+
+    def __init__(self, requests_max=100, requests_busy=None, latency_max=1.0,
+                 alpha=0.2, paths_max=10000, probe_rate=0.05):
+        self.requests_max = requests_max
+        if requests_busy is None:
+            requests_busy = requests_max / 2
+        self.requests_busy = requests_busy
+        self.latency_max = latency_max
+        self.alpha = alpha
+        self.probe_rate = probe_rate
+        # The latencies: {path: seconds}
+        self.latencies = LRUCache(paths_max, paths_max + paths_max / 10)
+        # Metrics
+        self.rejected = 0
+        self.degraded = 0
+        self.probed = 0
+
+
+    def admit(self, path, requests):
+        """Returns True if the request to the given path is to be served,
+        False otherwise.  The number of requests being served is given.
+        """
+        if requests < self.requests_busy:
+            return True
+
+        # Overload
+        if requests >= self.requests_max:
+            self.rejected += 1
+            return False
+
+        # Busy: only the fast paths
+        latency = self.latencies.get(path)
+        if latency is not None and latency > self.latency_max:
+            # Else the latency of the path would never be updated
+            if random() < self.probe_rate:
+                self.probed += 1
+                return True
+            self.degraded += 1
+            return False
+
+        return True
+
+
+    def update(self, path, seconds):
+        """Records the time taken to render a request to the given path.
+        """
+        latencies = self.latencies
+        latency = latencies.get(path)
+        if latency is None:
+            latencies[path] = seconds
+        else:
+            alpha = self.alpha
+            latencies[path] = alpha * seconds + (1 - alpha) * latency
+
+
+    def get_latency(self, path):
+        """Returns the latency of the given path in seconds, or None if it is
+        not known.
+        """
+        return self.latencies.get(path)
+
+
+    def get_stats(self):
+        """Returns a dict with the number of requests rejected because the
+        server was overloaded ('rejected'), or because it was busy and the
+        path slow ('degraded'); the number of requests to slow paths served
+        anyway to measure their latency ('probed'); and the number of paths
+        with a known latency ('paths').
+        """
+        return {
+            'rejected': self.rejected,
+            'degraded': self.degraded,
+            'probed': self.probed,
+            'paths': len(self.latencies)}
@@ -26,6 +26,7 @@ from copy import copy
 from datetime import datetime, timedelta
 from hashlib import sha224
 from sys import exc_clear
+from threading import local
 from types import FunctionType, MethodType
 from urllib import quote, unquote
 
@@ -42,13 +43,14 @@ from itools.log import Logger, log_error, log_warning
 from itools.uri import decode_query, get_reference, Path, Reference
 
 # Local imports
-from entities import Entity
-from exceptions import ClientError, NotModified, Forbidden, NotFound, Conflict
+from exceptions import BadRequest, ClientError, NotModified, Forbidden
+from exceptions import NotFound, Conflict
 from exceptions import NotImplemented, MethodNotAllowed, Unauthorized
 from exceptions import FormError
 from headers import get_type, Cookie, SetCookieDataType
 from messages import ERROR
-from utils import set_response
+from multipart import MultipartParser
+from utils import set_response, set_response_body
 from views import BaseView
 
 
@@ -60,6 +62,9 @@ class Context(prototype):
     status = None # response status
     mtime = None # Last-Modified
 
+    # The resources loaded again by 'set_database'
+    database_resources = ('root', 'site_root', 'resource', 'user')
+
 
     def init_context(self):
         soup_message = self.soup_message
@@ -114,6 +119,19 @@ class Context(prototype):
         self.site_root.before_traverse(self)  # Hook
 
 
+    def set_database(self, database):
+        """Moves the context to the given database, the resources it refers
+        to are loaded again from it (see 'database_resources').  Used by the
+        threads of the server, which have their own database.
+        """
+        self.database = database
+        for name in self.database_resources:
+            resource = getattr(self, name, None)
+            abspath = getattr(resource, 'abspath', None)
+            if abspath is not None:
+                setattr(self, name, database.get_resource(abspath))
+
+
     @proto_lazy_property
     def timestamp(self):
         return datetime.utcnow().replace(tzinfo=fixed_offset(0))
@@ -129,53 +147,37 @@ class Context(prototype):
 
     @proto_lazy_property
     def body(self):
-        # Case 1: nothing
+        # Case 1: multipart, parsed while received (see WebServer.start_body)
+        server = self.server
+        if server is not None:
+            parser = server.bodies.get(self.soup_message.get_id())
+            if parser is not None:
+                try:
+                    return parser.get_form()
+                except ValueError, error:
+                    raise BadRequest, str(error)
+
+        # Case 2: nothing
         body = self.soup_message.get_body()
         if not body:
             return {}
 
-        # Case 2: urlencoded
+        # Case 3: urlencoded
         content_type, type_parameters = self.get_header('content-type')
         if content_type == 'application/x-www-form-urlencoded':
             return decode_query(body)
 
-        # Case 3: multipart
+        # Case 4: multipart
         if content_type.startswith('multipart/'):
             boundary = type_parameters.get('boundary')
-            boundary = '--%s' % boundary
-            form = {}
-            for part in body.split(boundary)[1:-1]:
-                # Parse the entity
-                entity = Entity(string=part)
-                # Find out the parameter name
-                header = entity.get_header('Content-Disposition')
-                value, header_parameters = header
-                name = header_parameters['name']
-                # Load the value
-                body = entity.get_body()
-                if 'filename' in header_parameters:
-                    filename = header_parameters['filename']
-                    if filename:
-                        # Strip the path (for IE).
-                        filename = filename.split('\\')[-1]
-                        # Default content-type, see
-                        # http://tools.ietf.org/html/rfc2045#section-5.2
-                        if entity.has_header('content-type'):
-                            mimetype = entity.get_header('content-type')[0]
-                        else:
-                            mimetype = 'text/plain'
-                        form[name] = filename, mimetype, body
-                else:
-                    if name not in form:
-                        form[name] = body
-                    else:
-                        if isinstance(form[name], list):
-                            form[name].append(body)
-                        else:
-                            form[name] = [form[name], body]
-            return form
-
-        # Case 4: This is useful for REST services
+            parser = MultipartParser(boundary)
+            try:
+                parser.feed(body)
+                return parser.get_form()
+            except ValueError, error:
+                raise BadRequest, str(error)
+
+        # Case 5: This is useful for REST services
         # XXX Should just return the body as a string? deserialized?
         return {'body': body}
 
@@ -635,6 +637,10 @@ status2name = {
 
 class RequestMethod(object):
 
+    # The view may be rendered in a thread (see WebServer.start_threads)
+    threaded = False
+
+
     @classmethod
     def find_resource(cls, context):
         """Sets 'context.resource' to the requested resource if it exists.
@@ -748,7 +754,8 @@ class RequestMethod(object):
             location = str(location)
             context.soup_message.set_header('Location', location)
         else:
-            context.soup_message.set_response(context.content_type, body)
+            set_response_body(context.soup_message, context.content_type,
+                              body)
 
 
     @classmethod
@@ -795,7 +802,6 @@ class RequestMethod(object):
             exc_clear()
 
         # (2) Always deserialize the query
-        resource = context.resource
         view = context.view
         try:
             context.query = view.get_query(context)
@@ -809,6 +815,39 @@ class RequestMethod(object):
             # GET, POST...
             method = getattr(view, cls.method_name)
 
+        # Render in a thread, if possible
+        server = context.server
+        if server is not None and server.thread_pool is not None:
+            if method is not None and cls.threaded and view.threaded:
+                pool = server.thread_pool
+                if not pool.push(context.soup_message, cls.render_in_thread,
+                                 context, method):
+                    # 503 Service Unavailable
+                    server.reject(context.soup_message)
+                return
+
+        cls.render(context, method)
+
+
+    @classmethod
+    def render_in_thread(cls, database, soup_message, context, method):
+        # The database and the soup message are only used from the main
+        # loop, use the read-only database of the thread and the proxy of
+        # the message (see itools.web.threads)
+        context.soup_message = soup_message
+        if database is not None:
+            context.set_database(database)
+        set_context(context)
+        try:
+            cls.render(context, method, transaction=False)
+        finally:
+            set_context(None)
+
+
+    @classmethod
+    def render(cls, context, method, transaction=True):
+        resource = context.resource
+
         # (3) Render
         if method is not None:
             try:
@@ -827,7 +866,8 @@ class RequestMethod(object):
                     context.status = 200
 
         # (4) Commit the transaction
-        cls.commit_transaction(context)
+        if transaction:
+            cls.commit_transaction(context)
 
         # (5) Build response, when postponed (useful for POST methods)
         if isinstance(context.entity, (FunctionType, MethodType)):
@@ -835,7 +875,8 @@ class RequestMethod(object):
                 context.entity = context.entity(context.resource, context)
             except Exception:
                 cls.internal_server_error(context)
-            context.database.abort_changes()
+            if transaction:
+                context.database.abort_changes()
 
         # (6) After Traverse hook
         try:
@@ -851,6 +892,9 @@ class RequestMethod(object):
 
 class SafeMethod(RequestMethod):
 
+    threaded = True
+
+
     @classmethod
     def check_transaction(cls, context):
         return False
@@ -1042,18 +1086,17 @@ class DELETE(RequestMethod):
 
 
 ###########################################################################
-# Keep the context globally
+# Keep the context globally (one per thread)
 ###########################################################################
-context = None
+_local = local()
 
 
 def set_context(ctx):
-    global context
-    context = ctx
+    _local.context = ctx
 
 
 def get_context():
-    return context
+    return getattr(_local, 'context', None)
 
 
 #######################################################################
@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements a parser of 'multipart/form-data' bodies, fed chunk
+by chunk as they are received.  The memory used is proportional to the size
+of the chunks: the files are written to temporary files (in memory while
+they are smaller than 'spool_max').
+"""
+
+# Import from the Standard Library
+from cStringIO import StringIO
+from tempfile import SpooledTemporaryFile
+
+# Import from itools
+from entities import read_headers
+
+
+# The states of the parser
+PREAMBLE, DELIMITER, HEADERS, BODY, EPILOGUE = range(5)
+
+
+
+class MultipartParser(object):
+
+    # The maximum size of the headers of a part
+    headers_max = 65536
+
+
+    def __init__(self, boundary, spool_max=1048576):
+        # The first delimiter may come without the leading CRLF
+        self.delimiter = '\r\n--%s' % boundary
+        self.buffer = '\r\n'
+        self.state = PREAMBLE
+        self.spool_max = spool_max
+        self.error = None
+        # The part being parsed
+        self.name = None
+        self.filename = None
+        self.mimetype = None
+        self.data = None
+        # The result
+        self.form = {}
+
+
+    def feed(self, data):
+        """Parses the given chunk of the body.  Raises ValueError if the body
+        is not well formed.
+        """
+        if self.error is not None:
+            raise ValueError, self.error
+
+        try:
+            self.buffer += data
+            self._parse()
+        except ValueError, error:
+            self.error = str(error)
+            raise
+
+
+    def _parse(self):
+        delimiter = self.delimiter
+        keep = len(delimiter) - 1
+        while True:
+            buffer = self.buffer
+            state = self.state
+            if state == PREAMBLE or state == BODY:
+                # Look for the next delimiter
+                index = buffer.find(delimiter)
+                if index == -1:
+                    # Keep what may be the beginning of a delimiter
+                    if len(buffer) > keep:
+                        if state == BODY:
+                            self._write(buffer[:-keep])
+                        self.buffer = buffer[-keep:]
+                    return
+                if state == BODY:
+                    self._write(buffer[:index])
+                    self._end_part()
+                self.buffer = buffer[index + len(delimiter):]
+                self.state = DELIMITER
+            elif state == DELIMITER:
+                # The last delimiter, or the end of the delimiter line
+                if buffer[:2] == '--':
+                    self.buffer = ''
+                    self.state = EPILOGUE
+                    return
+                index = buffer.find('\r\n')
+                if index == -1:
+                    if len(buffer) > 1024:
+                        raise ValueError, 'bad delimiter line'
+                    return
+                self.buffer = buffer[index + 2:]
+                self.state = HEADERS
+            elif state == HEADERS:
+                index = buffer.find('\r\n\r\n')
+                if index == -1:
+                    if len(buffer) > self.headers_max:
+                        raise ValueError, 'headers too long'
+                    return
+                self._start_part(buffer[:index + 4])
+                self.buffer = buffer[index + 4:]
+                self.state = BODY
+            else:
+                # Epilogue: ignore
+                self.buffer = ''
+                return
+
+
+    def _start_part(self, data):
+        headers = read_headers(StringIO(data))
+        header = headers.get('content-disposition')
+        if header is None:
+            raise ValueError, 'expected the Content-Disposition header'
+        value, parameters = header
+        if 'name' not in parameters:
+            raise ValueError, 'expected the name of the form field'
+
+        self.name = parameters['name']
+        if 'filename' in parameters:
+            # Strip the path (for IE).
+            self.filename = parameters['filename'].split('\\')[-1]
+            # Default content-type, see
+            # http://tools.ietf.org/html/rfc2045#section-5.2
+            if 'content-type' in headers:
+                self.mimetype = headers['content-type'][0]
+            else:
+                self.mimetype = 'text/plain'
+            self.data = SpooledTemporaryFile(self.spool_max)
+        else:
+            self.filename = None
+            self.data = []
+
+
+    def _write(self, data):
+        if type(self.data) is list:
+            self.data.append(data)
+        else:
+            self.data.write(data)
+
+
+    def _end_part(self):
+        form = self.form
+        name = self.name
+        data = self.data
+        self.data = None
+        # A file
+        if self.filename is not None:
+            if self.filename:
+                data.seek(0)
+                form[name] = self.filename, self.mimetype, data
+            else:
+                data.close()
+            return
+
+        # A field
+        body = ''.join(data)
+        if name not in form:
+            form[name] = body
+        elif isinstance(form[name], list):
+            form[name].append(body)
+        else:
+            form[name] = [form[name], body]
+
+
+    def get_form(self):
+        """Returns the form, once the whole body has been parsed.  The files
+        are given as a tuple (filename, mimetype, file object).
+        """
+        if self.error is not None:
+            raise ValueError, self.error
+        if self.state != EPILOGUE:
+            raise ValueError, 'unexpected end of the body'
+        return self.form
+
+
+    def close(self):
+        """Releases the temporary files.
+        """
+        if self.data is not None and type(self.data) is not list:
+            self.data.close()
+        for value in self.form.itervalues():
+            if type(value) is tuple:
+                value[2].close()
@@ -21,14 +21,27 @@
 
 # Import from the Standard Library
 from datetime import timedelta
-from time import strftime
+from errno import EINTR
+from os import _exit, dup2, fork, kill, wait, WEXITSTATUS, WIFEXITED
+from signal import signal, SIG_DFL, SIG_IGN, SIGHUP, SIGINT, SIGTERM
+from socket import socket, AF_INET, SOCK_STREAM
+from time import sleep, strftime, time
+
+# Import from pygobject
+from gobject import MainLoop, threads_init, timeout_add
 
 # Import from itools
+from itools.database import RODatabase
 from itools.i18n import init_language_selector
-from itools.log import Logger, register_logger, log_info
+from itools.log import Logger, register_logger, log_error, log_info
+from admission import AdmissionControl
 from context import select_language
 from context import WebLogger
+from headers import ContentType
+from multipart import MultipartParser
 from soup import SoupServer
+from threads import ThreadPool
+from utils import set_response
 
 
 class WebServer(SoupServer):
@@ -39,6 +52,33 @@ class WebServer(SoupServer):
     database = None
     session_timeout = timedelta(0)
 
+    # The pool of threads where the views are rendered (see 'start_threads')
+    thread_pool = None
+    # The class of the databases of the threads, and the size of their cache
+    # (see 'open_thread_database')
+    thread_database_class = RODatabase
+    thread_cache_size = (480, 520)
+
+    # The admission control (see 'start_admission_control'), and the value
+    # of the Retry-After header of the 503 responses (in seconds)
+    admission = None
+    retry_after = 10
+
+    # The files uploaded are kept in memory up to this size (in bytes)
+    spool_max = 1048576
+
+    # Pre-fork mode: a worker being stopped waits this long (in seconds) for
+    # the requests it is serving
+    graceful_timeout = 30
+    # Pre-fork mode: a worker that fails within 'restart_window' seconds is
+    # replaced after a delay, doubled on every failure in a row (from
+    # 'restart_delay' to 'restart_delay_max' seconds); after
+    # 'restart_failures_max' such failures the server gives up
+    restart_window = 10
+    restart_delay = 1
+    restart_delay_max = 60
+    restart_failures_max = 5
+
 
     def __init__(self, root, access_log=None, event_log=None):
         super(WebServer, self).__init__()
@@ -53,6 +93,10 @@ class WebServer(SoupServer):
 
         # Useful the current uploads stats
         self.upload_stats = {}
+        # The bodies being received: {message id: MultipartParser}
+        self.bodies = {}
+        # The requests being served: {message id: (path, start time)}
+        self.requests = {}
 
 
     def log_access(self, host, request_line, status_code, body_length):
@@ -74,6 +118,57 @@ class WebServer(SoupServer):
         print 'Listen %s:%d' % (address, port)
 
 
+    def add_handler(self, path, callback):
+        def handler(soup_message, path):
+            admission = self.admission
+            if admission is not None:
+                if not admission.admit(path, len(self.requests)):
+                    return self.reject(soup_message)
+            message_id = soup_message.get_id()
+            self.requests[message_id] = (path, time())
+            callback(soup_message, path)
+            # Rendered, unless it goes on in a thread (see ThreadPool.reply)
+            pool = self.thread_pool
+            if pool is None or not pool.is_pending(message_id):
+                self.end_render(message_id)
+
+        super(WebServer, self).add_handler(path, handler)
+
+
+    def end_render(self, message_id, end=None):
+        """Called once the response is ready, before it is sent: the time
+        taken since the request was received, up to 'end' (defaults to
+        now), is the latency of the path for the admission control.
+        """
+        admission = self.admission
+        if admission is None:
+            return
+
+        request = self.requests.get(message_id)
+        if request is None:
+            return
+
+        path, start = request
+        if end is None:
+            end = time()
+        admission.update(path, end - start)
+
+
+    def end_request(self, message_id):
+        """This function is called by the C part of your server, once the
+        response has been sent, or the connection lost.
+        """
+        self.requests.pop(message_id, None)
+
+
+    def reject(self, soup_message):
+        """Answers "503 Service Unavailable", for when the server is too
+        busy.
+        """
+        set_response(soup_message, 503)
+        soup_message.set_header('Retry-After', str(self.retry_after))
+
+
     def set_upload_stats(self, upload_id, uploaded_size, total_size):
         """This function is called by the C part of your server.
         """
@@ -83,12 +178,290 @@ class WebServer(SoupServer):
             self.upload_stats[upload_id] = (uploaded_size, total_size)
 
 
+    def start_body(self, message_id, content_type):
+        """This function is called by the C part of your server, once the
+        headers of a POST or PUT request have been received.  Returns True
+        if the body is to be parsed while it is received (see 'feed_body'),
+        False if it is to be kept in memory.
+        """
+        try:
+            value, parameters = ContentType.decode(content_type)
+        except Exception:
+            return False
+
+        boundary = parameters.get('boundary')
+        if value != 'multipart/form-data' or not boundary:
+            return False
+
+        self.bodies[message_id] = MultipartParser(boundary, self.spool_max)
+        return True
+
+
+    def feed_body(self, message_id, data):
+        """This function is called by the C part of your server, for every
+        chunk of the body.
+        """
+        parser = self.bodies.get(message_id)
+        if parser is None or parser.error is not None:
+            return
+
+        try:
+            parser.feed(data)
+        except ValueError:
+            # The error will be reported by Context.body
+            pass
+        except Exception:
+            log_error('Failed to parse the request body', domain='itools.web')
+            parser.error = 'internal error'
+
+
+    def end_body(self, message_id):
+        """This function is called by the C part of your server, once the
+        response has been sent.
+        """
+        parser = self.bodies.pop(message_id, None)
+        if parser is not None:
+            parser.close()
+
+
     def stop(self):
         super(WebServer, self).stop()
         if self.access_log:
             self.access_log_file.close()
 
 
+    def start_threads(self, size, queue_max=100):
+        """Renders the views in a pool of 'size' threads, instead of in the
+        main loop.  Only the views with 'threaded = True' are concerned, and
+        only for the GET and HEAD methods.  When 'queue_max' requests are
+        already waiting for a thread, the next ones are answered with
+        "503 Service Unavailable".
+
+        Threads are off by default.  Every thread renders the views with its
+        own read-only database (see 'open_thread_database' and
+        'Context.set_database'), which sees the changes once they are
+        committed.
+        """
+        threads_init()
+        self.thread_pool = ThreadPool(self, size, queue_max)
+
+
+    def open_thread_database(self):
+        """Returns a new database for a thread of the pool, on the database
+        of the server: an instance of 'thread_database_class' (to be set by
+        the applications with their own database classes), with a cache of
+        'thread_cache_size' handlers.  Returns None if the server has no
+        database.
+        """
+        database = self.database
+        if database is None:
+            return None
+
+        size_min, size_max = self.thread_cache_size
+        return self.thread_database_class(database.path, size_min, size_max)
+
+
+    def start_admission_control(self, requests_max=100, requests_busy=None,
+                                latency_max=1.0, retry_after=10,
+                                probe_rate=0.05):
+        """Answers "503 Service Unavailable" when the server is too busy,
+        with the header "Retry-After: <retry_after>":
+
+        - to every request, when 'requests_max' requests are being served;
+        - to the requests to the paths slower than 'latency_max' seconds
+          (on average), when 'requests_busy' requests are being served
+          (defaults to half 'requests_max'), but for a sample of them
+          ('probe_rate') that keeps their latency up to date.
+
+        See 'AdmissionControl', and 'get_load' for the metrics.
+        """
+        self.admission = AdmissionControl(requests_max, requests_busy,
+                                          latency_max, probe_rate=probe_rate)
+        self.retry_after = retry_after
+
+
+    def get_load(self):
+        """Returns a dict with the number of requests being served
+        ('requests'), waiting for a thread ('queued'), and the metrics of
+        the thread pool and of the admission control, if enabled.
+        """
+        load = {'requests': len(self.requests), 'queued': 0}
+        if self.thread_pool is not None:
+            stats = self.thread_pool.get_stats()
+            load['queued'] = stats['queued']
+            load['threads'] = stats
+        if self.admission is not None:
+            load['admission'] = self.admission.get_stats()
+        return load
+
+
+    #######################################################################
+    # Pre-fork mode
+    #######################################################################
+    def run_workers(self, n):
+        """Pre-fork mode, to be called after 'listen' instead of running the
+        main loop.  Forks 'n' worker processes, every one accepts connections
+        on the socket inherited from this process and runs the main loop.
+        This process does not serve requests, it only supervises the workers:
+
+        - a worker that dies is replaced by a new one; if it failed shortly
+          after being started, the new one is forked after a delay (see
+          'get_restart_delay'), and after 'restart_failures_max' such
+          failures in a row the workers are stopped and RuntimeError is
+          raised;
+        - on SIGHUP the workers are replaced, gracefully (see 'stop_worker');
+        - on SIGTERM or SIGINT the workers are stopped, gracefully, and this
+          method returns.
+
+        The new workers are forks of this process, so they run the code it
+        has already loaded: SIGHUP does not pick up new code, to upgrade the
+        server must be restarted.
+
+        The workers share nothing, so this mode is meant for read-only
+        databases: changes made by a worker are not seen by the others.
+        """
+        self.workers = {}
+        self.workers_n = n
+        self.reload = False
+        self.stopping = False
+
+        def on_reload(signum, frame):
+            self.reload = True
+
+        def on_stop(signum, frame):
+            self.stopping = True
+
+        signal(SIGHUP, on_reload)
+        signal(SIGTERM, on_stop)
+        signal(SIGINT, on_stop)
+
+        # Start
+        for i in range(n):
+            self.fork_worker()
+
+        # Supervise
+        stopping = False
+        failures = 0
+        while self.workers:
+            # Signals
+            if self.stopping and not stopping:
+                stopping = True
+                for pid in self.workers:
+                    kill(pid, SIGTERM)
+            elif self.reload:
+                self.reload = False
+                log_info('Reload: replace the workers', domain='itools.web')
+                old_workers = self.workers
+                self.workers = {}
+                for i in range(n):
+                    self.fork_worker()
+                for pid in old_workers:
+                    kill(pid, SIGTERM)
+
+            # Wait for a worker to die
+            try:
+                pid, status = wait()
+            except OSError, error:
+                if error.errno == EINTR:
+                    continue
+                raise
+
+            if pid not in self.workers:
+                # Replaced by a reload
+                continue
+            started = self.workers.pop(pid)
+            if stopping:
+                continue
+            if WIFEXITED(status) and WEXITSTATUS(status) == 0:
+                self.fork_worker()
+                continue
+
+            # Failed
+            if time() - started >= self.restart_window:
+                failures = 0
+            failures += 1
+            if failures > self.restart_failures_max:
+                log_error('Worker %d died (status %d), %d failures in a row,'
+                          ' give up' % (pid, status, failures - 1),
+                          domain='itools.web')
+                self.stopping = True
+                continue
+            delay = self.get_restart_delay(failures)
+            log_error('Worker %d died (status %d), replace it in %d seconds'
+                      % (pid, status, delay), domain='itools.web')
+            # The sleep is interrupted by the signals
+            deadline = time() + delay
+            while not self.stopping and time() < deadline:
+                sleep(deadline - time())
+            if not self.stopping:
+                self.fork_worker()
+
+        # Restore the default signal handlers
+        signal(SIGHUP, SIG_DFL)
+        signal(SIGTERM, SIG_DFL)
+        signal(SIGINT, SIG_DFL)
+
+        if failures > self.restart_failures_max:
+            raise RuntimeError, 'the workers keep failing'
+
+
+    def get_restart_delay(self, failures):
+        """Returns the delay (in seconds) before replacing a worker that
+        failed shortly after being started, given the number of such failures
+        in a row (from 1).
+        """
+        delay = self.restart_delay * 2 ** (failures - 1)
+        return min(delay, self.restart_delay_max)
+
+
+    def fork_worker(self):
+        pid = fork()
+        if pid:
+            # Master
+            self.workers[pid] = time()
+            return pid
+
+        # Worker
+        loop = MainLoop()
+        signal(SIGHUP, SIG_IGN)
+        signal(SIGINT, SIG_IGN)
+        signal(SIGTERM, lambda signum, frame: self.stop_worker(loop))
+        status = 0
+        try:
+            loop.run()
+        except Exception:
+            log_error('Worker failed', domain='itools.web')
+            status = 1
+        _exit(status)
+
+
+    def stop_worker(self, loop):
+        """Called in a worker when it receives SIGTERM.  The worker stops
+        accepting connections, ends the requests it is serving (for at most
+        'graceful_timeout' seconds), and exits.
+        """
+        # Stop accepting connections.  The listening socket is shared with
+        # the other workers, so it cannot be closed or shut down: instead
+        # its file descriptor is replaced by a socket nobody connects to.
+        fd = self.get_fd()
+        if fd != -1:
+            idle = socket(AF_INET, SOCK_STREAM)
+            idle.bind(('127.0.0.1', 0))
+            idle.listen(1)
+            dup2(idle.fileno(), fd)
+            idle.close()
+
+        # Wait for the requests being served
+        deadline = time() + self.graceful_timeout
+        def check():
+            if self.requests and time() < deadline:
+                return True
+            loop.quit()
+            return False
+
+        timeout_add(100, check)
+
+
     def set_context(self, path, context):
         context = context(server=self, mount_path=path)
         self.add_handler(path, context.handle_request)
@@ -173,9 +173,15 @@ got_chunk_callback (SoupMessage * s_msg, SoupBuffer * chunk,
   unsigned int id, uploaded_size, total_size;
   PyObject *p_result;
   PyObject *p_server = (PyObject *) user_data;
-
-  /* Get uploaded_size and total_size */
-  uploaded_size = (unsigned int) s_msg->request_body->length;
+  PyGILState_STATE gstate;
+
+  /* Get uploaded_size and total_size (the request body may not be
+   * accumulated, see got_headers_callback) */
+  uploaded_size = GPOINTER_TO_UINT (g_object_get_data (G_OBJECT (s_msg),
+                                                       "uploaded-size"));
+  uploaded_size += (unsigned int) chunk->length;
+  g_object_set_data (G_OBJECT (s_msg), "uploaded-size",
+                     GUINT_TO_POINTER (uploaded_size));
   total_size = (unsigned int)
     soup_message_headers_get_content_length (s_msg->request_headers);
 
@@ -183,6 +189,7 @@ got_chunk_callback (SoupMessage * s_msg, SoupBuffer * chunk,
   id = get_upload_id (s_msg);
 
   /* And finally call the "set_upload_stats" method */
+  gstate = PyGILState_Ensure ();
   p_result =
     PyObject_CallMethod (p_server, "set_upload_stats", "III", id,
                          uploaded_size, total_size);
@@ -195,17 +202,79 @@ got_chunk_callback (SoupMessage * s_msg, SoupBuffer * chunk,
       abort ();
     }
   Py_DECREF (p_result);
+  PyGILState_Release (gstate);
+}
+
+
+/* The body is passed to Python chunk by chunk, instead of being
+ * accumulated in memory */
+static void
+body_chunk_callback (SoupMessage * s_msg, SoupBuffer * chunk,
+                     gpointer user_data)
+{
+  PyObject *p_result;
+  PyObject *p_server = (PyObject *) user_data;
+  PyGILState_STATE gstate;
+
+  gstate = PyGILState_Ensure ();
+  p_result = PyObject_CallMethod (p_server, "feed_body", "ks#",
+                                  (unsigned long) s_msg, chunk->data,
+                                  (int) chunk->length);
+  /* The Python callback should never fail, it is its responsibility to catch
+   * and handle exceptions */
+  if (p_result == NULL)
+    {
+      printf ("ERROR! Python's feed_body failed, this should never happen\n");
+      abort ();
+    }
+  Py_DECREF (p_result);
+  PyGILState_Release (gstate);
 }
 
 
-/* Just useful for the upload percent computation */
 static void
 got_headers_callback (SoupMessage * s_msg, gpointer user_data)
 {
   unsigned int id;
+  const char *content_type;
+  PyObject *p_result;
+  PyObject *p_server = (PyObject *) user_data;
+  PyGILState_STATE gstate;
 
+  /* Just for POST and PUT */
+  if (s_msg->method == NULL || (strcmp (s_msg->method, "POST") != 0 &&
+                                strcmp (s_msg->method, "PUT") != 0))
+    return;
+
+  /* Ask the server whether to stream the body */
+  content_type = soup_message_headers_get_one (s_msg->request_headers,
+                                               "Content-Type");
+  if (content_type != NULL)
+    {
+      gstate = PyGILState_Ensure ();
+      p_result = PyObject_CallMethod (p_server, "start_body", "ks",
+                                      (unsigned long) s_msg, content_type);
+      if (p_result == NULL)
+        {
+          printf (
+          "ERROR! Python's start_body failed, this should never happen\n");
+          abort ();
+        }
+      if (PyObject_IsTrue (p_result))
+        {
+          soup_message_body_set_accumulate (s_msg->request_body, FALSE);
+          g_signal_connect (s_msg, "got-chunk",
+                            G_CALLBACK (body_chunk_callback), user_data);
+          g_object_set_data (G_OBJECT (s_msg), "streamed-body",
+                             GUINT_TO_POINTER (1));
+        }
+      Py_DECREF (p_result);
+      PyGILState_Release (gstate);
+    }
+
+  /* Just useful for the upload percent computation */
   /* Just for POST */
-  if (s_msg->method == NULL || strcmp (s_msg->method, "POST") != 0)
+  if (strcmp (s_msg->method, "POST") != 0)
     return;
 
   /* if id == 0 => upload_id is not detected */
@@ -255,6 +324,15 @@ PyMessage_get_request_line (PyMessage * self, PyObject * args,
 }
 
 
+static PyObject *
+PyMessage_get_id (PyMessage * self, PyObject * args, PyObject * kwdict)
+{
+  /* The same id is given to the "start_body", "feed_body" and "end_body"
+   * methods of the server */
+  return PyLong_FromUnsignedLong ((unsigned long) self->s_msg);
+}
+
+
 static PyObject *
 PyMessage_get_body (PyMessage * self, PyObject * args, PyObject * kwdict)
 {
@@ -395,6 +473,162 @@ PyMessage_set_response (PyMessage * self, PyObject * args, PyObject * kwdict)
 }
 
 
+/* Streamed responses: the body is written chunk by chunk, the next chunk is
+ * taken from the Python iterator once the previous one has been written */
+static void
+write_next_chunk (SoupMessage * s_msg, PyObject * p_iter)
+{
+  PyObject *p_chunk;
+  char *data;
+  Py_ssize_t length;
+  goffset *remaining;
+  SoupSocket *s_socket;
+  gboolean failed = FALSE;
+
+  /* The bytes left to write, if the Content-Length has been given */
+  remaining = (goffset *) g_object_get_data (G_OBJECT (s_msg),
+                                             "response-remaining");
+
+  while (1)
+    {
+      p_chunk = PyIter_Next (p_iter);
+      if (p_chunk == NULL)
+        break;
+
+      if (PyString_AsStringAndSize (p_chunk, &data, &length) == -1)
+        {
+          Py_DECREF (p_chunk);
+          break;
+        }
+
+      /* More than announced */
+      if (remaining != NULL && (goffset) length > *remaining)
+        {
+          Py_DECREF (p_chunk);
+          failed = TRUE;
+          break;
+        }
+
+      /* An empty chunk would end the body */
+      if (length > 0)
+        {
+          soup_message_body_append (s_msg->response_body, SOUP_MEMORY_COPY,
+                                    data, (gsize) length);
+          if (remaining != NULL)
+            *remaining -= (goffset) length;
+          Py_DECREF (p_chunk);
+          return;
+        }
+      Py_DECREF (p_chunk);
+    }
+
+  /* The end */
+  if (PyErr_Occurred ())
+    {
+      PyErr_Print ();
+      failed = TRUE;
+    }
+  else if (remaining != NULL && *remaining > 0)
+    failed = TRUE;
+
+  /* Release the iterator */
+  g_object_set_data (G_OBJECT (s_msg), "response-iter", NULL);
+
+  /* The headers have been sent, the client must not take the body for
+   * complete: abort the connection */
+  if (failed)
+    {
+      s_socket = (SoupSocket *) g_object_get_data (G_OBJECT (s_msg),
+                                                   "client-socket");
+      if (s_socket != NULL)
+        soup_socket_disconnect (s_socket);
+      return;
+    }
+
+  soup_message_body_complete (s_msg->response_body);
+}
+
+
+static void
+wrote_chunk_callback (SoupMessage * s_msg, gpointer user_data)
+{
+  PyObject *p_iter;
+  PyGILState_STATE gstate;
+
+  p_iter = (PyObject *) g_object_get_data (G_OBJECT (s_msg), "response-iter");
+  if (p_iter != NULL)
+    {
+      gstate = PyGILState_Ensure ();
+      write_next_chunk (s_msg, p_iter);
+      PyGILState_Release (gstate);
+    }
+}
+
+
+static void
+release_iter (gpointer data)
+{
+  PyGILState_STATE gstate;
+
+  gstate = PyGILState_Ensure ();
+  Py_DECREF ((PyObject *) data);
+  PyGILState_Release (gstate);
+}
+
+
+static PyObject *
+PyMessage_set_response_iter (PyMessage * self, PyObject * args,
+                             PyObject * kwdict)
+{
+  SoupMessage *s_msg = self->s_msg;
+  char *content_type;
+  PyObject *p_iterable, *p_iter;
+  long content_length = -1;
+  goffset *remaining;
+
+  if (!PyArg_ParseTuple (args, "sO|l", &content_type, &p_iterable,
+                         &content_length))
+    return NULL;
+
+  p_iter = PyObject_GetIter (p_iterable);
+  if (p_iter == NULL)
+    return NULL;
+
+  /* The headers */
+  soup_message_headers_replace (s_msg->response_headers, "Content-Type",
+                                content_type);
+  if (content_length >= 0)
+    {
+      soup_message_headers_set_content_length (s_msg->response_headers,
+                                               (goffset) content_length);
+      remaining = g_new (goffset, 1);
+      *remaining = (goffset) content_length;
+      g_object_set_data_full (G_OBJECT (s_msg), "response-remaining",
+                              remaining, g_free);
+    }
+  else if (soup_message_get_http_version (s_msg) == SOUP_HTTP_1_0)
+    soup_message_headers_set_encoding (s_msg->response_headers,
+                                       SOUP_ENCODING_EOF);
+  else
+    soup_message_headers_set_encoding (s_msg->response_headers,
+                                       SOUP_ENCODING_CHUNKED);
+
+  /* Do not keep in memory the chunks already written */
+  soup_message_body_set_accumulate (s_msg->response_body, FALSE);
+
+  /* The iterator is released with the message, or once consumed */
+  g_object_set_data_full (G_OBJECT (s_msg), "response-iter", p_iter,
+                          release_iter);
+  g_signal_connect (s_msg, "wrote-chunk", G_CALLBACK (wrote_chunk_callback),
+                    NULL);
+
+  /* The first chunk */
+  write_next_chunk (s_msg, p_iter);
+
+  Py_RETURN_NONE;
+}
+
+
 static PyObject *
 PyMessage_set_status (PyMessage * self, PyObject * args, PyObject * kwdict)
 {
@@ -416,6 +650,8 @@ static PyMethodDef PyMessage_methods[] = {
    "Returns the request line"},
   {"get_body", (PyCFunction) PyMessage_get_body, METH_NOARGS,
    "Returns the body of the request"},
+  {"get_id", (PyCFunction) PyMessage_get_id, METH_NOARGS,
+   "Returns the id of the message, as given to the server callbacks"},
   {"get_headers", (PyCFunction) PyMessage_get_headers, METH_NOARGS,
    "Returns all the headers of the request"},
   {"get_header", (PyCFunction) PyMessage_get_header, METH_VARARGS,
@@ -430,6 +666,8 @@ static PyMethodDef PyMessage_methods[] = {
    "Set the given response header"},
   {"set_response", (PyCFunction) PyMessage_set_response, METH_VARARGS,
    "Set the response body"},
+  {"set_response_iter", (PyCFunction) PyMessage_set_response_iter,
+   METH_VARARGS, "Set the response body, streamed from an iterator"},
   {"set_status", (PyCFunction) PyMessage_set_status, METH_VARARGS,
    "Set the response status code"},
   {NULL}                        /* Sentinel */
@@ -506,6 +744,9 @@ request_end_callback (SoupServer * s_server, SoupMessage * s_msg,
   unsigned int id;
   PyObject *p_result;
   PyObject *p_server = (PyObject *) user_data;
+  PyGILState_STATE gstate;
+
+  gstate = PyGILState_Ensure ();
 
   /* Just useful for the upload percent computation */
   /* Just for POST with upload_id=xxx */
@@ -526,8 +767,36 @@ request_end_callback (SoupServer * s_server, SoupMessage * s_msg,
       Py_DECREF (p_result);
     }
 
+  /* Release the streamed body */
+  if (g_object_get_data (G_OBJECT (s_msg), "streamed-body") != NULL)
+    {
+      p_result = PyObject_CallMethod (p_server, "end_body", "k",
+                                      (unsigned long) s_msg);
+      if (p_result == NULL)
+        {
+          printf (
+          "ERROR! Python's end_body failed, this should never happen\n");
+          abort ();
+        }
+      Py_DECREF (p_result);
+      g_object_set_data (G_OBJECT (s_msg), "streamed-body", NULL);
+    }
+
+  /* The request is finished (or aborted) */
+  p_result = PyObject_CallMethod (p_server, "end_request", "k",
+                                  (unsigned long) s_msg);
+  if (p_result == NULL)
+    {
+      printf (
+        "ERROR! Python's end_request failed, this should never happen\n");
+      abort ();
+    }
+  Py_DECREF (p_result);
+
   /* And call the logger */
   log_access (p_server, s_msg, s_client);
+
+  PyGILState_Release (gstate);
 }
 
 
@@ -540,18 +809,34 @@ s_server_callback (SoupServer * s_server, SoupMessage * s_msg,
   PyObject *p_callback;
   PyObject *p_args;
   PyObject *p_result;
+  PyGILState_STATE gstate;
+
+  /* The Python callback may run other threads (see WebServer.start_threads)
+   * so the GIL is released by the main loop */
+  gstate = PyGILState_Ensure ();
 
   /* Create the Python Message object */
   p_message = PyObject_New (PyMessage, &PyMessageType);
   if (!p_message)
-    return;
+    {
+      PyGILState_Release (gstate);
+      return;
+    }
 
   p_message->s_msg = s_msg;
 
+  /* To abort the connection if a streamed body fails (see
+   * write_next_chunk) */
+  g_object_set_data (G_OBJECT (s_msg), "client-socket",
+                     soup_client_context_get_socket (s_client));
+
   /* Call the Python callback */
   p_args = Py_BuildValue ("(Ns)", p_message, path);
   if (!p_args)
-    return;
+    {
+      PyGILState_Release (gstate);
+      return;
+    }
 
   p_callback = (PyObject *) user_data;
   p_result = PyObject_CallObject (p_callback, p_args);
@@ -561,7 +846,7 @@ s_server_callback (SoupServer * s_server, SoupMessage * s_msg,
       abort ();
     }
 
-  return;
+  PyGILState_Release (gstate);
 }
 
 
@@ -639,6 +924,23 @@ PyServerType_stop (PyServer * self, PyObject * args, PyObject * kwdict)
 }
 
 
+static PyObject *
+PyServerType_get_fd (PyServer * self, PyObject * args, PyObject * kwdict)
+{
+  SoupSocket *s_listener;
+
+  if (self->s_server == NULL)
+    return PyInt_FromLong (-1);
+
+  /* The file descriptor of the listening socket */
+  s_listener = soup_server_get_listener (self->s_server);
+  if (s_listener == NULL)
+    return PyInt_FromLong (-1);
+
+  return PyInt_FromLong (soup_socket_get_fd (s_listener));
+}
+
+
 static PyObject *
 PyServerType_add_handler (PyServer * self, PyObject * args, PyObject * kwdict)
 {
@@ -656,10 +958,46 @@ PyServerType_add_handler (PyServer * self, PyObject * args, PyObject * kwdict)
 }
 
 
+static PyObject *
+PyServerType_pause_message (PyServer * self, PyObject * args,
+                            PyObject * kwdict)
+{
+  PyMessage *p_message;
+
+  if (!PyArg_ParseTuple (args, "O!", &PyMessageType, &p_message))
+    return NULL;
+
+  soup_server_pause_message (self->s_server, p_message->s_msg);
+
+  Py_RETURN_NONE;
+}
+
+
+static PyObject *
+PyServerType_unpause_message (PyServer * self, PyObject * args,
+                              PyObject * kwdict)
+{
+  PyMessage *p_message;
+
+  if (!PyArg_ParseTuple (args, "O!", &PyMessageType, &p_message))
+    return NULL;
+
+  soup_server_unpause_message (self->s_server, p_message->s_msg);
+
+  Py_RETURN_NONE;
+}
+
+
 static PyMethodDef PyServer_methods[] = {
   {"listen", (PyCFunction) PyServerType_listen, METH_VARARGS,
    "Listen to the given interface and port"},
   {"stop", (PyCFunction) PyServerType_stop, METH_NOARGS, "Stop the server"},
+  {"get_fd", (PyCFunction) PyServerType_get_fd, METH_NOARGS,
+   "Returns the file descriptor of the listening socket"},
+  {"pause_message", (PyCFunction) PyServerType_pause_message, METH_VARARGS,
+   "Pauses the I/O of the given message, until it is unpaused"},
+  {"unpause_message", (PyCFunction) PyServerType_unpause_message,
+   METH_VARARGS, "Resumes the I/O of the given message"},
   {"add_handler", (PyCFunction) PyServerType_add_handler, METH_VARARGS,
    "Adds a handler for requests under path"},
   {NULL}                        /* Sentinel */
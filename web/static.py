@@ -23,7 +23,7 @@ from itools.core import fixed_offset
 from itools.fs.common import get_mimetype
 from itools.uri import Path
 from context import Context
-from utils import set_response
+from utils import set_response, set_response_body
 
 
 class StaticContext(Context):
@@ -46,10 +46,10 @@ class StaticContext(Context):
         if since and since >= mtime:
             return set_response(self.soup_message, 304)
 
-        # 200 Ok
+        # 200 Ok (the file is streamed, not read at once; if it is changed
+        # meanwhile the connection is aborted)
         # FIXME Check we set the encoding for text files
         mimetype = get_mimetype(basename(path))
-        data = open(path).read()
         self.soup_message.set_status(200)
-        self.soup_message.set_response(mimetype, data)
+        set_response_body(self.soup_message, mimetype, open(path, 'rb'))
         self.set_header('Last-Modified', mtime)
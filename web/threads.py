@@ -0,0 +1,237 @@
+# -*- coding: UTF-8 -*-
+# Copyright (C) 2012 J. David Ibáñez <jdavid.ibp@gmail.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the pool of threads where the views are rendered,
+while the main loop goes on serving the other requests.
+
+Neither the database of the server nor libsoup are thread safe, so they are
+only used from the main loop: every thread has its own read-only database
+(see WebServer.open_thread_database), the request is copied before it is
+given to a thread, and the response is recorded, then written from the main
+loop.
+"""
+
+# Import from the Standard Library
+from Queue import Queue
+from threading import Lock, Thread
+from time import time
+
+# Import from pygobject
+from gobject import idle_add
+
+# Import from itools
+from itools.log import log_error
+from utils import set_response
+
+
+
+class MessageProxy(object):
+    """Stands for the soup message in the threads.  The request is copied
+    when the proxy is made, from the main loop; the writes are recorded to
+    be replayed from the main loop (see 'replay').  The threads never touch
+    the soup message.
+    """
+
+    writes = frozenset(['append_header', 'set_header', 'set_response',
+                        'set_response_iter', 'set_status'])
+
+    def __init__(self, soup_message):
+        self.soup_message = soup_message
+        # The request
+        self.message_id = soup_message.get_id()
+        self.method = soup_message.get_method()
+        self.host = soup_message.get_host()
+        self.query = soup_message.get_query()
+        self.request_line = soup_message.get_request_line()
+        self.headers = soup_message.get_headers()
+        self.body = soup_message.get_body()
+        # The response
+        self.calls = []
+        # When the render ended
+        self.rendered = None
+
+
+    def __getattr__(self, name):
+        if name in self.writes:
+            return lambda *args: self.calls.append((name, args))
+        raise AttributeError, name
+
+
+    def get_id(self):
+        return self.message_id
+
+
+    def get_method(self):
+        return self.method
+
+
+    def get_host(self):
+        return self.host
+
+
+    def get_query(self):
+        return self.query
+
+
+    def get_request_line(self):
+        return self.request_line
+
+
+    def get_headers(self):
+        return list(self.headers)
+
+
+    def get_header(self, name):
+        # Like libsoup, the names are case insensitive
+        name = name.lower()
+        value = None
+        for key, x in self.headers:
+            if key.lower() == name:
+                value = x
+        return value
+
+
+    def get_body(self):
+        return self.body
+
+
+    def reset(self):
+        """Forgets the writes recorded so far.
+        """
+        del self.calls[:]
+
+
+    def replay(self):
+        """Does the writes recorded, to be called from the main loop.
+        """
+        soup_message = self.soup_message
+        for name, args in self.calls:
+            getattr(soup_message, name)(*args)
+        del self.calls[:]
+
+
+
+class ThreadPool(object):
+    """The messages are paused while they wait and are processed by a
+    thread, and unpaused from the main loop once done.  At most 'queue_max'
+    messages may wait.
+
+    The callbacks are called with the database of the thread (None if the
+    server has no database) and the proxy of the soup message, followed by
+    the arguments given to 'push'.
+    """
+
+    def __init__(self, server, size, queue_max):
+        self.server = server
+        self.queue = Queue(queue_max)
+        # The messages pushed and not yet replied (only used from the main
+        # loop)
+        self.pending = set()
+        # Metrics
+        self.lock = Lock()
+        self.count = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # Start
+        for i in range(size):
+            thread = Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+
+    def push(self, soup_message, callback, *args):
+        """Calls 'callback(database, message, *args)' in a thread.  Returns
+        False if the queue is full, True otherwise.
+        """
+        # Only the main loop pushes, so the queue cannot get full between
+        # the check and the put
+        queue = self.queue
+        if queue.full():
+            with self.lock:
+                self.rejected += 1
+            return False
+
+        self.server.pause_message(soup_message)
+        self.pending.add(soup_message.get_id())
+        message = MessageProxy(soup_message)
+        queue.put((time(), message, callback, args))
+        return True
+
+
+    def is_pending(self, message_id):
+        """Returns True if the given message has been pushed and is not yet
+        replied, False otherwise.
+        """
+        return message_id in self.pending
+
+
+    def work(self):
+        database = self.server.open_thread_database()
+        queue = self.queue
+        while True:
+            queued, message, callback, args = queue.get()
+            # Metrics
+            wait = time() - queued
+            with self.lock:
+                self.count += 1
+                self.wait_total += wait
+                if wait > self.wait_max:
+                    self.wait_max = wait
+            # See the last changes
+            if database is not None and database.catalog is not None:
+                database.catalog.reopen()
+            # Go
+            try:
+                callback(database, message, *args)
+            except Exception:
+                log_error('Internal error', domain='itools.web')
+                message.reset()
+                set_response(message, 500)
+            message.rendered = time()
+            if database is not None:
+                database.make_room()
+            # Reply from the main loop
+            idle_add(self.reply, message)
+
+
+    def reply(self, message):
+        server = self.server
+        soup_message = message.soup_message
+        message_id = soup_message.get_id()
+        self.pending.discard(message_id)
+        # The latency does not include the time taken to send the response
+        server.end_render(message_id, message.rendered)
+        message.replay()
+        server.unpause_message(soup_message)
+        return False
+
+
+    def get_stats(self):
+        """Returns a dict with the number of messages waiting ('queued'),
+        processed ('count') and rejected because the queue was full
+        ('rejected'); and the mean and max time they have waited, in seconds
+        ('wait_mean', 'wait_max').
+        """
+        with self.lock:
+            count = self.count
+            return {
+                'queued': self.queue.qsize(),
+                'count': count,
+                'rejected': self.rejected,
+                'wait_mean': self.wait_total / count if count else 0.0,
+                'wait_max': self.wait_max}
@@ -14,6 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from os import fstat
+from stat import S_ISREG
+
+# Import from itools
+from itools.log import log_error
+
+
 
 reason_phrases = {
     # Informational (HTTP 1.1)
@@ -75,3 +83,56 @@ def set_response(soup_message, status):
     body = '{0} {1}'.format(status, reason_phrases[status])
     soup_message.set_response('text/plain', body)
 
+
+
+
+def iter_body(body, chunk_size=65536):
+    """Iterates over the chunks of the given response body, a file object
+    or an iterator of strings.  Once the headers are sent there is no way to
+    report an error to the client, so the errors are logged and raised
+    again: then the connection is aborted, the client does not take the
+    body for complete.
+    """
+    try:
+        if hasattr(body, 'read'):
+            chunk = body.read(chunk_size)
+            while chunk:
+                yield chunk
+                chunk = body.read(chunk_size)
+        else:
+            for chunk in body:
+                if type(chunk) is unicode:
+                    chunk = chunk.encode('utf-8')
+                yield chunk
+    except Exception:
+        log_error('Failed to write the response body', domain='itools.web')
+        raise
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+
+def get_body_length(body):
+    """Returns the length of the given response body if it is a regular
+    file, or -1 if it is not known.
+    """
+    try:
+        stat = fstat(body.fileno())
+        if S_ISREG(stat.st_mode):
+            return stat.st_size - body.tell()
+    except Exception:
+        pass
+    return -1
+
+
+def set_response_body(soup_message, content_type, body):
+    """Sets the response body: a string is written at once, a file object
+    or an iterator of strings is streamed.
+    """
+    if isinstance(body, basestring):
+        soup_message.set_response(content_type, body)
+        return
+
+    length = get_body_length(body)
+    soup_message.set_response_iter(content_type, iter_body(body), length)
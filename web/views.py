@@ -53,6 +53,11 @@ class BaseView(prototype):
     # Access Control
     access = False
 
+    # The GET method is thread safe (it does not change the database and
+    # only reaches it through the context), it may be run in the pool of
+    # threads of the server (see WebServer.start_threads)
+    threaded = False
+
     def __init__(self, **kw):
         for key in kw:
             setattr(self, key, kw[key])